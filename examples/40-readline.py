@@ -1,42 +1,27 @@
-import msvcrt
-from time import sleep
+import selectors
+import time
 
+from tchat.terminal import TerminalInput
 
-_readline_cached_line = ""
 
-
-def readline(echo: bool = True) -> None | str:
-    global _readline_cached_line
-
-    if msvcrt.kbhit():
-        key_pressed = msvcrt.getch()
-        if key_pressed in b"\x00\xe0":
-            key_pressed += msvcrt.getch()
-        elif key_pressed == b"\x03":
-            raise KeyboardInterrupt
-        elif key_pressed == b"\r":
-            line = _readline_cached_line + "\n"
-            _readline_cached_line = ""
-            print(flush=True)
-            return line
-        elif key_pressed == b"\x08":
-            _readline_cached_line = _readline_cached_line[:-1]
-            if echo:
-                print("\b \b", end="", flush=True)
+def readline(terminal: TerminalInput, selector: selectors.BaseSelector) -> str:
+    # Waits for the keyboard instead of polling it, except on Windows
+    while not terminal.lines:
+        if terminal.fileno() is None:
+            time.sleep(terminal.poll_interval)
         else:
-            decoded_char = key_pressed.decode("cp850", errors="ignore")
-            _readline_cached_line += decoded_char
-            print(decoded_char, end="", flush=True)
-        # print(f"\33[2K\r{message}", end="", flush=True)
-    return None
+            selector.select()
+        terminal.lines.extend(terminal.read_lines())
+    return terminal.lines.popleft()
 
 
 if __name__ == "__main__":
-    while True:
-        try:
-            message = readline()
-            if message is not None:
+    with TerminalInput() as terminal, selectors.DefaultSelector() as selector:
+        if terminal.fileno() is not None:
+            selector.register(terminal.fileno(), selectors.EVENT_READ)
+        while True:
+            try:
+                message = readline(terminal, selector)
                 print(f"{message=}")
-            sleep(0.1)
-        except KeyboardInterrupt:
-            break
+            except (KeyboardInterrupt, EOFError):
+                break
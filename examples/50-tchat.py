@@ -1,73 +1,305 @@
 from dataclasses import dataclass, field
-import msvcrt
-import select
+from itertools import islice
+import selectors
 import socket
 import sys
-from typing import Iterable
+import time
+from typing import Container, Iterable
+
+from tchat.binary import (
+    ACCEPTED,
+    BINARY_PING,
+    CLIENT_FRAMES,
+    COMMAND,
+    PONG,
+    TEXT,
+    BinaryCodec,
+    BinaryDecoder,
+    BinaryMessage,
+    Interner,
+    defined_name,
+    encode_frame,
+)
+from tchat.compress import Compression, CompressionSession, accepted, parse_level
+from tchat.fanout import Frames, encode_message, fan_out
+from tchat.framing import FrameDecoder, FrameError, LineDecoder
+from tchat.handoff import (
+    ACK,
+    HANDOFF_TIMEOUT,
+    connect_handoff,
+    listen_handoff,
+    receive_ack,
+    receive_handoff,
+    StateReader,
+    StateWriter,
+    same_user,
+    send_handoff,
+)
+from tchat.history import HISTORY_REPLAY, History, HistoryEntry, entry_frames
+from tchat.listen import (
+    UNIX_PREFIX,
+    Endpoint,
+    listener_name,
+    open_listeners,
+    parse_endpoint,
+    peer_name,
+    remove_socket_files,
+)
+from tchat.logs import LogConfig, log, payload_log, start_logging
+from tchat.metrics import (
+    LoopCalls,
+    MetricsRegistry,
+    format_histogram,
+    serve_metrics,
+)
+from tchat.outqueue import OutputQueue
+from tchat.ratelimit import (
+    ClientLimits,
+    RateLimitConfig,
+    RateLimiter,
+    TokenBucket,
+    Verdict,
+    parse_rate,
+)
+from tchat.registry import Client, Registry, address_to_str
+from tchat.store import (
+    QUERY_LIMIT,
+    MessageStore,
+    QueryResult,
+    StoreConfig,
+    format_result,
+    parse_fsync,
+    parse_since,
+)
+from tchat.terminal import Renderer, TerminalInput
+from tchat.timers import (
+    PING_FRAME,
+    PONG_FRAME,
+    ConnectionTimers,
+    TimeoutConfig,
+    TimerWheel,
+)
 
 
 SERVER_PORT = 3030
 MESSAGE_MAX_SIZE = 100
+CLIENT_RECEIVE_SIZE = 64 * 1024
+STORE_DISABLED = "Le journal des messages n'est pas activé (--store)."
+# select() on Windows cannot be interrupted by Ctrl+C, so wake up periodically
+SELECT_TIMEOUT = 0.5 if sys.platform == "win32" else None
+# Clients copied to a new server per iteration of the loop, which goes on
+# serving in between, and copies of those changed meanwhile before stopping
+HANDOFF_BATCH = 500
+HANDOFF_ROUNDS = 3
+
+# Metrics of the server process, shown by /stats and served by --metrics
+metrics = MetricsRegistry()
+connections_total = metrics.counter("tchat_connections_total", "Connexions acceptées")
+clients_gauge = metrics.gauge("tchat_clients", "Clients connectés")
+messages_received = metrics.counter("tchat_messages_received_total", "Messages reçus")
+bytes_received = metrics.counter("tchat_received_bytes_total", "Octets reçus")
+messages_sent = metrics.counter("tchat_messages_sent_total", "Messages envoyés")
+bytes_sent = metrics.counter("tchat_sent_bytes_total", "Octets envoyés")
+queued_bytes = metrics.gauge(
+    "tchat_queued_bytes", "Octets en attente dans les files d'envoi"
+)
+select_seconds = metrics.counter(
+    "tchat_select_seconds_total", "Temps passé à attendre dans select()"
+)
+loop_seconds = metrics.histogram(
+    "tchat_loop_iteration_seconds", "Durée de traitement des évènements d'un select()"
+)
+fanout_seconds = metrics.histogram(
+    "tchat_fanout_seconds", "Durée d'encodage et de mise en file d'une diffusion"
+)
+delivery_seconds = metrics.histogram(
+    "tchat_delivery_seconds", "Attente des messages dans les files d'envoi"
+)
+
+# Recent room messages, replayed to new members and by /history and /resume
+history = History()
+metrics.gauge(
+    "tchat_history_bytes", "Taille de l'historique des messages", lambda: history.size
+)
+# Frames and interned ids of the clients that switched to /binary, only the
+# nicknames and rooms in use keep theirs, set by server_main
+binary_codec = BinaryCodec()
+metrics.gauge(
+    "tchat_binary_names",
+    "Pseudos numérotés pour le protocole binaire",
+    lambda: len(binary_codec.names),
+)
+# zlib contexts of the clients that asked for /compress
+compression = Compression()
+metrics.gauge(
+    "tchat_compression_streams",
+    "Contextes zlib des clients compressés",
+    lambda: compression.streams,
+)
+metrics.counter(
+    "tchat_compressed_input_bytes_total",
+    "Octets à compresser",
+    lambda: compression.input_bytes,
+)
+metrics.counter(
+    "tchat_compressed_output_bytes_total",
+    "Octets compressés envoyés",
+    lambda: compression.output_bytes,
+)
+metrics.counter(
+    "tchat_shared_compressions_total",
+    "Trames compressées une fois pour plusieurs clients",
+    lambda: compression.shared_frames,
+)
+# Durable log of the room messages, for /since and /search, with --store
+store: MessageStore | None = None
+metrics.gauge(
+    "tchat_store_pending_messages",
+    "Messages en attente d'écriture dans le journal",
+    lambda: store.records.qsize() if store else 0,
+)
+# Idle timeout, heartbeat and login deadline of the clients, set by server_main
+timers: "ConnectionTimers[ClientInfo] | None" = None
+metrics.gauge(
+    "tchat_timers", "Minuteries en cours", lambda: len(timers.wheel) if timers else 0
+)
+metrics.counter(
+    "tchat_pings_total", "/ping envoyés", lambda: timers.pings if timers else 0
+)
+metrics.counter(
+    "tchat_timeout_disconnections_total",
+    "Clients inactifs ou sans pseudo déconnectés",
+    lambda: timers.idle_closed + timers.login_closed if timers else 0,
+)
+# Flood control of the received messages, set by server_main
+limiter: RateLimiter | None = None
+metrics.counter(
+    "tchat_refused_messages_total",
+    "Messages refusés par la limite de débit",
+    lambda: limiter.refused_messages if limiter else 0,
+)
+metrics.counter(
+    "tchat_refused_bytes_total",
+    "Octets refusés par la limite de débit",
+    lambda: limiter.refused_bytes if limiter else 0,
+)
+metrics.counter(
+    "tchat_flood_mutes_total",
+    "Clients rendus muets pour flood",
+    lambda: limiter.mutes if limiter else 0,
+)
+metrics.counter(
+    "tchat_flood_disconnections_total",
+    "Clients déconnectés pour flood",
+    lambda: limiter.disconnections if limiter else 0,
+)
+# Clients being passed to a new server, set by server_main: the changes of
+# the clients already copied are tracked
+handoff: "Handoff | None" = None
+
+
+@dataclass(slots=True, eq=False)
+class ClientInfo(Client):
+    # Client records are keyed by their socket
+    send_buffer: OutputQueue = field(default_factory=OutputQueue)
+    # A BinaryDecoder after /binary
+    receive_buffer: FrameDecoder = field(default_factory=LineDecoder)
+    # Frames are queued compressed after /compress
+    compression: CompressionSession | None = None
+    selector: selectors.BaseSelector | None = None
+    events: int = selectors.EVENT_READ
+    # Since when the oldest frame of send_buffer waits
+    queued_since: float = 0.0
+    received_messages: int = 0
+    received_bytes: int = 0
+    sent_messages: int = 0
+    sent_bytes: int = 0
+
+    @property
+    def socket(self) -> socket.socket:
+        return self.key  # type: ignore [return-value]
+
+
+ConnectionDict = Registry[ClientInfo]
+
+
+def set_write_interest(client_info: ClientInfo, enabled: bool):
+    # Only ask the selector for EVENT_WRITE while there is something to send,
+    # otherwise every idle connection would wake the loop up.
+    if client_info.selector is None:
+        return
+    events = selectors.EVENT_READ
+    if enabled:
+        events |= selectors.EVENT_WRITE
+    if events != client_info.events:
+        client_info.selector.modify(client_info.socket, events)
+        client_info.events = events
 
 
-@dataclass
-class ClientInfo:
-    socket: socket.socket
-    name: str
-    send_buffer: list[bytes] = field(default_factory=list)
-
-
-ConnectionDict = dict[socket.socket, ClientInfo]
-
-
-def address_to_str(address: tuple[str, int] | tuple[str, int, int, int]) -> str:
-    try:
-        host, port, *_ = address
-        return f"{host}:{port}"
-    except:
-        return str(address)
-
-
-def connection_made(connections: ConnectionDict, client_socket: socket.socket):
-    name = address_to_str(client_socket.getpeername())
-    print(f"Connection de {name}")
-    connections[client_socket] = ClientInfo(client_socket, name)
-    send_message(
-        "Bienvenue sur le tchat !",
-        connections[client_socket],
+def connection_address(client_socket: socket.socket) -> str:
+    return address_to_str(
+        peer_name(client_socket.getpeername(), client_socket.getsockname())
     )
 
 
-def terminate_connection(connections: ConnectionDict, client_socket: socket.socket):
-    print(f"Déconnexion de {address_to_str(client_socket.getpeername())}")
-    client_name = connections[client_socket].name
-    del connections[client_socket]
-    broadcast_message_to(f"{client_name} est parti.", connections.values())
+def connection_made(
+    connections: ConnectionDict,
+    client_socket: socket.socket,
+    selector: selectors.BaseSelector | None = None,
+):
+    address = connection_address(client_socket)
+    log.info("Connection de %s", address)
+    if selector is not None:
+        selector.register(client_socket, selectors.EVENT_READ)
+    client_info = connections.add(ClientInfo(client_socket, address, selector=selector))
+    connections_total.inc()
+    clients_gauge.set(len(connections))
+    if handoff:
+        handoff.dirty[client_info] = None
+    if timers:
+        timers.connected(client_info)
+    send_message("Bienvenue sur le tchat !", client_info)
+    replay_history(client_info, history.recent(connections.rooms.default_room))
 
 
-def cut_message(message: str, max_size: int):
-    data = message.encode()
-    data_size = len(data)
-    if data_size <= max_size:
-        yield data
-    else:
-        while data:
-            beginning = data[:max_size].decode(errors="ignore").encode()
-            yield beginning
-            data = data[len(beginning) :]
-
-
-def get_data_from_message(message: str, from_name: str):
-    message = message.rstrip()
-    header = from_name + "> "
-    header_data = header.encode()
-    footer_data = "\n".encode()
-    overhead_size = len(header_data) + len(footer_data)
-    return (
-        header_data + body_data + footer_data
-        for line in message.split("\n")
-        for body_data in cut_message(line, MESSAGE_MAX_SIZE - overhead_size)
-    )
+def terminate_connection(connections: ConnectionDict, client_socket: socket.socket):
+    client_info = connections[client_socket]
+    if handoff:
+        handoff.dirty[client_info] = None
+    if timers:
+        timers.disconnected(client_info)
+    audience = connections.rooms.audience(client_info)
+    del audience[client_info]
+    connections.remove(client_socket)
+    clients_gauge.set(len(connections))
+    queued_bytes.inc(-client_info.send_buffer.size)
+    if client_info.compression:
+        client_info.compression.close()
+    log.info("Déconnexion de %s", client_info.address)
+    broadcast_message_to(f"{client_info.label} est parti.", audience)
+
+
+def get_data_from_message(message: str, from_name: str) -> Frames:
+    return encode_message(message, from_name + "> ", MESSAGE_MAX_SIZE)
+
+
+def queue_frame(destination: ClientInfo, frame: bytes):
+    if destination.compression:
+        frame = destination.compression.compress(frame)
+    if not destination.send_buffer:
+        destination.queued_since = time.perf_counter()
+    destination.send_buffer.append(frame)
+    queued_bytes.inc(len(frame))
+    if handoff:
+        handoff.dirty[destination] = None
+    set_write_interest(destination, True)
+
+
+def queue_text_frame(destination: ClientInfo, frame: bytes):
+    # Text frames reach binary clients behind a TEXT header
+    if destination.binary:
+        frame = encode_frame(TEXT, frame)
+    queue_frame(destination, frame)
 
 
 def send_message(message: str, destination: ClientInfo, from_name: str = ""):
@@ -77,43 +309,329 @@ def send_message(message: str, destination: ClientInfo, from_name: str = ""):
 def broadcast_message_to(
     message: str, destinations: Iterable[ClientInfo], from_name: str = ""
 ):
-    for message_data in get_data_from_message(message, from_name):
-        for destination in destinations:
-            destination.send_buffer.append(message_data)
+    # Frames are built once and the same bytes objects are queued to everybody
+    start = time.perf_counter()
+    frames = get_data_from_message(message, from_name)
+    fan_out(frames, destinations, queue_text_frame)
+    fanout_seconds.record(time.perf_counter() - start)
+
+
+def broadcast_message_to_room(
+    message: str,
+    connections: ConnectionDict,
+    room: str,
+    from_name: str = "",
+    exclude: ClientInfo | None = None,
+):
+    start = time.perf_counter()
+    if from_name:
+        from_name = connections.rooms.sender_label(room, from_name)
+    frames = get_data_from_message(message, from_name)
+    connections.rooms.fan_out(room, frames, queue_frame, exclude)
+    fanout_seconds.record(time.perf_counter() - start)
+
+
+def broadcast_chat_message(
+    message: str, connections: ConnectionDict, room: str, sender: ClientInfo
+):
+    # Like broadcast_message_to_room, and the frames are kept in the history
+    start = time.perf_counter()
+    from_name = connections.rooms.sender_label(room, sender.label)
+    frames = get_data_from_message(message, from_name)
+    entry = history.append(room, frames)
+
+    def encode_binary() -> BinaryMessage | None:
+        # Once there is a binary member. Only nicknames are interned: the
+        # messages of a client without one reach them as TEXT frames
+        if sender.name is None:
+            return None
+        binary = binary_codec.message(entry.seq, sender.name, room, message)
+        history.set_binary(entry, binary)
+        return binary
+
+    connections.rooms.fan_out(
+        room, frames, queue_frame, sender, entry.sequenced_frames, encode_binary
+    )
+    if store:
+        store.append(room, sender.label, message.rstrip("\n"))
+    fanout_seconds.record(time.perf_counter() - start)
+
+
+def replay_history(client_info: ClientInfo, entries: Iterable[HistoryEntry]):
+    for frame in entry_frames(entries, client_info.sequenced, client_info.binary):
+        queue_frame(client_info, frame)
 
 
 def process_ready_to_send(connections: ConnectionDict, client_socket: socket.socket):
-    if client_socket in connections and connections[client_socket].send_buffer:
-        data = connections[client_socket].send_buffer.pop(0)
-        client_socket.send(data)
-        print(f"Envoi {data!r} à {address_to_str(client_socket.getpeername())}")
+    client_info = connections.get(client_socket)
+    if client_info is None:
+        return
+    if client_info.send_buffer:
+        # Flush every queued frame the kernel accepts in one writev() call,
+        # partially sent frames stay at the head of the queue.
+        frame_count = len(client_info.send_buffer)
+        sent = client_info.send_buffer.send_to(client_socket)
+        frame_count -= len(client_info.send_buffer)
+        now = time.perf_counter()
+        delivery_seconds.record(now - client_info.queued_since)
+        client_info.queued_since = now
+        client_info.sent_messages += frame_count
+        client_info.sent_bytes += sent
+        messages_sent.inc(frame_count)
+        bytes_sent.inc(sent)
+        queued_bytes.inc(-sent)
+        log.debug(
+            "Envoi %d messages (%d octets) à %s", frame_count, sent, client_info.address
+        )
+    set_write_interest(client_info, bool(client_info.send_buffer))
 
 
-def get_ready_to_send(connections: ConnectionDict) -> list[socket.socket]:
-    return [client for client, sending_buffer in connections.items() if sending_buffer]
+def process_ready_to_receive(
+    connections: ConnectionDict, client_socket: socket.socket
+) -> bool:
+    # Returns False when the connection has to be closed
+    client_info = connections[client_socket]
+    try:
+        if not client_info.receive_buffer.recv_from(client_socket):
+            return False
+        receive_buffer = None
+        # /binary replaces the decoder, which takes over the bytes left
+        while receive_buffer is not client_info.receive_buffer:
+            receive_buffer = client_info.receive_buffer
+            for message_data in receive_buffer:
+                data_received(connections, message_data, client_socket)
+    except (BlockingIOError, InterruptedError):
+        pass
+    except (ConnectionError, ValueError):
+        # FrameError or anything else this client sent that cannot be read:
+        # only its connection is closed
+        return False
+    return True
 
 
 def command_set_name(
     connections: ConnectionDict, client_info: ClientInfo, client_name: str
 ):
-    if any(
-        connection.name == client_name
-        for connection in connections.values()
-        if connection is not client_info
-    ):
+    if not connections.rename(client_info, client_name):
         send_message(
             f"Impossible de fixer le pseudo à {client_name} car il est déjà utilisé.",
             client_info,
         )
         return
-    client_info.name = client_name
-    broadcast_message_to(f"{client_name} est dans la place !", connections.values())
+    if timers:
+        timers.logged_in(client_info)
+    broadcast_message_to(
+        f"{client_name} est dans la place !", connections.rooms.audience(client_info)
+    )
 
 
 def command_help_set_name(connections: ConnectionDict, client_info: ClientInfo):
     send_message("Usage: /pseudo mon_pseudo", client_info)
 
 
+def command_private_message(
+    connections: ConnectionDict, client_info: ClientInfo, client_name: str, *words: str
+):
+    destination = connections.find_name(client_name)
+    if destination is None:
+        send_message(f"Personne ne s'appelle {client_name}.", client_info)
+        return
+    text = " ".join(words)
+    if destination.binary and client_info.name is not None:
+        message = binary_codec.private(client_info.name, text)
+        for frame in destination.binary.message_frames(message):
+            queue_frame(destination, frame)
+        return
+    send_message(text, destination, f"{client_info.label} (privé)")
+
+
+def command_help_private_message(connections: ConnectionDict, client_info: ClientInfo):
+    send_message("Usage: /msg pseudo message", client_info)
+
+
+def command_join_room(connections: ConnectionDict, client_info: ClientInfo, room: str):
+    if connections.rooms.join(client_info, room):
+        replay_history(client_info, history.recent(room))
+        broadcast_message_to_room(
+            f"{client_info.label} a rejoint le salon {room}.", connections, room
+        )
+    else:
+        send_message(f"Vous parlez maintenant dans le salon {room}.", client_info)
+
+
+def command_help_join_room(connections: ConnectionDict, client_info: ClientInfo):
+    send_message("Usage: /join salon", client_info)
+
+
+def command_leave_room(
+    connections: ConnectionDict, client_info: ClientInfo, room: str = ""
+):
+    rooms = connections.rooms
+    room = room or rooms.current(client_info) or ""
+    if not rooms.leave(client_info, room):
+        send_message(f"Vous n'êtes pas dans le salon {room}.", client_info)
+        return
+    broadcast_message_to_room(
+        f"{client_info.label} a quitté le salon {room}.", connections, room
+    )
+    if not client_info.rooms:
+        rooms.join(client_info, rooms.default_room)
+    send_message(
+        f"Vous avez quitté le salon {room}, vous parlez dans le salon "
+        f"{rooms.current(client_info)}.",
+        client_info,
+    )
+
+
+def command_help_leave_room(connections: ConnectionDict, client_info: ClientInfo):
+    send_message("Usage: /leave [salon]", client_info)
+
+
+def command_list_rooms(connections: ConnectionDict, client_info: ClientInfo):
+    rooms = connections.rooms
+    current = rooms.current(client_info)
+    room_list = "".join(
+        f"{'*' if room == current else ' '} {room} ({len(rooms.members[room])})\n"
+        for room in sorted(rooms)
+    )
+    send_message("Salons:\n" + room_list, client_info)
+
+
+def command_history(
+    connections: ConnectionDict, client_info: ClientInfo, count: str = ""
+):
+    room = connections.rooms.current(client_info) or ""
+    if count and not count.isdigit():
+        command_help_history(connections, client_info)
+        return
+    replay_history(client_info, history.recent(room, int(count or HISTORY_REPLAY)))
+
+
+def command_help_history(connections: ConnectionDict, client_info: ClientInfo):
+    send_message("Usage: /history [nombre de messages]", client_info)
+
+
+def command_resume(
+    connections: ConnectionDict, client_info: ClientInfo, position: str = ""
+):
+    # Handshake of tchat.client: "/seq <position>" answers, then come the room
+    # messages missed since `position`, each one after its "/seq N" line.
+    client_info.sequenced = True
+    queue_text_frame(client_info, f"/seq {history.position}\n".encode())
+    if position:
+        entries, complete = history.resume(position, client_info.rooms)
+        if not complete:
+            send_message("Historique incomplet, derniers messages:", client_info)
+        replay_history(client_info, entries)
+
+
+def command_binary(connections: ConnectionDict, client_info: ClientInfo):
+    # Negotiation of tchat.binary: the answer is the last text line both ways
+    if client_info.binary:
+        send_message("Le protocole binaire est déjà actif.", client_info)
+        return
+    queue_frame(client_info, ACCEPTED)
+    client_info.binary = binary_codec.session()
+    client_info.receive_buffer = BinaryDecoder.following(client_info.receive_buffer)
+
+
+def command_compress(
+    connections: ConnectionDict, client_info: ClientInfo, level: str = ""
+):
+    # The answer is the last frame sent uncompressed
+    if client_info.compression:
+        send_message("La compression est déjà active.", client_info)
+        return
+    try:
+        compression_level = parse_level(level)
+    except ValueError:
+        command_help_compress(connections, client_info)
+        return
+    queue_text_frame(client_info, accepted(compression_level))
+    client_info.compression = compression.session(compression_level)
+
+
+def command_help_compress(connections: ConnectionDict, client_info: ClientInfo):
+    send_message("Usage: /compress [niveau de 1 à 9]", client_info)
+
+
+def send_stored_messages(client_info: ClientInfo, result: QueryResult, command: str):
+    # Queries run in the loop: each reads a bounded part of the index, and
+    # tells the client the command that gets the next messages
+    send_message(format_result(result, command), client_info)
+
+
+def command_since(connections: ConnectionDict, client_info: ClientInfo, since: str):
+    if store is None:
+        send_message(STORE_DISABLED, client_info)
+        return
+    try:
+        kind, value = parse_since(since)
+    except ValueError:
+        command_help_since(connections, client_info)
+        return
+    room = connections.rooms.current(client_info)
+    if kind == "seq":
+        result = store.since_seq(int(value), room)
+    else:
+        result = store.since_time(value, room)
+    send_stored_messages(client_info, result, "/since")
+
+
+def command_help_since(connections: ConnectionDict, client_info: ClientInfo):
+    send_message(
+        "Usage: /since <numéro de message | durée (10m, 2h, 1j) | date ISO>",
+        client_info,
+    )
+
+
+def command_search(
+    connections: ConnectionDict,
+    client_info: ClientInfo,
+    name: str,
+    count: str = "",
+    before: str = "",
+):
+    if store is None:
+        send_message(STORE_DISABLED, client_info)
+        return
+    if count and not count.isdigit() or before and not before.isdigit():
+        command_help_search(connections, client_info)
+        return
+    limit = min(int(count or HISTORY_REPLAY), QUERY_LIMIT)
+    result = store.by_author(name, limit, int(before) if before else None)
+    send_stored_messages(client_info, result, f"/search {name} {limit}")
+
+
+def command_help_search(connections: ConnectionDict, client_info: ClientInfo):
+    send_message(
+        "Usage: /search <pseudo> [nombre de messages] [avant le numéro]", client_info
+    )
+
+
+def command_stats(connections: ConnectionDict, client_info: ClientInfo):
+    send_message(
+        "Statistiques du serveur:\n"
+        f" clients: {len(connections)} ({connections_total.value} connexions)\n"
+        f" reçus: {messages_received.value} messages ({bytes_received.value} octets)\n"
+        f" envoyés: {messages_sent.value} messages ({bytes_sent.value} octets), "
+        f"{queued_bytes.value} octets en attente\n"
+        f" attente dans select(): {select_seconds.value:.1f} s\n"
+        f" traitement d'un select(): {format_histogram(loop_seconds)}\n"
+        f" diffusion: {format_histogram(fanout_seconds)}\n"
+        f" livraison: {format_histogram(delivery_seconds)}\n"
+        f" compression: {compression.input_bytes} octets envoyés en "
+        f"{compression.output_bytes}, {compression.shared_frames} trames partagées\n"
+        f" refusés (limite de débit): {limiter.refused_messages if limiter else 0} "
+        f"messages, {limiter.mutes if limiter else 0} clients rendus muets\n"
+        f" vous: {client_info.received_messages} messages reçus "
+        f"({client_info.received_bytes} octets), {client_info.sent_messages} "
+        f"envoyés ({client_info.sent_bytes} octets), "
+        f"{client_info.send_buffer.size} octets en attente",
+        client_info,
+    )
+
+
 def command_help(connections: ConnectionDict, client_info: ClientInfo, name: str = ""):
     global commands
     if name:
@@ -140,6 +658,17 @@ def command_help_help(connections: ConnectionDict, client_info: ClientInfo):
 
 commands = {
     "/pseudo": (command_set_name, 1, 1, command_help_set_name),
+    "/msg": (command_private_message, 2, sys.maxsize, command_help_private_message),
+    "/join": (command_join_room, 1, 1, command_help_join_room),
+    "/leave": (command_leave_room, 0, 1, command_help_leave_room),
+    "/rooms": (command_list_rooms, 0, 0, None),
+    "/stats": (command_stats, 0, 0, None),
+    "/history": (command_history, 0, 1, command_help_history),
+    "/resume": (command_resume, 0, 1, None),
+    "/binary": (command_binary, 0, 0, None),
+    "/compress": (command_compress, 0, 1, command_help_compress),
+    "/since": (command_since, 1, 1, command_help_since),
+    "/search": (command_search, 1, 3, command_help_search),
     "/help": (command_help, 0, 1, command_help_help),
     "/?": (command_help, 0, 1, command_help_help),
     "/toto": (None, 0, 5, None),
@@ -173,139 +702,784 @@ def process_command(message: str, client_info: ClientInfo, connections: Connecti
 def data_received(
     connections: ConnectionDict, data: bytes, client_socket: socket.socket
 ):
-    peername = address_to_str(client_socket.getpeername())
-    print(f"Reçu {data!r} de {peername}")
-
-    message = data.decode()
     client_info = connections[client_socket]
+    payload_log.debug("Reçu %r de %s", data, client_info.address)
+    client_info.received_messages += 1
+    client_info.received_bytes += len(data)
+    messages_received.inc()
+    bytes_received.inc(len(data))
+
+    # Whatever a client sends, invalid UTF-8 included, is shown as text
+    message = data.decode(errors="replace")
+    if client_info.binary:
+        # The frame type says what the text protocol finds in the text
+        decoder: BinaryDecoder = client_info.receive_buffer  # type: ignore [assignment]
+        frame_type = decoder.frame_type
+        if frame_type not in CLIENT_FRAMES:
+            raise FrameError(f"Trame de type {frame_type} inattendue")
+        if timers:
+            timers.activity(client_info)
+        if frame_type == PONG:
+            return
+        is_command = frame_type == COMMAND
+    else:
+        if timers:
+            timers.activity(client_info)
+            if message.rstrip() == "/pong":
+                return
+        is_command = message.startswith("/")
+
+    room = None if is_command else connections.rooms.current(client_info)
+    if limiter:
+        # Before anything is encoded or queued for the room
+        verdict = limiter.check(client_info, len(data), room)
+        if verdict is not Verdict.ACCEPT:
+            refuse_message(verdict, client_info, room)
+            return
+        notice = limiter.dropped_notice(client_info)
+        if notice:
+            send_message(notice, client_info)
 
-    if message.startswith("/"):
+    if is_command:
         process_command(message, client_info, connections)
         return
 
-    # Broadcast the message
-    for connection, info in connections.items():
-        if connection is not client_socket:
-            send_message(message, info, client_info.name)
+    # Broadcast the message to the members of the current room
+    if room is not None:
+        broadcast_chat_message(message, connections, room, client_info)
 
 
-def server_main(host: str, port: int):
-    addresses = socket.getaddrinfo(host, port, family=socket.AF_INET)
-    if not addresses:
-        print(f"Impossible de résoudre l'adresse {host}:{port}")
-        return
-    server_address = addresses[0][-1]
-    server_socket = socket.socket()
-    server_socket.setblocking(False)
-    server_socket.bind(server_address)
-    server_socket.listen()
-    print(f"Serveur en écoute {host}:{port}")
+def refuse_message(verdict: Verdict, client_info: ClientInfo, room: str | None):
+    assert limiter
+    if verdict is Verdict.DISCONNECT:
+        log.info("Déconnexion de %s: trop de messages", client_info.address)
+        # process_ready_to_receive closes the connection
+        raise ConnectionAbortedError
+    notice = limiter.notice(verdict, room)
+    if notice:
+        send_message(notice, client_info)
+
+
+def close_connection(
+    connections: ConnectionDict,
+    client_socket: socket.socket,
+    selector: selectors.BaseSelector,
+):
+    selector.unregister(client_socket)
+    terminate_connection(connections, client_socket)
+    client_socket.close()
+
+
+def accept_connections(
+    connections: ConnectionDict,
+    server_socket: socket.socket,
+    selector: selectors.BaseSelector,
+):
+    # Drain the whole accept backlog at once, connections arrive in bursts
+    while True:
+        try:
+            client_socket, _ = server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        client_socket.setblocking(False)
+        connection_made(connections, client_socket, selector)
+
+
+def process_events(
+    connections: ConnectionDict,
+    ready: list[tuple[selectors.SelectorKey, int]],
+    selector: selectors.BaseSelector,
+    listeners: Container[socket.socket] = (),
+):
+    for key, events in ready:
+        ready_socket: socket.socket = key.fileobj  # type: ignore [assignment]
+        if ready_socket in listeners:
+            accept_connections(connections, ready_socket, selector)
+            continue
+
+        if events & selectors.EVENT_READ:
+            if not process_ready_to_receive(connections, ready_socket):
+                close_connection(connections, ready_socket, selector)
+                continue
+
+        if events & selectors.EVENT_WRITE:
+            try:
+                process_ready_to_send(connections, ready_socket)
+            except ConnectionError:
+                close_connection(connections, ready_socket, selector)
+
+
+def pop_ready(
+    ready: list[tuple[selectors.SelectorKey, int]], sock: socket.socket | None
+) -> bool:
+    # Whether `sock`, which is no client, is ready; removed from `ready`
+    for index, (key, _) in enumerate(ready):
+        if key.fileobj is sock:
+            del ready[index]
+            return True
+    return False
+
+
+def export_client(client_info: ClientInfo, writer: StateWriter) -> list:
+    # What a new process needs to go on with the connection, the frames of
+    # the send queue and the start of a frame received become plain bytes
+    send_buffer = client_info.send_buffer
+    receive_buffer = client_info.receive_buffer
+    received = bytes(receive_buffer.view[receive_buffer.start : receive_buffer.end])
+    binary = client_info.binary
+    return [
+        int(client_info.socket.family),
+        client_info.address,
+        client_info.name,
+        list(client_info.rooms),
+        client_info.sequenced,
+        client_info.last_activity,
+        export_limits(client_info.limits),
+        [export_ids(binary.names), export_ids(binary.rooms)] if binary else None,
+        client_info.compression.level if client_info.compression else 0,
+        writer.blob(b"".join(send_buffer.pending_buffers(len(send_buffer)))),
+        client_info.queued_since,
+        writer.blob(received),
+        client_info.received_messages,
+        client_info.received_bytes,
+        client_info.sent_messages,
+        client_info.sent_bytes,
+    ]
+
+
+def export_ids(known: dict[int, bytes]) -> list[tuple[int, str]]:
+    # Ids a binary client knows, with the names it was told
+    return [(index, defined_name(definition)) for index, definition in known.items()]
+
+
+def adopt_ids(interner: Interner, names: list[list]) -> dict[int, bytes]:
+    return {index: interner.define(index, name) for index, name in names}
+
+
+def export_bucket(bucket: TokenBucket | None) -> list | None:
+    if bucket is None:
+        return None
+    return [bucket.rate, bucket.capacity, bucket.tokens, bucket.updated]
+
+
+def adopt_bucket(state: list | None) -> TokenBucket | None:
+    return None if state is None else TokenBucket(*state)
 
-    all_sockets = [server_socket]
-    connections: ConnectionDict = {}
 
+def export_limits(limits: ClientLimits | None) -> list | None:
+    if limits is None:
+        return None
+    return [
+        export_bucket(limits.messages),
+        export_bucket(limits.bytes),
+        limits.refused,
+        limits.notified,
+        limits.muted_until,
+        limits.mutes,
+        limits.dropped,
+    ]
+
+
+def adopt_limits(state: list | None) -> ClientLimits | None:
+    if state is None:
+        return None
+    messages, size, *counters = state
+    return ClientLimits(adopt_bucket(messages), adopt_bucket(size), *counters)
+
+
+def adopt_client(
+    connections: ConnectionDict,
+    selector: selectors.BaseSelector,
+    client_socket: socket.socket,
+    state: list,
+    reader: StateReader,
+) -> ClientInfo:
+    address = state[1]
+    if client_socket.family == socket.AF_UNIX:
+        # Numbered again, the numbers of this process start over
+        address = connection_address(client_socket)
+    selector.register(client_socket, selectors.EVENT_READ)
+    client_info = connections.add(ClientInfo(client_socket, address, selector=selector))
+    if timers:
+        timers.connected(client_info)
+    update_client(connections, client_info, state, reader)
+    return client_info
+
+
+def update_client(
+    connections: ConnectionDict,
+    client_info: ClientInfo,
+    state: list,
+    reader: StateReader,
+):
+    # The state exported by the old server, of an adopted client or of one
+    # changed since
+    (
+        _,
+        _,
+        name,
+        rooms,
+        client_info.sequenced,
+        client_info.last_activity,
+        limits,
+        binary_ids,
+        level,
+        pending,
+        client_info.queued_since,
+        received,
+        client_info.received_messages,
+        client_info.received_bytes,
+        client_info.sent_messages,
+        client_info.sent_bytes,
+    ) = state
+    client_info.limits = adopt_limits(limits)
+    pending = reader.blob(pending)
+    received = reader.blob(received)
+    if name != client_info.name:
+        connections.rename(client_info, name)
+    if rooms != list(client_info.rooms):
+        connections.rooms.leave_all(client_info)
+        for room in rooms:
+            connections.rooms.join(client_info, room)
+    if binary_ids:
+        if not client_info.binary:
+            client_info.binary = binary_codec.session()
+        names, rooms = binary_ids
+        client_info.binary.names = adopt_ids(binary_codec.names, names)
+        client_info.binary.rooms = adopt_ids(binary_codec.rooms, rooms)
+    if binary_ids or client_info.receive_buffer:
+        client_info.receive_buffer = BinaryDecoder() if binary_ids else LineDecoder()
+    if received:
+        client_info.receive_buffer.feed(received)
+    if level != (client_info.compression.level if client_info.compression else 0):
+        if client_info.compression:
+            client_info.compression.close()
+        # A new zlib context may follow the output of another after a flush
+        client_info.compression = compression.session(level) if level else None
+    if client_info.send_buffer:
+        queued_bytes.inc(-client_info.send_buffer.size)
+        client_info.send_buffer = OutputQueue()
+    if pending:
+        client_info.send_buffer.append(pending)
+        queued_bytes.inc(len(pending))
+    set_write_interest(client_info, bool(pending))
+
+
+def discard_client(
+    connections: ConnectionDict,
+    selector: selectors.BaseSelector,
+    client_info: ClientInfo,
+):
+    # Closes an adopted client gone from the old server, which told the others
+    selector.unregister(client_info.socket)
+    if timers:
+        timers.disconnected(client_info)
+    connections.remove(client_info.socket)
+    queued_bytes.inc(-client_info.send_buffer.size)
+    if client_info.compression:
+        client_info.compression.close()
+    client_info.socket.close()
+
+
+@dataclass(slots=True)
+class Handoff:
+    """Clients passed to a new server connected to `successor`.
+
+    They are copied by batches while this server goes on, the next one once
+    the new server adopted the previous one, with the history up to
+    `history_seq`. `dirty` gets the clients changed, connected or gone
+    meanwhile: copied again in another round while there are many, the
+    only ones sent once this server stopped. `ids` numbers the clients sent.
+    """
+
+    successor: socket.socket
+    clients: list[ClientInfo]
+    start: float
+    history_seq: int
+    copied: int = 0
+    rounds: int = 1
+    ids: dict[ClientInfo, int] = field(default_factory=dict)
+    dirty: dict[ClientInfo, None] = field(default_factory=dict)
+
+
+def start_handoff(
+    connections: ConnectionDict,
+    selector: selectors.BaseSelector,
+    listeners: list[socket.socket],
+    handoff_listener: socket.socket,
+) -> Handoff | None:
+    # The listening sockets first, then the clients by copy_clients()
     try:
-        while all_sockets:
-            output_sockets = get_ready_to_send(connections)
-            readable_sockets, writable_sockets, error_sockets = select.select(
-                all_sockets, output_sockets, all_sockets, 0.1
-            )
+        successor, _ = handoff_listener.accept()
+    except (BlockingIOError, InterruptedError):
+        return None
+    start = time.monotonic()
+    try:
+        successor.settimeout(HANDOFF_TIMEOUT)
+        if not same_user(successor):
+            raise PermissionError("processus d'un autre utilisateur")
+        fds = [handoff_listener.fileno(), *(sock.fileno() for sock in listeners)]
+        send_handoff(successor, fds, b"")
+    except OSError as error:
+        log.error("Passation impossible: %s", error)
+        successor.close()
+        return None
+    # Readable when the new server acknowledges a message
+    selector.register(successor, selectors.EVENT_READ)
+    log.info("Passation de %d connexions à un nouveau serveur", len(connections))
+    return Handoff(
+        successor, list(connections.values()), start, history.first_seq - 1
+    )
 
-            for readable_socket in readable_sockets:
-                if readable_socket is server_socket:
-                    # server socket is ready to accept a connection
-                    client_socket, _ = server_socket.accept()
-                    client_socket.setblocking(False)
-                    all_sockets.append(client_socket)
-                    connection_made(connections, client_socket)
-                else:
-                    try:
-                        data = readable_socket.recv(MESSAGE_MAX_SIZE)
-                    except ConnectionError:
-                        data = None
-                    if data:
-                        data_received(connections, data, readable_socket)
-                    else:
-                        terminate_connection(connections, readable_socket)
-                        all_sockets.remove(readable_socket)
-                        readable_socket.close()
-
-            for writable_socket in writable_sockets:
-                process_ready_to_send(connections, writable_socket)
-
-            for error_socket in error_sockets:
-                terminate_connection(connections, error_socket)
-                all_sockets.remove(error_socket)
-                error_socket.close()
 
-    except KeyboardInterrupt:
-        pass
+def copy_again(handoff: Handoff) -> bool:
+    # Whether the clients changed during the last round are copied again:
+    # too many for the message sent once this server stopped, but fewer than
+    # copied, or another round would end the same way
+    return (
+        HANDOFF_BATCH < len(handoff.dirty) < len(handoff.clients)
+        and handoff.rounds < HANDOFF_ROUNDS
+    )
 
-    server_socket.close()
 
+def copy_done(handoff: Handoff) -> bool:
+    return (
+        handoff.copied >= len(handoff.clients)
+        and history.last_seq - handoff.history_seq <= HANDOFF_BATCH
+        and not copy_again(handoff)
+    )
+
+
+def history_entries(
+    handoff: Handoff, count: int | None, writer: StateWriter
+) -> list[list]:
+    # The next entries, the oldest ones may have been dropped meanwhile
+    first = max(handoff.history_seq + 1, history.first_seq) - history.first_seq
+    stop = None if count is None else first + count
+    entries = [
+        [
+            entry.seq,
+            entry.room,
+            export_frames(entry.frames, writer),
+            export_message(entry.binary, writer),
+        ]
+        for entry in islice(history.entries, first, stop)
+    ]
+    if entries:
+        handoff.history_seq = entries[-1][0]
+    return entries
+
+
+def export_frames(frames: Frames, writer: StateWriter) -> list[int]:
+    return [writer.blob(frame) for frame in frames]
 
-_readline_cached_line = ""
 
+def adopt_frames(indexes: list[int], reader: StateReader) -> Frames:
+    return tuple(map(reader.blob, indexes))
 
-def readline(echo: bool = True):
-    global _readline_cached_line
 
-    if msvcrt.kbhit():
-        key_pressed = msvcrt.getch()
-        if key_pressed in b"\x00\xe0":
-            key_pressed += msvcrt.getch()
-        elif key_pressed == b"\x03":
-            raise KeyboardInterrupt
-        elif key_pressed == b"\r":
-            line = _readline_cached_line + "\n"
-            _readline_cached_line = ""
-            print(flush=True)
-            return line
-        elif key_pressed == b"\x08":
-            _readline_cached_line = _readline_cached_line[:-1]
-            if echo:
-                print("\b \b", end="", flush=True)
+def export_message(binary: BinaryMessage | None, writer: StateWriter) -> list | None:
+    if binary is None:
+        return None
+    return [
+        binary.sender,
+        defined_name(binary.sender_definition),
+        binary.room,
+        defined_name(binary.room_definition),
+        export_frames(binary.frames, writer),
+    ]
+
+
+def adopt_message(state: list | None, reader: StateReader) -> BinaryMessage | None:
+    if state is None:
+        return None
+    sender, sender_name, room, room_name, frames = state
+    return BinaryMessage(
+        sender,
+        room,
+        adopt_frames(frames, reader),
+        binary_codec.names.define(sender, sender_name),
+        binary_codec.rooms.define(room, room_name),
+    )
+
+
+def send_clients(
+    handoff: Handoff,
+    added: list[ClientInfo],
+    updated: Iterable[ClientInfo] = (),
+    closed: Iterable[ClientInfo] = (),
+    final: list | None = None,
+):
+    # A message of the handoff: the sockets and the state of new clients, the
+    # state of those which changed, the ids of those gone, the next history
+    # entries, and last `final`
+    ids = handoff.ids
+    for client_info in added:
+        ids[client_info] = len(ids)
+    writer = StateWriter()
+    state = writer.encode(
+        [
+            [
+                [ids[client_info], export_client(client_info, writer)]
+                for client_info in added
+            ],
+            [
+                [ids[client_info], export_client(client_info, writer)]
+                for client_info in updated
+            ],
+            [ids[client_info] for client_info in closed],
+            history_entries(handoff, None if final else HANDOFF_BATCH, writer),
+            final,
+        ]
+    )
+    fds = [client_info.socket.fileno() for client_info in added]
+    send_handoff(handoff.successor, fds, state)
+
+
+def copy_clients(handoff: Handoff, connections: ConnectionDict) -> bool:
+    # The next batch once the previous message was acknowledged, False if the
+    # new server is gone
+    if handoff.copied >= len(handoff.clients) and copy_again(handoff):
+        handoff.clients = list(handoff.dirty)
+        handoff.copied = 0
+        handoff.rounds += 1
+    start = handoff.copied
+    handoff.copied += HANDOFF_BATCH
+    batch = [
+        client_info
+        for client_info in handoff.clients[start : handoff.copied]
+        if client_info.socket in connections
+    ]
+    for client_info in batch:
+        handoff.dirty.pop(client_info, None)
+    added = [client_info for client_info in batch if client_info not in handoff.ids]
+    updated = [client_info for client_info in batch if client_info in handoff.ids]
+    try:
+        receive_ack(handoff.successor)
+        send_clients(handoff, added, updated)
+    except OSError as error:
+        log.error("Passation impossible: %s", error)
+        return False
+    return True
+
+
+def finish_handoff(handoff: Handoff, connections: ConnectionDict) -> bool:
+    """Sends what changed during the copy and the ids and buckets of the rooms.
+
+    Called once this server stopped serving, which it no longer does if the
+    new server acknowledges, True then. Closing the connection to the new
+    server lets it go on.
+    """
+    start = time.monotonic()
+    added, updated, closed = [], [], []
+    for client_info in handoff.dirty:
+        if client_info.socket not in connections:
+            if client_info in handoff.ids:
+                closed.append(client_info)
+        elif client_info in handoff.ids:
+            updated.append(client_info)
+        else:
+            added.append(client_info)
+    rate_rooms = {
+        room: [export_bucket(messages), export_bucket(size)]
+        for room, (messages, size) in (limiter.rooms if limiter else {}).items()
+    }
+    try:
+        receive_ack(handoff.successor)
+        send_clients(
+            handoff,
+            added,
+            updated,
+            closed,
+            [
+                start,
+                history.epoch,
+                [binary_codec.names.ids, binary_codec.names.free],
+                [binary_codec.rooms.ids, binary_codec.rooms.free],
+                rate_rooms,
+            ],
+        )
+        receive_ack(handoff.successor)
+    except OSError as error:
+        log.error("Passation impossible: %s", error)
+        return False
+    log.info(
+        "%d connexions passées au nouveau serveur en %.1f ms, %d tours de copie, "
+        "%d changées ensuite",
+        len(connections),
+        (time.monotonic() - handoff.start) * 1000,
+        handoff.rounds,
+        len(handoff.dirty),
+    )
+    return True
+
+
+def take_over_listeners(
+    predecessor: socket.socket,
+) -> tuple[socket.socket, list[socket.socket]]:
+    # The handoff socket and the listening sockets of the old server
+    fds, _ = receive_handoff(predecessor)
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    for sock in sockets:
+        sock.setblocking(False)
+    predecessor.sendall(ACK)
+    return sockets[0], sockets[1:]
+
+
+def take_over_clients(
+    predecessor: socket.socket,
+    connections: ConnectionDict,
+    selector: selectors.BaseSelector,
+) -> float:
+    # Adopts the clients and the history batch by batch until the old server
+    # stopped, then its binary ids and room buckets; returns when it stopped
+    clients: dict[int, ClientInfo] = {}
+    final = None
+    while not final:
+        fds, data = receive_handoff(predecessor)
+        reader = StateReader(data)
+        added, updated, closed, entries, final = reader.document
+        # Nicknames of the clients gone are free for the others
+        for client_id in closed:
+            discard_client(connections, selector, clients.pop(client_id))
+        for client_id, state in updated:
+            update_client(connections, clients[client_id], state, reader)
+        for fd, (client_id, state) in zip(fds, added):
+            client_socket = socket.socket(state[0], socket.SOCK_STREAM, 0, fd)
+            client_socket.setblocking(False)
+            clients[client_id] = adopt_client(
+                connections, selector, client_socket, state, reader
+            )
+        for seq, room, frames, binary in entries:
+            # The same sequence numbers: the resume tokens stay valid
+            history.last_seq = seq - 1
+            history.append(
+                room, adopt_frames(frames, reader), adopt_message(binary, reader)
+            )
+        if not final:
+            predecessor.sendall(ACK)
+    start, history.epoch, names, rooms, rate_rooms = final
+    binary_codec.names.restore(*names)
+    binary_codec.rooms.restore(*rooms)
+    if limiter:
+        limiter.rooms = {
+            room: (adopt_bucket(messages), adopt_bucket(size))
+            for room, (messages, size) in rate_rooms.items()
+        }
+    return start
+
+
+def server_main(
+    endpoints: list[Endpoint],
+    metrics_port: int | None = None,
+    store_config: StoreConfig | None = None,
+    timeout_config: TimeoutConfig | None = None,
+    rate_config: RateLimitConfig | None = None,
+    handoff_path: str | None = None,
+):
+    global store, timers, limiter, handoff
+    # A server already running on handoff_path hands everything over
+    try:
+        predecessor = connect_handoff(handoff_path) if handoff_path else None
+    except PermissionError as error:
+        log.error("Passation impossible: %s", error)
+        return
+    handoff_listener = None
+    try:
+        if predecessor:
+            handoff_listener, listeners = take_over_listeners(predecessor)
+            # Removed on exit by this process from now on
+            endpoints = [
+                Endpoint(path=listener.getsockname())
+                for listener in listeners
+                if listener.family == socket.AF_UNIX
+            ]
         else:
-            decoded_char = key_pressed.decode("cp850", errors="ignore")
-            _readline_cached_line += decoded_char
-            print(decoded_char, end="", flush=True)
-    return _readline_cached_line
+            # Every listener, TCP or Unix, feeds the same registry
+            listeners = open_listeners(endpoints)
+            if handoff_path:
+                handoff_listener = listen_handoff(handoff_path)
+    except OSError as error:
+        if predecessor:
+            # The old server goes on
+            log.error("Passation impossible: %s", error)
+        else:
+            addresses = ", ".join(map(str, endpoints))
+            log.error("Impossible d'écouter sur %s: %s", addresses, error)
+        return
+    if handoff_path:
+        endpoints = [*endpoints, Endpoint(path=handoff_path)]
+    log.info("Serveur en écoute %s", ", ".join(map(listener_name, listeners)))
+
+    # DefaultSelector is epoll on Linux, kqueue on BSD/macOS: no FD_SETSIZE
+    # limit and the cost of a wait does not depend on the number of idle sockets.
+    selector = selectors.DefaultSelector()
+    for listener in listeners:
+        selector.register(listener, selectors.EVENT_READ)
+    if handoff_listener:
+        selector.register(handoff_listener, selectors.EVENT_READ)
+    connections: ConnectionDict = Registry()
+    binary_codec.names.in_use = connections.by_name
+    binary_codec.rooms.in_use = connections.rooms
+    # The timers fire between two select(), which wakes up for them
+    timer_wheel = TimerWheel()
+    timers = ConnectionTimers(
+        timer_wheel,
+        timeout_config or TimeoutConfig(),
+        lambda client_info: queue_frame(
+            client_info, BINARY_PING if client_info.binary else PING_FRAME
+        ),
+        lambda client_info: close_connection(
+            connections, client_info.socket, selector
+        ),
+    )
+    limiter = RateLimiter(rate_config)
+    takeover_start = None
+    if predecessor:
+        try:
+            takeover_start = take_over_clients(predecessor, connections, selector)
+            predecessor.sendall(ACK)
+        except (OSError, ValueError) as error:
+            # Nothing was acknowledged, the old server goes on
+            log.error("Passation impossible: %s", error)
+            return
+        clients_gauge.set(len(connections))
+        # The old server closes its message log and its metrics port, then
+        # hangs up: both can be opened here
+        try:
+            predecessor.recv(1)
+        except OSError as error:
+            log.warning("Fin de l'ancien serveur non confirmée: %s", error)
+        predecessor.close()
+    metrics_server = None
+    loop_calls = None
+    if metrics_port is not None:
+        # Scrapes ask this loop to render the metrics
+        loop_calls = LoopCalls()
+        selector.register(loop_calls.reader, selectors.EVENT_READ)
+        metrics_server = serve_metrics(
+            metrics, "127.0.0.1", metrics_port, loop_calls.call_soon_threadsafe
+        )
+        log.info("Métriques sur http://127.0.0.1:%d/metrics", metrics_port)
+    if store_config:
+        store = MessageStore(store_config)
+        store.start()
+        log.info("Journal des messages dans %s", store_config.directory)
+    if takeover_start is not None:
+        log.info(
+            "Reprise de %d connexions après une pause de %.1f ms",
+            len(connections),
+            (time.monotonic() - takeover_start) * 1000,
+        )
+
+    handed_off = False
+    try:
+        while not handed_off:
+            start = time.perf_counter()
+            ready = selector.select(timer_wheel.timeout(SELECT_TIMEOUT))
+            select_end = time.perf_counter()
+            select_seconds.inc(select_end - start)
+            requested = pop_ready(ready, handoff_listener)
+            if loop_calls and pop_ready(ready, loop_calls.reader):
+                loop_calls.run()
+            acknowledged = handoff and pop_ready(ready, handoff.successor)
+            if handoff:
+                for key, _ in ready:
+                    client_info = connections.get(key.fileobj)
+                    if client_info:
+                        handoff.dirty[client_info] = None
+            process_events(connections, ready, selector, listeners)
+            timer_wheel.advance()
+            if acknowledged:
+                assert handoff
+                if not copy_done(handoff):
+                    going_on = copy_clients(handoff, connections)
+                else:
+                    going_on = handed_off = finish_handoff(handoff, connections)
+                if not going_on:
+                    # This server goes on alone
+                    selector.unregister(handoff.successor)
+                    handoff.successor.close()
+                    handoff = None
+            elif requested and not handoff:
+                assert handoff_listener
+                handoff = start_handoff(
+                    connections, selector, listeners, handoff_listener
+                )
+            loop_seconds.record(time.perf_counter() - select_end)
+
+    except KeyboardInterrupt:
+        pass
+
+    if metrics_server:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    if loop_calls:
+        loop_calls.close()
+    if store:
+        store.close()
+    if handoff:
+        # Once it acknowledged, the new server goes on with the same sockets:
+        # closing them here only drops the descriptors of this process
+        handoff.successor.close()
+
+    for client_socket in list(connections):
+        client_socket.close()
+    selector.close()
+    for listener in listeners:
+        listener.close()
+    if handoff_listener:
+        handoff_listener.close()
+    if not handed_off:
+        remove_socket_files(endpoints)
 
 
 def client_main(host: str, port: int):
     prompt = "# "
     try:
-        addresses = socket.getaddrinfo(host, port, family=socket.AF_INET)
-        if not addresses:
-            print(f"Impossible de résoudre l'adresse {host}:{port}")
-            return
-        server_address = addresses[0][-1]
-        with socket.socket() as client:
+        if host.startswith(UNIX_PREFIX):
+            family, server_address = socket.AF_UNIX, host[len(UNIX_PREFIX) :]
+            server_name = host
+        else:
+            addresses = socket.getaddrinfo(host or None, port, type=socket.SOCK_STREAM)
+            if not addresses:
+                print(f"Impossible de résoudre l'adresse {host}:{port}")
+                return
+            family, server_address = addresses[0][0], addresses[0][-1]
+            server_name = address_to_str(server_address)
+        with socket.socket(family) as client, TerminalInput() as terminal:
             client.connect(server_address)
-            print(f"Connecté à {address_to_str(server_address)}")
-            client.settimeout(0.001)
-            message = ""
-            print(f"\33[2K\r{prompt}", end="", flush=True)
+            print(f"Connecté à {server_name}")
+            # Sleeps until the server or the keyboard has something, except on
+            # Windows where the keyboard is polled every terminal.poll_interval
+            selector = selectors.DefaultSelector()
+            selector.register(client, selectors.EVENT_READ)
+            if terminal.fileno() is not None:
+                selector.register(terminal.fileno(), selectors.EVENT_READ)
+            renderer = Renderer(
+                prompt, terminal.editor, on_ping=lambda: client.sendall(PONG_FRAME)
+            )
+            renderer.show_prompt()
             has_said_bye = False
             while not has_said_bye:
-                message = readline()
-                if message.endswith("\n"):
-                    has_said_bye = message.lower() == "bye\n"
-                    client.send(message.encode())
-                    print(prompt, end="", flush=True)
-                    message = ""
-                try:
-                    data = client.recv(MESSAGE_MAX_SIZE)
-                    if data:
-                        received_message = data.decode()
-                        print(
-                            f"\33[2K\r{received_message}{prompt}{message}",
-                            end="",
-                            flush=True,
-                        )
-                except socket.timeout:
-                    pass
-    except KeyboardInterrupt:
+                timeout = renderer.timeout(terminal.poll_interval)
+                ready = {key.fd for key, _ in selector.select(timeout)}
+                if terminal.fileno() is None or terminal.fileno() in ready:
+                    for message in terminal.read_lines():
+                        has_said_bye = message.lower() == "bye\n"
+                        client.sendall(message.encode())
+                        renderer.show_prompt()
+                if client.fileno() in ready:
+                    # A burst is read in large chunks and shown once per frame
+                    data = client.recv(CLIENT_RECEIVE_SIZE)
+                    if not data:
+                        renderer.render()
+                        print("\33[2K\rConnexion terminée")
+                        break
+                    renderer.add(data)
+                renderer.render_if_due()
+            selector.close()
+    except (KeyboardInterrupt, EOFError):
         pass
     except ConnectionError as error:
         print("\n" + error.strerror)
@@ -315,6 +1489,14 @@ if __name__ == "__main__":
     start_server = False
     host = ""
     port = SERVER_PORT
+    listen: list[str] = []
+    handoff_path = None
+    log_config = LogConfig()
+    metrics_port = None
+    store_config = None
+    store_fsync = "1"
+    timeout_config = TimeoutConfig()
+    rate_config = RateLimitConfig()
 
     i = 1
     while i < len(sys.argv):
@@ -333,12 +1515,120 @@ if __name__ == "__main__":
                 print("Port du serveur manquant.", file=sys.stderr)
                 exit(1)
             port = int(sys.argv[i])
+        elif argument == "--listen":
+            i += 1
+            if i == len(sys.argv):
+                print("Adresse d'écoute manquante.", file=sys.stderr)
+                exit(1)
+            listen.append(sys.argv[i])
+        elif argument == "--handoff":
+            i += 1
+            if i == len(sys.argv):
+                print("Chemin du socket de passation manquant.", file=sys.stderr)
+                exit(1)
+            handoff_path = sys.argv[i]
+        elif argument == "--metrics":
+            i += 1
+            if i == len(sys.argv):
+                print("Port des métriques manquant.", file=sys.stderr)
+                exit(1)
+            metrics_port = int(sys.argv[i])
+        elif argument == "--history-size":
+            i += 1
+            if i == len(sys.argv):
+                print("Taille de l'historique manquante.", file=sys.stderr)
+                exit(1)
+            history.max_bytes = int(sys.argv[i])
+        elif argument == "--store":
+            i += 1
+            if i == len(sys.argv):
+                print("Répertoire du journal manquant.", file=sys.stderr)
+                exit(1)
+            store_config = StoreConfig(sys.argv[i])
+        elif argument == "--store-fsync":
+            i += 1
+            if i == len(sys.argv):
+                print("Politique de fsync manquante.", file=sys.stderr)
+                exit(1)
+            store_fsync = sys.argv[i]
+        elif argument in ("--ping-interval", "--idle-timeout", "--login-timeout"):
+            i += 1
+            if i == len(sys.argv):
+                print(f"Durée manquante pour {argument}.", file=sys.stderr)
+                exit(1)
+            if argument == "--ping-interval":
+                timeout_config.ping_interval = float(sys.argv[i])
+            elif argument == "--idle-timeout":
+                timeout_config.idle_timeout = float(sys.argv[i])
+            else:
+                timeout_config.login_timeout = float(sys.argv[i])
+        elif argument in ("--rate-limit", "--room-rate-limit"):
+            i += 1
+            if i == len(sys.argv):
+                print("Limite de débit manquante.", file=sys.stderr)
+                exit(1)
+            try:
+                messages_rate, bytes_rate = parse_rate(sys.argv[i])
+            except ValueError:
+                print(f"Limite de débit invalide: {sys.argv[i]}", file=sys.stderr)
+                exit(1)
+            if argument == "--rate-limit":
+                rate_config.client_messages = messages_rate
+                if bytes_rate is not None:
+                    rate_config.client_bytes = bytes_rate
+            else:
+                rate_config.room_messages = messages_rate
+                if bytes_rate is not None:
+                    rate_config.room_bytes = bytes_rate
+        elif argument in ("--flood-mute", "--flood-disconnect"):
+            i += 1
+            if i == len(sys.argv):
+                print(f"Nombre manquant pour {argument}.", file=sys.stderr)
+                exit(1)
+            if argument == "--flood-mute":
+                rate_config.mute_after = int(sys.argv[i])
+            else:
+                rate_config.disconnect_after = int(sys.argv[i])
+        elif argument in ("--log-level", "--log-file", "--log-payloads"):
+            i += 1
+            if i == len(sys.argv):
+                print(f"Valeur manquante pour {argument}.", file=sys.stderr)
+                exit(1)
+            if argument == "--log-level":
+                log_config.level = sys.argv[i]
+            elif argument == "--log-file":
+                log_config.filename = sys.argv[i]
+            else:
+                log_config.payload_every = int(sys.argv[i])
         else:
             print(f"Option invalide: {argument}", file=sys.stderr)
             exit(1)
         i += 1
 
+    if store_config:
+        try:
+            store_config.fsync_interval = parse_fsync(store_fsync)
+        except ValueError:
+            print(f"Politique de fsync invalide: {store_fsync}", file=sys.stderr)
+            exit(1)
+
+    # Without --listen, -h and -p
+    try:
+        endpoints = [parse_endpoint(value, port) for value in listen]
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        exit(1)
+    endpoints = endpoints or [Endpoint(host, port)]
+
     if start_server:
-        server_main(host, port)
+        with start_logging(log_config):
+            server_main(
+                endpoints,
+                metrics_port,
+                store_config,
+                timeout_config,
+                rate_config,
+                handoff_path,
+            )
     else:
         client_main(host, port)
@@ -1,15 +1,114 @@
 import asyncio
+from dataclasses import dataclass, field, replace
 import functools
-import msvcrt
+import socket
 import sys
-from typing import Any, Coroutine, Iterable, MutableSet
+import time
+from typing import Any, Callable, Coroutine, Iterable, MutableSet
+
+from tchat.binary import (
+    ACCEPTED,
+    BINARY_PING,
+    CLIENT_FRAMES,
+    COMMAND,
+    PONG,
+    TEXT,
+    BinaryCodec,
+    BinaryDecoder,
+    BinaryMessage,
+    encode_frame,
+    read_frame,
+)
+from tchat.bus import LocalBus, WorkerBus, fork_workers, run_hub, stop_workers
+import tchat.client
+from tchat.compress import DEFAULT_LEVEL, Compression, accepted, parse_level
+from tchat.fanout import encode_message, fan_out
+from tchat.framing import FrameDecoder, FrameError, LineDecoder
+from tchat.history import (
+    HISTORY_MAX_BYTES,
+    HISTORY_REPLAY,
+    History,
+    HistoryEntry,
+    entry_frames,
+)
+from tchat.listen import (
+    Endpoint,
+    listener_name,
+    open_listeners,
+    parse_endpoint,
+    remove_socket_files,
+)
+from tchat.logs import LogConfig, log, payload_log, start_logging
+from tchat.metrics import (
+    MetricsRegistry,
+    format_histogram,
+    monitor_loop_lag,
+    serve_metrics,
+)
+from tchat.peer import (
+    QUEUE_HIGH_WATERMARK,
+    QUEUE_LOW_WATERMARK,
+    OverflowPolicy,
+    Peer,
+    QueueMetrics,
+    StreamPeer,
+    TransportPeer,
+)
+from tchat.ratelimit import RateLimitConfig, RateLimiter, Verdict, parse_rate
+from tchat.registry import Client, Registry, address_to_str
+from tchat.store import (
+    QUERY_LIMIT,
+    MessageStore,
+    QueryResult,
+    StoreConfig,
+    format_result,
+    parse_fsync,
+    parse_since,
+)
+from tchat.terminal import Renderer, TerminalInput
+from tchat.timers import PING_FRAME, ConnectionTimers, TimeoutConfig, TimerWheel
 
 
 SERVER_PORT = 3030
 MESSAGE_MAX_SIZE = 10240
+# Messages of the bus between the --workers: the frames of a message as large
+# as a client may send, with a "[salon] pseudo> " header and the room list,
+# each of them one client line at most. A larger message, the header being
+# repeated on each of its lines, is refused to its sender.
+BUS_MESSAGE_MAX_SIZE = 4 * MESSAGE_MAX_SIZE + 64
+MESSAGE_TOO_LONG = "Message trop long, il n'a pas été envoyé."
+CLIENT_RECEIVE_SIZE = 64 * 1024
+STORE_DISABLED = "Le journal des messages n'est pas activé (--store)."
+
 
+@dataclass
+class ServerConfig:
+    queue_high_watermark: int = QUEUE_HIGH_WATERMARK
+    queue_low_watermark: int = QUEUE_LOW_WATERMARK
+    overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST
+    queue_metrics: QueueMetrics = field(default_factory=QueueMetrics)
+    # asyncio.Protocol based server instead of streams and tasks
+    use_protocol: bool = False
+    # Processes sharing the listening port (SO_REUSEPORT) and the chat
+    workers: int = 1
+    log: LogConfig = field(default_factory=LogConfig)
+    # Local HTTP port of the Prometheus endpoint, one port per worker from there
+    metrics_port: int | None = None
+    # Memory limit of the message history, in bytes
+    history_size: int = HISTORY_MAX_BYTES
+    # Durable log of the room messages for /since and /search, single process
+    store: StoreConfig | None = None
+    timeouts: TimeoutConfig = field(default_factory=TimeoutConfig)
+    # Per client and per room, each worker limits its own clients and rooms
+    rate_limits: RateLimitConfig = field(default_factory=RateLimitConfig)
 
-INETAddress = tuple[str, int] | tuple[str, int, int, int]
+    def peer_options(self) -> dict[str, Any]:
+        return {
+            "high_watermark": self.queue_high_watermark,
+            "low_watermark": self.queue_low_watermark,
+            "policy": self.overflow_policy,
+            "metrics": self.queue_metrics,
+        }
 
 
 ###############################################################################
@@ -17,6 +116,202 @@ INETAddress = tuple[str, int] | tuple[str, int, int, int]
 ###############################################################################
 
 
+@dataclass(slots=True, eq=False)
+class ClientRecord(Client):
+    # Client records are keyed by their peer
+    received_messages: int = 0
+    received_bytes: int = 0
+
+    @property
+    def peer(self) -> Peer:
+        return self.key  # type: ignore [return-value]
+
+
+class ServerMetrics:
+    # Metrics of a server process, for /stats and the Prometheus endpoint
+
+    def __init__(
+        self,
+        config: ServerConfig,
+        clients: Registry[ClientRecord],
+        history: History,
+        store: MessageStore | None,
+        timers: ConnectionTimers,
+        limiter: RateLimiter,
+        binary: BinaryCodec,
+        compression: Compression,
+    ):
+        queues = config.queue_metrics
+        self.registry = registry = MetricsRegistry()
+        self.connections = registry.counter(
+            "tchat_connections_total", "Connexions acceptées"
+        )
+        self.messages_received = registry.counter(
+            "tchat_messages_received_total", "Messages reçus"
+        )
+        self.bytes_received = registry.counter(
+            "tchat_received_bytes_total", "Octets reçus"
+        )
+        registry.counter(
+            "tchat_messages_sent_total", "Messages envoyés", lambda: queues.sent_frames
+        )
+        registry.counter(
+            "tchat_sent_bytes_total", "Octets envoyés", lambda: queues.sent_bytes
+        )
+        registry.counter(
+            "tchat_dropped_messages_total",
+            "Messages perdus",
+            lambda: queues.dropped_frames,
+        )
+        registry.gauge("tchat_clients", "Clients connectés", lambda: len(clients))
+        registry.gauge(
+            "tchat_queued_bytes",
+            "Octets en attente dans les files d'envoi",
+            lambda: sum(client.peer.queued_bytes for client in clients.values()),
+        )
+        registry.gauge(
+            "tchat_history_bytes",
+            "Taille de l'historique des messages",
+            lambda: history.size,
+        )
+        registry.gauge(
+            "tchat_store_pending_messages",
+            "Messages en attente d'écriture dans le journal",
+            lambda: store.records.qsize() if store else 0,
+        )
+        registry.gauge(
+            "tchat_binary_names",
+            "Pseudos numérotés pour le protocole binaire",
+            lambda: len(binary.names),
+        )
+        registry.gauge(
+            "tchat_compression_streams",
+            "Contextes zlib des clients compressés",
+            lambda: compression.streams,
+        )
+        registry.counter(
+            "tchat_compressed_input_bytes_total",
+            "Octets à compresser",
+            lambda: compression.input_bytes,
+        )
+        registry.counter(
+            "tchat_compressed_output_bytes_total",
+            "Octets compressés envoyés",
+            lambda: compression.output_bytes,
+        )
+        registry.counter(
+            "tchat_shared_compressions_total",
+            "Trames compressées une fois pour plusieurs clients",
+            lambda: compression.shared_frames,
+        )
+        registry.gauge("tchat_timers", "Minuteries en cours", lambda: len(timers.wheel))
+        registry.counter("tchat_pings_total", "/ping envoyés", lambda: timers.pings)
+        registry.counter(
+            "tchat_timeout_disconnections_total",
+            "Clients inactifs ou sans pseudo déconnectés",
+            lambda: timers.idle_closed + timers.login_closed,
+        )
+        registry.counter(
+            "tchat_refused_messages_total",
+            "Messages refusés par la limite de débit",
+            lambda: limiter.refused_messages,
+        )
+        registry.counter(
+            "tchat_refused_bytes_total",
+            "Octets refusés par la limite de débit",
+            lambda: limiter.refused_bytes,
+        )
+        registry.counter(
+            "tchat_flood_mutes_total",
+            "Clients rendus muets pour flood",
+            lambda: limiter.mutes,
+        )
+        registry.counter(
+            "tchat_flood_disconnections_total",
+            "Clients déconnectés pour flood",
+            lambda: limiter.disconnections,
+        )
+        self.fanout = registry.histogram(
+            "tchat_fanout_seconds",
+            "Durée d'encodage et de mise en file d'une diffusion",
+        )
+        self.delivery = registry.add(queues.delivery)
+        self.loop_lag = registry.histogram(
+            "tchat_loop_lag_seconds", "Retard de la boucle asyncio"
+        )
+
+
+@dataclass
+class Chat:
+    # State shared by every connection of a server process
+    config: ServerConfig
+    bus: LocalBus
+    clients: Registry[ClientRecord] = field(default_factory=Registry)
+    metrics: ServerMetrics = field(init=False)
+    history: History = field(init=False)
+    store: MessageStore | None = field(init=False)
+    # Driven by server_main with `timers.wheel.run()`
+    timers: ConnectionTimers[ClientRecord] = field(init=False)
+    limiter: RateLimiter = field(init=False)
+    # Frames and interned ids of the clients that switched to /binary, for
+    # the nicknames and rooms in use
+    binary: BinaryCodec = field(init=False)
+    # zlib contexts of the clients that asked for /compress
+    compression: Compression = field(default_factory=Compression)
+
+    def __post_init__(self):
+        self.binary = BinaryCodec(self.clients.by_name, self.clients.rooms)
+        self.history = History(self.config.history_size)
+        self.store = MessageStore(self.config.store) if self.config.store else None
+        self.timers = ConnectionTimers(
+            TimerWheel(),
+            self.config.timeouts,
+            lambda client: client.peer.push(
+                BINARY_PING if client.binary else PING_FRAME
+            ),
+            lambda client: client.peer.close(),
+        )
+        # On the time of the loop, virtual in bench.simulate
+        self.limiter = RateLimiter(
+            self.config.rate_limits, asyncio.get_running_loop().time
+        )
+        self.metrics = ServerMetrics(
+            self.config,
+            self.clients,
+            self.history,
+            self.store,
+            self.timers,
+            self.limiter,
+            self.binary,
+            self.compression,
+        )
+
+    def connect(self, peer: Peer) -> ClientRecord:
+        client = self.clients.add(ClientRecord(peer, address_to_str(peer.peername)))
+        self.metrics.connections.inc()
+        self.timers.connected(client)
+        log.info("Connection de %s", client.address)
+        send_message("Bienvenu sur le tchat !", client)
+        replay_history(client, self.history.recent(self.clients.rooms.default_room))
+        return client
+
+    def disconnect(self, client: ClientRecord):
+        self.timers.disconnected(client)
+        self.clients.remove(client.key)
+        self.bus.release_name(client.name)
+        peer = client.peer
+        if peer.compression:
+            peer.compression.close()
+        log.info(
+            "Déconnexion de %s: %d messages envoyés, %d perdus, "
+            "file d'attente max %d octets",
+            client.address,
+            peer.sent_frames,
+            peer.dropped_frames,
+            peer.max_queued_bytes,
+        )
+
+
 def create_background_task(coro: Coroutine[Any, Any, Any], bg_tasks: MutableSet[asyncio.Task[Any]]):
     task = asyncio.create_task(coro)
     bg_tasks.add(task)
@@ -28,184 +323,667 @@ async def handle_client_connection(
     reader: asyncio.StreamReader,
     writer: asyncio.StreamWriter,
     *,
-    lock: asyncio.Lock,
-    connections: dict[INETAddress, asyncio.StreamWriter],
+    chat: Chat,
 ):
     background_tasks: set[asyncio.Task[Any]] = set()
-    addr = writer.get_extra_info("peername")
-    async with lock:
-        connections[addr] = writer
-    print(f"Connection de {addr}")
+    peer = StreamPeer(writer, **chat.config.peer_options())
+    peer.start()
+    client = chat.connect(peer)
 
-    client_data = {
-        "addr": addr,
-        "connections": connections,
-        "lock": lock,
-    }
+    async def read_message() -> tuple[bytes, int | None] | None:
+        # A line, or a frame and its type once the client switched with
+        # /binary; None at the end of the stream
+        if client.binary is None:
+            line = await reader.readline()
+            return (line, None) if line else None
+        try:
+            header, payload = await read_frame(reader, MESSAGE_MAX_SIZE)
+        except (asyncio.IncompleteReadError, FrameError):
+            return None
+        return payload, header[0]
 
     try:
-        read_message_task = create_background_task(reader.readline(), background_tasks)
-
-        message = "Bienvenu sur le tchat !"
-        create_background_task(send_message(message, writer), background_tasks)
+        read_message_task = create_background_task(read_message(), background_tasks)
 
         while background_tasks:
             await asyncio.wait(background_tasks, return_when=asyncio.FIRST_COMPLETED)
             if read_message_task.done():
-                message = await read_message_task
-                if message:
-                    create_background_task(
-                        receive_data(message, client_data), background_tasks
-                    )
+                received = await read_message_task
+                if received:
+                    receive_data(*received, client, chat)
                     read_message_task = create_background_task(
-                        reader.readline(), background_tasks
+                        read_message(), background_tasks
                     )
                 else:
                     break
 
     finally:
-        async with lock:
-            del connections[addr]
+        await peer.stop()
+        chat.disconnect(client)
         writer.close()
         await writer.wait_closed()
-        print(f"Déconnexion de {addr}")
 
 
-async def send_data(data: bytes, writer: asyncio.StreamWriter):
-    peername = writer.get_extra_info("peername")
-    print(f"Envoi {data!r} à {peername}")
-    writer.write(data)
-    await writer.drain()
+def send_message(message: str, client: ClientRecord, header: str = ""):
+    fan_out(encode_message(message, header), [client], push_text)
+
+
+def push_to_client(client: ClientRecord, frame: bytes):
+    client.peer.push(frame)
+
+
+def push_text(client: ClientRecord, frame: bytes):
+    # Text frames reach binary clients behind a TEXT header
+    if client.binary:
+        frame = encode_frame(TEXT, frame)
+    client.peer.push(frame)
+
+
+def broadcast_message(
+    message: str,
+    chat: Chat,
+    rooms: list[str],
+    header: str = "",
+    exclude: ClientRecord | None = None,
+):
+    # Frames are built once and queued to the members of the rooms without
+    # waiting for any of them: a slow client only fills its own queue.
+    start = time.perf_counter()
+    frames = encode_message(message, header)
+    room_index = chat.clients.rooms
+    if len(rooms) == 1:
+        count = room_index.fan_out(rooms[0], frames, push_to_client, exclude)
+    else:
+        audience = room_index.members_of(rooms)
+        audience.pop(exclude, None)  # type: ignore [arg-type]
+        count = fan_out(frames, audience, push_text)
+    # Members of the other workers
+    data = b"".join(frames)
+    chat.bus.publish(rooms, data)
+    chat.metrics.fanout.record(time.perf_counter() - start)
+    payload_log.debug("Diffusion %r à %d clients", data, count)
+
+
+def broadcast_chat_message(message: str, chat: Chat, room: str, sender: ClientRecord):
+    # Like broadcast_message, and the frames are kept in the history
+    start = time.perf_counter()
+    header = f"{chat.clients.rooms.sender_label(room, sender.label)}> "
+    frames = encode_message(message, header)
+    data = b"".join(frames)
+    if not chat.bus.fits([room], data):
+        send_message(MESSAGE_TOO_LONG, sender)
+        return
+    history = chat.history
+    entry = history.append(room, frames)
+
+    def encode_binary() -> BinaryMessage | None:
+        # Once there is a binary member, only nicknames are interned
+        if sender.name is None:
+            return None
+        binary = chat.binary.message(entry.seq, sender.name, room, message)
+        history.set_binary(entry, binary)
+        return binary
+
+    count = chat.clients.rooms.fan_out(
+        room, frames, push_to_client, sender, entry.sequenced_frames, encode_binary
+    )
+    chat.bus.publish_message(room, data)
+    if chat.store:
+        chat.store.append(room, sender.label, message.rstrip("\n"))
+    chat.metrics.fanout.record(time.perf_counter() - start)
+    payload_log.debug("Diffusion %r à %d clients", data, count)
 
 
-async def send_message(message: str, writer: asyncio.StreamWriter):
-    if not message.endswith("\n"):
-        message += "\n"
-    await send_data(message.encode(), writer)
+def replay_history(client: ClientRecord, entries: Iterable[HistoryEntry]):
+    for frame in entry_frames(entries, client.sequenced, client.binary):
+        client.peer.push(frame)
 
 
-async def broadcast_message(message: str, writers: Iterable[asyncio.StreamWriter]):
-    if not message.endswith("\n"):
-        message += "\n"
-    data = message.encode()
-    for writer in writers:
-        await send_data(data, writer)
+def deliver_from_bus(rooms: list[str], data: bytes, chat: Chat):
+    fan_out((data,), chat.clients.rooms.members_of(rooms), push_text)
 
 
-async def process_command(command: str, client_data: dict[str, Any]):
-    client_addr = client_data["addr"]
-    client_writer = client_data["connections"][client_addr]
-    others_writer = (
-        writer
-        for writer in client_data["connections"].values()
-        if writer is not client_writer
+def deliver_message_from_bus(room: str, data: bytes, chat: Chat):
+    # Each worker numbers the messages in its own history
+    frames = (data,)
+    history = chat.history
+    entry = history.append(room, frames)
+
+    def encode_binary() -> BinaryMessage:
+        binary = chat.binary.relayed(entry.seq, room, data)
+        history.set_binary(entry, binary)
+        return binary
+
+    chat.clients.rooms.fan_out(
+        room, frames, push_to_client, None, entry.sequenced_frames, encode_binary
     )
+
+
+def deliver_private_from_bus(name: str, data: bytes, chat: Chat):
+    client = chat.clients.find_name(name)
+    if client is not None:
+        push_text(client, data)
+
+
+def command_set_name(name: str, client: ClientRecord, chat: Chat):
+    def set_name(granted: bool):
+        if client.peer.closed:
+            if granted:
+                chat.bus.release_name(name)
+        elif not granted:
+            send_message(
+                f"Impossible de fixer le pseudo à {name} car il est déjà utilisé.",
+                client,
+            )
+        else:
+            chat.clients.rename(client, name)
+            chat.timers.logged_in(client)
+            send_message(f"Bienvenue {name}", client)
+            broadcast_message(
+                f"{name} est dans la place !", chat, list(client.rooms), exclude=client
+            )
+
+    # Another worker may own the nickname: the answer can come later
+    chat.bus.claim_name(name, client.name, set_name)
+
+
+def command_private_message(name: str, text: str, client: ClientRecord, chat: Chat):
+    def delivered(found: bool):
+        if not found and not client.peer.closed:
+            send_message(f"Personne ne s'appelle {name}.", client)
+
+    frames = encode_message(text, f"{client.label} (privé)> ")
+    destination = chat.clients.find_name(name)
+    if destination is not None and destination.binary and client.name is not None:
+        message = chat.binary.private(client.name, text)
+        binary_frames = destination.binary.message_frames(message)
+        fan_out(binary_frames, [destination.peer], Peer.push)
+    elif destination is not None:
+        fan_out(frames, [destination], push_text)
+    elif not chat.bus.fits([name], b"".join(frames)):
+        send_message(MESSAGE_TOO_LONG, client)
+    else:
+        # Maybe a client of another worker
+        chat.bus.send_private(name, b"".join(frames), delivered)
+
+
+def command_join_room(room: str, client: ClientRecord, chat: Chat):
+    if chat.clients.rooms.join(client, room):
+        replay_history(client, chat.history.recent(room))
+        broadcast_message(f"{client.label} a rejoint le salon {room}.", chat, [room])
+    else:
+        send_message(f"Vous parlez maintenant dans le salon {room}.", client)
+
+
+def command_leave_room(room: str | None, client: ClientRecord, chat: Chat):
+    rooms = chat.clients.rooms
+    room = room or rooms.current(client) or ""
+    if not rooms.leave(client, room):
+        send_message(f"Vous n'êtes pas dans le salon {room}.", client)
+        return
+    broadcast_message(f"{client.label} a quitté le salon {room}.", chat, [room])
+    if not client.rooms:
+        rooms.join(client, rooms.default_room)
+    send_message(
+        f"Vous avez quitté le salon {room}, vous parlez dans le salon "
+        f"{rooms.current(client)}.",
+        client,
+    )
+
+
+def command_list_rooms(client: ClientRecord, chat: Chat):
+    # Only the rooms of this process when running with --workers
+    rooms = chat.clients.rooms
+    current = rooms.current(client)
+    room_list = "".join(
+        f"{'*' if room == current else ' '} {room} ({len(rooms.members[room])})\n"
+        for room in sorted(rooms)
+    )
+    send_message("Salons:\n" + room_list, client)
+
+
+def command_history(count: int, client: ClientRecord, chat: Chat):
+    room = chat.clients.rooms.current(client) or ""
+    replay_history(client, chat.history.recent(room, count))
+
+
+def command_resume(position: str | None, client: ClientRecord, chat: Chat):
+    # Handshake of tchat.client: "/seq <position>" answers, then come the room
+    # messages missed since `position`, each one after its "/seq N" line.
+    history = chat.history
+    client.sequenced = True
+    push_text(client, f"/seq {history.position}\n".encode())
+    if position:
+        entries, complete = history.resume(position, client.rooms)
+        if not complete:
+            send_message("Historique incomplet, derniers messages:", client)
+        replay_history(client, entries)
+
+
+def command_binary(client: ClientRecord, chat: Chat):
+    # Negotiation of tchat.binary: the answer is the last text line both ways,
+    # the connection reads frames from the next message on
+    if client.binary:
+        send_message("Le protocole binaire est déjà actif.", client)
+        return
+    client.peer.push(ACCEPTED)
+    client.binary = chat.binary.session()
+    client.peer.binary = True
+
+
+def command_compress(level: str, client: ClientRecord, chat: Chat):
+    # The answer is the last frame sent uncompressed
+    if client.peer.compression:
+        send_message("La compression est déjà active.", client)
+        return
+    try:
+        compression_level = parse_level(level)
+    except ValueError:
+        send_message("Usage: /compress [niveau de 1 à 9]", client)
+        return
+    push_text(client, accepted(compression_level))
+    client.peer.compression = chat.compression.session(compression_level)
+
+
+def run_store_query(
+    query: Callable[[], QueryResult], client: ClientRecord, command: str
+):
+    # Queries read the disk: they run in a thread while the loop serves the
+    # other clients, the answer is sent from the loop once they are done. Each
+    # reads a bounded part of the index, `command` gets the next messages.
+    def send_result(done: asyncio.Future[QueryResult]):
+        if done.exception():
+            log.error("Requête sur le journal impossible: %s", done.exception())
+            send_message("Erreur de lecture du journal des messages.", client)
+            return
+        send_message(format_result(done.result(), command), client)
+
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(None, query).add_done_callback(send_result)
+
+
+def command_since(since: str, client: ClientRecord, chat: Chat):
+    if chat.store is None:
+        send_message(STORE_DISABLED, client)
+        return
+    try:
+        kind, value = parse_since(since)
+    except ValueError:
+        send_message(
+            "Usage: /since <numéro de message | durée (10m, 2h, 1j) | date ISO>",
+            client,
+        )
+        return
+    room = chat.clients.rooms.current(client)
+    if kind == "seq":
+        query = functools.partial(chat.store.since_seq, int(value), room)
+    else:
+        query = functools.partial(chat.store.since_time, value, room)
+    run_store_query(query, client, "/since")
+
+
+def command_search(
+    name: str, count: int, before: int | None, client: ClientRecord, chat: Chat
+):
+    if chat.store is None:
+        send_message(STORE_DISABLED, client)
+        return
+    limit = min(count, QUERY_LIMIT)
+    query = functools.partial(chat.store.by_author, name, limit, before)
+    run_store_query(query, client, f"/search {name} {limit}")
+
+
+def command_stats(client: ClientRecord, chat: Chat):
+    metrics = chat.metrics
+    queues = chat.config.queue_metrics
+    compression = chat.compression
+    peer = client.peer
+    send_message(
+        "Statistiques du serveur:\n"
+        f" clients: {len(chat.clients)} ({metrics.connections.value} connexions)\n"
+        f" reçus: {metrics.messages_received.value} messages "
+        f"({metrics.bytes_received.value} octets)\n"
+        f" envoyés: {queues.sent_frames} messages ({queues.sent_bytes} octets), "
+        f"{queues.dropped_frames} perdus\n"
+        f" diffusion: {format_histogram(metrics.fanout)}\n"
+        f" livraison: {format_histogram(metrics.delivery)}\n"
+        f" retard de la boucle: {format_histogram(metrics.loop_lag)}\n"
+        f" compression: {compression.input_bytes} octets envoyés en "
+        f"{compression.output_bytes}, {compression.shared_frames} trames partagées\n"
+        f" refusés (limite de débit): {chat.limiter.refused_messages} messages, "
+        f"{chat.limiter.mutes} clients rendus muets\n"
+        f" vous: {client.received_messages} messages reçus "
+        f"({client.received_bytes} octets), {peer.sent_frames} envoyés "
+        f"({peer.sent_bytes} octets), {peer.queued_bytes} octets en attente",
+        client,
+    )
+
+
+def process_command(command: str, client: ClientRecord, chat: Chat):
     command_parts = command.split()
     match command_parts:
         case ["/pseudo", name]:
-            client_data["pseudo"] = name
-            await send_message(f"Bienvenue {name}", client_writer)
-            await broadcast_message(f"{name} est dans la place !", others_writer)
+            command_set_name(name, client, chat)
+        case ["/msg", name, _, *_]:
+            text = command.split(maxsplit=2)[2]
+            command_private_message(name, text, client, chat)
+        case ["/join", room]:
+            command_join_room(room, client, chat)
+        case ["/leave"]:
+            command_leave_room(None, client, chat)
+        case ["/leave", room]:
+            command_leave_room(room, client, chat)
+        case ["/rooms"]:
+            command_list_rooms(client, chat)
+        case ["/stats"]:
+            command_stats(client, chat)
+        case ["/history"]:
+            command_history(HISTORY_REPLAY, client, chat)
+        case ["/history", count] if count.isdigit():
+            command_history(int(count), client, chat)
+        case ["/resume"]:
+            command_resume(None, client, chat)
+        case ["/resume", position]:
+            command_resume(position, client, chat)
+        case ["/binary"]:
+            command_binary(client, chat)
+        case ["/compress"]:
+            command_compress("", client, chat)
+        case ["/compress", level]:
+            command_compress(level, client, chat)
+        case ["/since", since]:
+            command_since(since, client, chat)
+        case ["/search", name]:
+            command_search(name, HISTORY_REPLAY, None, client, chat)
+        case ["/search", name, count] if count.isdigit():
+            command_search(name, int(count), None, client, chat)
+        case ["/search", name, count, before] if count.isdigit() and before.isdigit():
+            command_search(name, int(count), int(before), client, chat)
         case _:
-            await send_message(f"Erreur commande inconnue: '{command}'", client_writer)
+            send_message(f"Erreur commande inconnue: '{command}'", client)
 
 
-async def receive_data(data: bytes, client_data: dict[str, Any]):
-    client_addr = client_data["addr"]
-    connections = client_data["connections"]
-    client_writer = connections[client_addr]
-    message = data.decode()
-    print(f"Reçu {data!r} de {client_addr}")
+def receive_data(
+    data: bytes, frame_type: int | None, client: ClientRecord, chat: Chat
+):
+    # `frame_type`: None for a line of the text protocol
+    payload_log.debug("Reçu %r de %s", data, client.address)
+    client.received_messages += 1
+    client.received_bytes += len(data)
+    chat.metrics.messages_received.inc()
+    chat.metrics.bytes_received.inc(len(data))
+    chat.timers.activity(client)
+    if len(data) > MESSAGE_MAX_SIZE + 1:
+        # Only a line of the streams, newline included, goes beyond
+        send_message(MESSAGE_TOO_LONG, client)
+        return
+    # Whatever a client sends, invalid UTF-8 included, is shown as text
+    message = data.decode(errors="replace")
 
-    command = message.strip()
-    if command.startswith("/"):
-        await process_command(command, client_data)
-    elif "pseudo" not in client_data:
+    if frame_type is None:
+        command = message.strip()
+        if command == "/pong":
+            return  # answer to "/ping", already counted as activity
+        is_command = command.startswith("/")
+    elif frame_type in CLIENT_FRAMES:
+        # The frame type says what the text protocol finds in the text
+        if frame_type == PONG:
+            return
+        command = message
+        is_command = frame_type == COMMAND
+    else:
+        log.info("Déconnexion de %s: trame de type %d", client.address, frame_type)
+        client.peer.close()
+        return
+    room = None
+    if not is_command and client.name is not None:
+        room = chat.clients.rooms.current(client)
+    # Before anything is encoded or queued for the room
+    verdict = chat.limiter.check(client, len(data), room)
+    if verdict is not Verdict.ACCEPT:
+        refuse_message(verdict, client, chat, room)
+        return
+    notice = chat.limiter.dropped_notice(client)
+    if notice:
+        send_message(notice, client)
+    if is_command:
+        process_command(command, client, chat)
+    elif client.name is None:
         message = "Spécifiez votre pseudo pour envoyer un message avec la commande:\n /pseudo mon_pseudo"
-        await send_message(message, connections[client_addr])
+        send_message(message, client)
+    elif room is not None:
+        broadcast_chat_message(message, chat, room, client)
+
+
+def refuse_message(
+    verdict: Verdict, client: ClientRecord, chat: Chat, room: str | None
+):
+    if verdict is Verdict.DISCONNECT:
+        log.info("Déconnexion de %s: trop de messages", client.address)
+        client.peer.close()
+        return
+    notice = chat.limiter.notice(verdict, room)
+    if notice:
+        send_message(notice, client)
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    # Same chat as handle_client_connection, but messages are handled
+    # synchronously as they are decoded: no task nor future per message.
+
+    def __init__(self, chat: Chat):
+        self.chat = chat
+        # A BinaryDecoder after /binary
+        self.decoder: FrameDecoder = LineDecoder(max_frame_size=MESSAGE_MAX_SIZE)
+        self.peer: TransportPeer | None = None
+        self.client: ClientRecord | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        assert isinstance(transport, asyncio.WriteTransport)
+        self.peer = TransportPeer(transport, **self.chat.config.peer_options())
+        self.client = self.chat.connect(self.peer)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        assert self.client and self.peer
+        decoder = self.decoder
+        decoder.buffer_updated(nbytes)
+        try:
+            if not self.client.binary:
+                for message in decoder:
+                    receive_data(message, None, self.client, self.chat)
+                    if self.client.binary:
+                        # Answered /binary: the bytes left are frames
+                        self.decoder = decoder = BinaryDecoder.following(decoder)
+                        break
+            if isinstance(decoder, BinaryDecoder):
+                for payload in decoder:
+                    receive_data(payload, decoder.frame_type, self.client, self.chat)
+        except FrameError:
+            self.peer.close()
+
+    def pause_writing(self):
+        assert self.peer
+        self.peer.pause_writing()
+
+    def resume_writing(self):
+        assert self.peer
+        self.peer.resume_writing()
+
+    def connection_lost(self, exc: Exception | None):
+        assert self.client and self.peer
+        self.peer.closed = True
+        self.chat.disconnect(self.client)
+
+
+async def server_main(
+    endpoints: list[Endpoint],
+    config: ServerConfig | None = None,
+    bus_socket: socket.socket | None = None,
+    inherited: list[socket.socket] | None = None,
+):
+    # `inherited`: listeners opened by the parent of the workers
+    config = config or ServerConfig()
+    if bus_socket:
+        bus: LocalBus = await WorkerBus.connect(bus_socket, BUS_MESSAGE_MAX_SIZE)
     else:
-        message = f"{client_data['pseudo']}> {message}"
-        await broadcast_message(
-            message,
-            (writer for writer in connections.values() if writer is not client_writer),
+        bus = LocalBus()
+    chat = Chat(config, bus)
+    bus.on_broadcast = functools.partial(deliver_from_bus, chat=chat)
+    bus.on_message = functools.partial(deliver_message_from_bus, chat=chat)
+    bus.on_private = functools.partial(deliver_private_from_bus, chat=chat)
+    lag_task = asyncio.create_task(monitor_loop_lag(chat.metrics.loop_lag))
+    # One task fires the timers of every connection
+    timers_task = asyncio.create_task(chat.timers.wheel.run())
+    metrics_server = None
+    listeners: list[socket.socket] = []
+    if chat.store:
+        chat.store.start()
+        log.info("Journal des messages dans %s", chat.store.config.directory)
+    try:
+        if config.metrics_port is not None:
+            metrics_server = serve_metrics(
+                chat.metrics.registry,
+                "127.0.0.1",
+                config.metrics_port,
+                asyncio.get_running_loop().call_soon_threadsafe,
+            )
+            log.info("Métriques sur http://127.0.0.1:%d/metrics", config.metrics_port)
+        # Workers all listen on the same TCP ports, the kernel spreads the
+        # connections; they share the Unix sockets of their parent
+        if inherited is None:
+            listeners = open_listeners(endpoints)
+        else:
+            tcp_endpoints = [endpoint for endpoint in endpoints if not endpoint.path]
+            listeners = open_listeners(tcp_endpoints, reuse_port=True) + inherited
+        # One server per listener, all of them feeding the same chat
+        loop = asyncio.get_running_loop()
+        servers = []
+        for listener in listeners:
+            if config.use_protocol:
+                server = await loop.create_server(
+                    lambda: ChatProtocol(chat), sock=listener
+                )
+            else:
+                client_connected_cb = functools.partial(
+                    handle_client_connection, chat=chat
+                )
+                server = await asyncio.start_server(client_connected_cb, sock=listener)
+            servers.append(server)
+        addrs = ", ".join(map(listener_name, listeners))
+        log.info("Serveur en écoute %s", addrs)
+
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+    except OSError as err:
+        log.error("%s", err)
+    finally:
+        metrics = config.queue_metrics
+        log.info(
+            "Files d'envoi: %d messages perdus (%d octets), %d débordements, "
+            "%d clients lents déconnectés, max %d octets",
+            metrics.dropped_frames,
+            metrics.dropped_bytes,
+            metrics.overflows,
+            metrics.disconnections,
+            metrics.max_queued_bytes,
         )
+        lag_task.cancel()
+        timers_task.cancel()
+        if metrics_server:
+            metrics_server.shutdown()
+        if chat.store:
+            chat.store.close()
+        if listeners and inherited is None:
+            remove_socket_files(endpoints)
+        await bus.close()
 
 
-async def server_main(host: str, port: int | str):
-    connections = {}
-    lock = asyncio.Lock()
-    client_connected_cb = functools.partial(
-        handle_client_connection, lock=lock, connections=connections
-    )
+def workers_main(endpoints: list[Endpoint], config: ServerConfig):
+    # The parent process only runs the bus between the workers. Unix sockets
+    # have no SO_REUSEPORT: opened here, the workers accept on the same ones
     try:
-        server = await asyncio.start_server(client_connected_cb, host, port)
-        addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
-        print(f"Serveur en écoute {addrs}")
+        unix_listeners = open_listeners(
+            endpoint for endpoint in endpoints if endpoint.path
+        )
+    except OSError as error:
+        print(error, file=sys.stderr)
+        return
 
-        async with server:
-            await server.serve_forever()
-    except OSError as err:
-        print(err)
+    def worker_main(index: int, bus_socket: socket.socket):
+        worker_config = config
+        if config.metrics_port is not None:
+            worker_config = replace(config, metrics_port=config.metrics_port + index)
+        # Each process has its own log writer thread, threads do not survive fork()
+        with start_logging(config.log):
+            try:
+                asyncio.run(
+                    server_main(endpoints, worker_config, bus_socket, unix_listeners)
+                )
+            except KeyboardInterrupt:
+                pass
+
+    workers = fork_workers(config.workers, worker_main)
+    for listener in unix_listeners:
+        listener.close()
+    with start_logging(config.log):
+        log.info("%d processus serveur démarrés", len(workers))
+        try:
+            asyncio.run(
+                run_hub(
+                    [bus_socket for _, bus_socket in workers], BUS_MESSAGE_MAX_SIZE
+                )
+            )
+        finally:
+            stop_workers(workers)
+            remove_socket_files(endpoints)
 
 
 ###############################################################################
 ## Client                                                                    ##
 ###############################################################################
 
-current_input_line = bytearray()
-
-
-async def readline(echo: bool = True) -> str:
-    global current_input_line
-    current_input_line.clear()
-    end_of_line = False
-
-    while not end_of_line:
-        while msvcrt.kbhit():
-            key_pressed = msvcrt.getch()
-            if key_pressed in b"\x00\xe0":
-                key_pressed += msvcrt.getch()
-            elif key_pressed == b"\x03":
-                raise KeyboardInterrupt
-            elif key_pressed == b"\r":
-                current_input_line += b"\n"
-                msvcrt.putch(b"\n")
-                end_of_line = True
-                break
-            elif key_pressed == b"\x08":
-                if len(current_input_line) > 0:
-                    current_input_line = current_input_line[:-1]
-                    if echo:
-                        # print("\b \b", end="", flush=True)
-                        msvcrt.putch(b"\b")
-                        msvcrt.putch(b" ")
-                        msvcrt.putch(b"\b")
-            else:
-                current_input_line += key_pressed
-                msvcrt.putch(key_pressed)
-        else:
-            await asyncio.sleep(0.03)
-    return get_input_line()
-
+async def client_main(
+    host: str, port: int | str, binary: bool = False, compress: bool = False
+):
+    # The networking, reconnections included, is done by tchat.client: only
+    # the keyboard and the screen are handled here
+    prompt = "# "
+    with TerminalInput() as terminal:
+        loop = asyncio.get_running_loop()
+        renderer = Renderer(prompt, terminal.editor, loop=loop)
+        client = tchat.client.ChatClient(
+            host,
+            port,
+            on_status=lambda status: renderer.add_text(f"{status}\n"),
+            binary=binary,
+            compress=DEFAULT_LEVEL if compress else None,
+        )
+        await client.start()
+        renderer.render()
+        try:
+            await run_client(client, terminal, renderer)
+        except EOFError:
+            pass
+        finally:
+            await client.close()
 
-def get_input_line():
-    global current_input_line
-    return current_input_line.decode("cp850", errors="ignore")
 
+async def run_client(
+    client: tchat.client.ChatClient, terminal: TerminalInput, renderer: Renderer
+):
+    # Both reads wait without polling: the socket and stdin are watched by the
+    # event loop, except the Windows console which TerminalInput polls
+    read_message_task = asyncio.create_task(client.receive_many())
+    read_input_task = asyncio.create_task(terminal.readline())
 
-async def client_main(host: str, port: int | str):
-    prompt = "# "
-    reader: asyncio.StreamReader | None = None
-    writer: asyncio.StreamWriter | None = None
+    message = ""
     try:
-        reader, writer = await asyncio.open_connection(host, port)
-        print(f"Connecté à {host}:{port}")
-        read_message_task = asyncio.create_task(reader.readline())
-
-        print(f"\33[2K\r{prompt}", end="", flush=True)
-        read_input_task = asyncio.create_task(readline())
-
-        message = ""
         while message.strip().lower() != "bye":
             await asyncio.wait(
                 (read_input_task, read_message_task),
@@ -213,29 +991,21 @@ async def client_main(host: str, port: int | str):
             )
             if read_input_task.done():
                 message = await read_input_task
-                writer.write(message.encode())
-                await writer.drain()
-                print(prompt, end="", flush=True)
-                read_input_task = asyncio.create_task(readline())
+                client.send(message)
+                renderer.show_prompt()
+                read_input_task = asyncio.create_task(terminal.readline())
             if read_message_task.done():
-                received_data = await read_message_task
-                if not received_data:
+                # Whatever arrived is taken at once and shown on the next frame
+                lines = await read_message_task
+                if not lines:
+                    renderer.render()
                     print("\33[2K\rConnexion terminée")
                     break
-                received_message = received_data.decode()
-                edited_message = get_input_line()
-                print(
-                    f"\33[2K\r{received_message}{prompt}{edited_message}",
-                    end="",
-                    flush=True,
-                )
-                read_message_task = asyncio.create_task(reader.readline())
-    except ConnectionError as err:
-        print(f"\n{err}")
+                renderer.add_text("".join(f"{line}\n" for line in lines))
+                read_message_task = asyncio.create_task(client.receive_many())
     finally:
-        if writer and not writer.is_closing():
-            writer.close()
-            await writer.wait_closed()
+        read_input_task.cancel()
+        read_message_task.cancel()
 
 
 ###############################################################################
@@ -246,6 +1016,11 @@ if __name__ == "__main__":
     start_server = False
     host = ""
     port = SERVER_PORT
+    listen: list[str] = []
+    config = ServerConfig()
+    store_fsync = "1"
+    binary = False
+    compress = False
 
     i = 1
     while i < len(sys.argv):
@@ -264,16 +1039,148 @@ if __name__ == "__main__":
                 print("Port du serveur manquant.", file=sys.stderr)
                 exit(1)
             port = sys.argv[i]
+        elif argument == "--listen":
+            i += 1
+            if i == len(sys.argv):
+                print("Adresse d'écoute manquante.", file=sys.stderr)
+                exit(1)
+            listen.append(sys.argv[i])
+        elif argument in ("--queue-high", "--queue-low"):
+            i += 1
+            if i == len(sys.argv):
+                print("Taille de file d'envoi manquante.", file=sys.stderr)
+                exit(1)
+            if argument == "--queue-high":
+                config.queue_high_watermark = int(sys.argv[i])
+            else:
+                config.queue_low_watermark = int(sys.argv[i])
+        elif argument == "--workers":
+            i += 1
+            if i == len(sys.argv):
+                print("Nombre de processus manquant.", file=sys.stderr)
+                exit(1)
+            config.workers = int(sys.argv[i])
+            if config.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+                print("--workers n'est pas disponible sur ce système.", file=sys.stderr)
+                exit(1)
+        elif argument in ("--log-level", "--log-file", "--log-payloads"):
+            i += 1
+            if i == len(sys.argv):
+                print(f"Valeur manquante pour {argument}.", file=sys.stderr)
+                exit(1)
+            if argument == "--log-level":
+                config.log.level = sys.argv[i]
+            elif argument == "--log-file":
+                config.log.filename = sys.argv[i]
+            else:
+                config.log.payload_every = int(sys.argv[i])
+        elif argument == "--metrics":
+            i += 1
+            if i == len(sys.argv):
+                print("Port des métriques manquant.", file=sys.stderr)
+                exit(1)
+            config.metrics_port = int(sys.argv[i])
+        elif argument == "--history-size":
+            i += 1
+            if i == len(sys.argv):
+                print("Taille de l'historique manquante.", file=sys.stderr)
+                exit(1)
+            config.history_size = int(sys.argv[i])
+        elif argument == "--store":
+            i += 1
+            if i == len(sys.argv):
+                print("Répertoire du journal manquant.", file=sys.stderr)
+                exit(1)
+            config.store = StoreConfig(sys.argv[i])
+        elif argument == "--store-fsync":
+            i += 1
+            if i == len(sys.argv):
+                print("Politique de fsync manquante.", file=sys.stderr)
+                exit(1)
+            store_fsync = sys.argv[i]
+        elif argument in ("--ping-interval", "--idle-timeout", "--login-timeout"):
+            i += 1
+            if i == len(sys.argv):
+                print(f"Durée manquante pour {argument}.", file=sys.stderr)
+                exit(1)
+            if argument == "--ping-interval":
+                config.timeouts.ping_interval = float(sys.argv[i])
+            elif argument == "--idle-timeout":
+                config.timeouts.idle_timeout = float(sys.argv[i])
+            else:
+                config.timeouts.login_timeout = float(sys.argv[i])
+        elif argument in ("--rate-limit", "--room-rate-limit"):
+            i += 1
+            if i == len(sys.argv):
+                print("Limite de débit manquante.", file=sys.stderr)
+                exit(1)
+            try:
+                messages_rate, bytes_rate = parse_rate(sys.argv[i])
+            except ValueError:
+                print(f"Limite de débit invalide: {sys.argv[i]}", file=sys.stderr)
+                exit(1)
+            if argument == "--rate-limit":
+                config.rate_limits.client_messages = messages_rate
+                if bytes_rate is not None:
+                    config.rate_limits.client_bytes = bytes_rate
+            else:
+                config.rate_limits.room_messages = messages_rate
+                if bytes_rate is not None:
+                    config.rate_limits.room_bytes = bytes_rate
+        elif argument in ("--flood-mute", "--flood-disconnect"):
+            i += 1
+            if i == len(sys.argv):
+                print(f"Nombre manquant pour {argument}.", file=sys.stderr)
+                exit(1)
+            if argument == "--flood-mute":
+                config.rate_limits.mute_after = int(sys.argv[i])
+            else:
+                config.rate_limits.disconnect_after = int(sys.argv[i])
+        elif argument == "--protocol":
+            config.use_protocol = True
+        elif argument == "--binary":
+            binary = True
+        elif argument == "--compress":
+            compress = True
+        elif argument == "--overflow":
+            i += 1
+            try:
+                config.overflow_policy = OverflowPolicy(sys.argv[i])
+            except (IndexError, ValueError):
+                policies = ", ".join(policy.value for policy in OverflowPolicy)
+                print(f"Politique de débordement: {policies}", file=sys.stderr)
+                exit(1)
         else:
             print(f"Option invalide: {argument}", file=sys.stderr)
             exit(1)
         i += 1
 
-    if start_server:
-        main = server_main
-    else:
-        main = client_main
+    if config.store:
+        if config.workers > 1:
+            # One writer per log: the workers would number messages each
+            print("--store n'est pas disponible avec --workers.", file=sys.stderr)
+            exit(1)
+        try:
+            config.store.fsync_interval = parse_fsync(store_fsync)
+        except ValueError:
+            print(f"Politique de fsync invalide: {store_fsync}", file=sys.stderr)
+            exit(1)
+
+    # Without --listen, -h and -p
     try:
-        asyncio.run(main(host, port))
+        endpoints = [parse_endpoint(value, port) for value in listen]
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        exit(1)
+    endpoints = endpoints or [Endpoint(host, int(port))]
+
+    try:
+        if start_server and config.workers > 1:
+            workers_main(endpoints, config)
+        elif start_server:
+            with start_logging(config.log):
+                asyncio.run(server_main(endpoints, config))
+        else:
+            asyncio.run(client_main(host, port, binary, compress))
     except KeyboardInterrupt:
         print("Interruption du programme")
@@ -0,0 +1,2 @@
+# Benchmarks des serveurs de tchat, à lancer depuis le dossier examples:
+#   python -m bench.idle
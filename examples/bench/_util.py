@@ -0,0 +1,110 @@
+import importlib.util
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from types import ModuleType
+
+
+EXAMPLES_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_example(file_name: str) -> ModuleType:
+    # The example scripts are not valid module names (50-tchat.py...)
+    path = EXAMPLES_DIR / file_name
+    module_name = "example_" + path.stem.replace("-", "_")
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(args: list[str], port: int, timeout: float = 10.0):
+    process = subprocess.Popen(
+        args,
+        cwd=EXAMPLES_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Le serveur {args} ne répond pas sur le port {port}")
+
+
+def stop_process(process: subprocess.Popen[bytes]):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _process_stat(pid: int | str) -> list[str]:
+    with open(f"/proc/{pid}/stat") as stat_file:
+        return stat_file.read().rsplit(")", 1)[1].split()
+
+
+def child_pids(pid: int) -> list[int]:
+    children = []
+    for child in os.listdir("/proc"):
+        if not child.isdigit():
+            continue
+        try:
+            fields = _process_stat(child)
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(child))
+    return children
+
+
+def process_cpu_time(pid: int) -> float:
+    # utime + stime of a running process and its direct children, Linux only
+    ticks = 0
+    for process in [pid, *child_pids(pid)]:
+        try:
+            fields = _process_stat(process)
+        except OSError:
+            continue
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def process_rss(pid: int) -> int:
+    # Resident memory of a process and its direct children (--workers)
+    pages = 0
+    for process in [pid, *child_pids(pid)]:
+        try:
+            with open(f"/proc/{process}/statm") as statm_file:
+                pages += int(statm_file.read().split()[1])
+        except OSError:
+            continue
+    return pages * os.sysconf("SC_PAGE_SIZE")
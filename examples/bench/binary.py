@@ -0,0 +1,211 @@
+# Protocole binaire (tchat.binary) contre protocole texte: décodage et tri des
+# messages reçus par le serveur, encodage et diffusion d'un message à un
+# salon, et octets sur le réseau par message. Vérifie aussi qu'un client
+# binaire dont la file déborde est déconnecté plutôt que de perdre des trames.
+#   python -m bench.binary [-n MESSAGES] [-u UTILISATEURS]
+import argparse
+import random
+import time
+from typing import Callable
+
+from tchat.binary import COMMAND, MESSAGE, BinaryCodec, BinaryDecoder, encode_frame
+from tchat.fanout import encode_message
+from tchat.framing import RECEIVE_BUFFER_SIZE, FrameDecoder, LineDecoder
+from tchat.history import History
+from tchat.peer import OverflowPolicy, Peer
+from tchat.registry import Client
+from tchat.rooms import Rooms
+
+
+ROOM = "jeux"
+# One received message out of COMMAND_EVERY is a command
+COMMAND_EVERY = 20
+
+
+def best_of(repeat: int, function: Callable[[], object]) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def report(name: str, count: int, elapsed: float):
+    print(f"{name:<36}{elapsed / count * 1e9:>8.0f} ns")
+
+
+def make_messages(count: int, rng: random.Random) -> list[tuple[str, str]]:
+    # (sender, line) as a client types them
+    words = "le la un une tchat salon message bonjour réponse demain ça été".split()
+    messages = []
+    for index in range(count):
+        sender = f"user{rng.randrange(1000)}"
+        if index % COMMAND_EVERY == 0:
+            line = f"/join salon{rng.randrange(10)}"
+        else:
+            line = " ".join(rng.choices(words, k=rng.randint(2, 20)))
+        messages.append((sender, line))
+    return messages
+
+
+def receive(decoder: FrameDecoder, stream: bytes, handle: Callable[[bytes], object]):
+    # Fed like recv_into() would, RECEIVE_BUFFER_SIZE bytes at most at a time
+    position = 0
+    while position < len(stream):
+        buffer = decoder.get_buffer()
+        size = min(len(buffer), len(stream) - position, RECEIVE_BUFFER_SIZE)
+        buffer[:size] = stream[position : position + size]
+        decoder.buffer_updated(size)
+        position += size
+        for data in decoder:
+            handle(data)
+
+
+def bench_decode(messages: list[tuple[str, str]], repeat: int):
+    lines = [line for _, line in messages]
+    text_stream = b"".join(line.encode() + b"\n" for line in lines)
+    binary_stream = b"".join(
+        encode_frame(COMMAND if line.startswith("/") else MESSAGE, line.encode())
+        for line in lines
+    )
+    commands: list[str] = []
+
+    def handle_line(data: bytes):
+        # What 51-asyncio.py does with a line before the command or the room
+        command = data.decode().strip()
+        if command == "/pong":
+            return
+        if command.startswith("/"):
+            commands.append(command)
+
+    def decode_text():
+        commands.clear()
+        receive(LineDecoder(), text_stream, handle_line)
+
+    def decode_binary():
+        decoder = BinaryDecoder()
+
+        def handle_frame(data: bytes):
+            message = data.decode()
+            if decoder.frame_type == COMMAND:
+                commands.append(message)
+
+        commands.clear()
+        receive(decoder, binary_stream, handle_frame)
+
+    commands_count = len(lines) // COMMAND_EVERY
+    print(f"réception de {len(lines)} messages ({commands_count} commandes)")
+    report("texte: découpage et tri", len(lines), best_of(repeat, decode_text))
+    report("binaire: découpage et tri", len(lines), best_of(repeat, decode_binary))
+    print(
+        f"  octets envoyés par message: texte {len(text_stream) / len(lines):.1f}, "
+        f"binaire {len(binary_stream) / len(lines):.1f}"
+    )
+
+
+def bench_fanout(messages: list[tuple[str, str]], users: int, repeat: int):
+    chat = [(sender, line) for sender, line in messages if not line.startswith("/")]
+    codec = BinaryCodec()
+    rooms: Rooms[Client] = Rooms()
+    for index in range(users):
+        text_client = Client(("texte", index), f"texte{index}")
+        rooms.join(text_client, "texte")
+        binary_client = Client(("binaire", index), f"binaire{index}")
+        binary_client.binary = codec.session()
+        rooms.join(binary_client, "binaire")
+    sent: list[bytes] = []
+
+    def push(client: Client, frame: bytes):
+        sent.append(frame)
+
+    def encode_text():
+        for sender, line in chat:
+            encode_message(line, f"{rooms.sender_label(ROOM, sender)}> ")
+
+    def encode_binary():
+        for seq, (sender, line) in enumerate(chat, 1):
+            codec.message(seq, sender, ROOM, line)
+
+    def fan_out_text(sequenced: bool) -> Callable[[], None]:
+        # ChatClient resumes with /resume: "/seq N" comes before each message
+        history = History()
+
+        def fan_out():
+            for client in rooms.members["texte"]:
+                client.sequenced = sequenced
+            sent.clear()
+            for sender, line in chat[:100]:
+                frames = encode_message(line, f"{rooms.sender_label(ROOM, sender)}> ")
+                entry = history.append(ROOM, frames)
+                rooms.fan_out("texte", frames, push, None, entry.sequenced_frames)
+
+        return fan_out
+
+    def fan_out_binary():
+        sent.clear()
+        for seq, (sender, line) in enumerate(chat[:100], 1):
+            binary = codec.message(seq, sender, ROOM, line)
+            rooms.fan_out("binaire", (), push, binary=lambda: binary)
+
+    print(f"envoi de {len(chat)} messages, diffusion à {users} membres")
+    report("texte: encodage", len(chat), best_of(repeat, encode_text))
+    report("binaire: encodage", len(chat), best_of(repeat, encode_binary))
+    # First broadcasts define the ids to the members, not measured
+    fan_out_binary()
+    deliveries = 100 * users
+    for name, function in (
+        ("texte: diffusion", fan_out_text(False)),
+        ("texte numéroté: diffusion", fan_out_text(True)),
+        ("binaire: diffusion", fan_out_binary),
+    ):
+        elapsed = best_of(repeat, function)
+        report(f"{name}, par membre", deliveries, elapsed)
+        print(f"  octets reçus par message: {sum(map(len, sent)) / deliveries:.1f}")
+
+
+class MemoryPeer(Peer):
+    # Never flushed: every pushed frame stays queued until the queue overflows
+
+    def _schedule_flush(self):
+        pass
+
+    def _abort(self):
+        pass
+
+
+def check_overflow():
+    # The frame defining a sender id must never be dropped: the client would
+    # show "?", or another nickname once the id is reused
+    codec = BinaryCodec()
+    for policy in (OverflowPolicy.DROP_OLDEST, OverflowPolicy.DROP_NEWEST):
+        text_peer = MemoryPeer("texte", 200, 100, policy)
+        binary_peer = MemoryPeer("binaire", 200, 100, policy)
+        binary_peer.binary = True
+        session = codec.session()
+        for seq in range(1, 21):
+            message = codec.message(seq, "alice", ROOM, "bonjour à tous")
+            for frame in session.message_frames(message):
+                binary_peer.push(frame)
+            for frame in encode_message("bonjour à tous", "[jeux] alice> "):
+                text_peer.push(frame)
+        assert text_peer.dropped_frames and not text_peer.closed, policy
+        assert binary_peer.closed and not binary_peer.dropped_frames, policy
+    print("débordement: client texte délesté, client binaire déconnecté")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Protocole binaire et texte")
+    parser.add_argument("-n", "--messages", type=int, default=100_000)
+    parser.add_argument("-u", "--users", type=int, default=1000)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    messages = make_messages(options.messages, random.Random(1))
+    bench_decode(messages, options.repeat)
+    bench_fanout(messages, options.users, options.repeat)
+    check_overflow()
+
+
+if __name__ == "__main__":
+    main()
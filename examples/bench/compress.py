@@ -0,0 +1,125 @@
+# Compression des envois (tchat.compress): octets sur le réseau contre temps
+# CPU de la diffusion à un salon, sans compression, avec un contexte zlib par
+# client et avec les contextes partagés entre clients, et mémoire par contexte.
+#   python -m bench.compress [-n MESSAGES] [-u UTILISATEURS]
+import argparse
+import random
+import time
+import tracemalloc
+from typing import Callable
+
+from tchat.compress import DEFAULT_LEVEL, Compression, DeflateStream
+from tchat.fanout import encode_message
+from tchat.registry import Client
+from tchat.rooms import Rooms
+
+
+ROOM = "jeux"
+
+
+def make_lines(count: int, rng: random.Random, paste: bool) -> list[str]:
+    words = "le la un une tchat salon message bonjour réponse demain ça été".split()
+    if not paste:
+        return [
+            " ".join(rng.choices(words, k=rng.randint(2, 20))) for _ in range(count)
+        ]
+    # Pasted logs: 40 lines of about 100 characters
+    return [
+        "\n".join(
+            f"2024-05-{rng.randint(1, 31):02} INFO worker-{rng.randrange(8)} "
+            + " ".join(rng.choices(words, k=12))
+            for _ in range(40)
+        )
+        for _ in range(count)
+    ]
+
+
+def bench_workload(
+    name: str, lines: list[str], users: int, senders: int, rng: random.Random
+):
+    # `senders` members take turns, none when the messages come from outside
+    # the room (a bot, another worker)
+    rooms: Rooms[Client] = Rooms()
+    clients = [Client(("client", index), f"user{index}") for index in range(users)]
+    for client in clients:
+        rooms.join(client, ROOM)
+    messages = [
+        (
+            rng.choice(clients[:senders]) if senders else None,
+            encode_message(line, "user> "),
+        )
+        for line in lines
+    ]
+    sizes = [0]
+
+    def run(push: Callable[[Client, bytes], object]) -> float:
+        sizes[0] = 0
+        start = time.perf_counter()
+        for sender, frames in messages:
+            rooms.fan_out(ROOM, frames, push, sender)
+        return time.perf_counter() - start
+
+    def plain(client: Client, frame: bytes):
+        sizes[0] += len(frame)
+
+    streams = {client: DeflateStream(DEFAULT_LEVEL) for client in clients}
+
+    def per_client(client: Client, frame: bytes):
+        sizes[0] += len(streams[client].compress(frame, 0))
+
+    compression = Compression()
+    sessions = {client: compression.session() for client in clients}
+
+    def shared(client: Client, frame: bytes):
+        sizes[0] += len(sessions[client].compress(frame))
+
+    deliveries = sum(users - (sender is not None) for sender, _ in messages)
+    print(f"{name}: {len(lines)} messages, {deliveries} livraisons")
+    plain_bytes = 0
+    for label, push in (
+        ("sans compression", plain),
+        ("un contexte par client", per_client),
+        ("contextes partagés", shared),
+    ):
+        elapsed = run(push)
+        if push is plain:
+            plain_bytes = sizes[0]
+        print(
+            f"  {label:<24}{elapsed / deliveries * 1e9:>8.0f} ns"
+            f"{sizes[0] / deliveries:>8.1f} octets"
+            f"{100 * (1 - sizes[0] / plain_bytes):>6.0f} % économisés"
+        )
+    print(
+        f"  contextes partagés: {compression.compressions / len(lines):.1f} "
+        f"compressions par message, {compression.streams} contextes à la fin"
+    )
+
+
+def bench_memory(count: int = 1000):
+    tracemalloc.start()
+    streams = [DeflateStream(DEFAULT_LEVEL) for _ in range(count)]
+    for stream in streams:
+        stream.compress(b"bonjour\n")
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"mémoire par contexte zlib: {memory / count / 1024:.0f} Ko")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compression des envois")
+    parser.add_argument("-n", "--messages", type=int, default=200)
+    parser.add_argument("-u", "--users", type=int, default=1000)
+    options = parser.parse_args()
+
+    rng = random.Random(1)
+    chat = make_lines(options.messages, rng, paste=False)
+    pastes = make_lines(options.messages // 10, rng, paste=True)
+    bench_workload("annonces", chat, options.users, 0, rng)
+    bench_workload("discussion à 10", chat, options.users, 10, rng)
+    bench_workload("discussion à tous", chat, options.users, options.users, rng)
+    bench_workload("logs collés", pastes, options.users, 10, rng)
+    bench_memory()
+
+
+if __name__ == "__main__":
+    main()
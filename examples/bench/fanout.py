@@ -0,0 +1,51 @@
+# Coût CPU d'une diffusion dans un salon: encodage du message pour chaque
+# destinataire (ancien data_received) contre encodage unique partagé.
+#   python -m bench.fanout [-u UTILISATEURS]
+import argparse
+import timeit
+
+from bench._util import load_example
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diffusion d'un message à un salon")
+    parser.add_argument("-u", "--users", type=int, default=1000)
+    parser.add_argument("-r", "--repeat", type=int, default=20)
+    options = parser.parse_args()
+
+    tchat = load_example("50-tchat.py")
+    recipients = [
+        tchat.ClientInfo(None, f"user{index}") for index in range(options.users)
+    ]
+
+    def per_recipient(message: str):
+        for recipient in recipients:
+            tchat.send_message(message, recipient, "alice")
+
+    def encode_once(message: str):
+        tchat.broadcast_message_to(message, recipients, "alice")
+
+    def clear():
+        for recipient in recipients:
+            recipient.send_buffer.clear()
+
+    print(f"{options.users} destinataires")
+    print(f"{'taille':>8}{'par destinataire':>20}{'encodage unique':>20}{'gain':>8}")
+    for size in (20, 200, 2000, 20000):
+        message = ("é" + "x" * 9) * (size // 10)
+        old, new = (
+            min(
+                timeit.repeat(
+                    lambda: function(message),
+                    setup=clear,
+                    number=1,
+                    repeat=options.repeat,
+                )
+            )
+            for function in (per_recipient, encode_once)
+        )
+        print(f"{size:>8}{old * 1e3:>17.2f} ms{new * 1e3:>17.2f} ms{old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
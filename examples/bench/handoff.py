@@ -0,0 +1,189 @@
+# Redémarrage sans coupure de 50-tchat.py (--handoff): un second serveur reprend
+# les sockets et l'état des clients du premier. Mesure la pause du service avec
+# beaucoup de connexions inactives, vue par les serveurs et par un client qui
+# reçoit un message par intervalle, et vérifie que rien n'est perdu: messages
+# de la sonde, file d'envoi d'un client qui ne lit pas, connexions inactives.
+#   python -m bench.handoff [-n CONNEXIONS] [-i INTERVALLE_MS]
+import argparse
+import asyncio
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench._util import (
+    EXAMPLES_DIR,
+    free_port,
+    raise_fd_limit,
+    start_process,
+    stop_process,
+)
+
+
+PROBE_ROOM = "sonde"
+# Receive buffer of the client which does not read: its messages wait in the
+# send queue of the server during the handoff
+SLOW_RECEIVE_BUFFER = 4096
+PROBE_MESSAGE = re.compile(rb"emetteur> (\d+)")
+PROBE_PADDING = "x" * 80
+
+
+def read_until(client: socket.socket, marker: bytes, timeout: float = 30) -> bytes:
+    client.settimeout(timeout)
+    data = b""
+    while marker not in data:
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def open_idle_clients(port: int, count: int) -> list[socket.socket]:
+    # Without a nickname: each /pseudo is announced to everybody
+    clients = [socket.create_connection(("127.0.0.1", port)) for _ in range(count)]
+    # Accepted in order: the last one greeted, all of them are
+    read_until(clients[-1], b"Bienvenue")
+    return clients
+
+
+def open_slow_client(port: int) -> socket.socket:
+    client = socket.socket()
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_RECEIVE_BUFFER)
+    client.connect(("127.0.0.1", port))
+    client.sendall(f"/pseudo lent\n/join {PROBE_ROOM}\n".encode())
+    return client
+
+
+async def login(
+    port: int, name: str
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"/pseudo {name}\n/join {PROBE_ROOM}\n".encode())
+    await reader.readuntil(f"{name} a rejoint le salon {PROBE_ROOM}.\n".encode())
+    return reader, writer
+
+
+async def probe(
+    port: int, interval: float, new_server: list[str], old_server: subprocess.Popen
+) -> tuple[dict[int, float], dict[int, float], subprocess.Popen]:
+    # Sends a numbered message every `interval` to the probe room, starts the
+    # new server, goes on until the old one is gone and a while more
+    _, sender = await login(port, "emetteur")
+    reader, receiver = await login(port, "sonde")
+    # Their /pseudo went to every idle connection: sent before measuring
+    await asyncio.sleep(1.0)
+    sent: dict[int, float] = {}
+    received: dict[int, float] = {}
+
+    async def receive():
+        while line := await reader.readline():
+            if match := PROBE_MESSAGE.search(line):
+                received[int(match.group(1))] = time.perf_counter()
+
+    receiving = asyncio.create_task(receive())
+    server = None
+    end = None
+    seq = 0
+    while end is None or time.perf_counter() < end:
+        sent[seq] = time.perf_counter()
+        sender.write(f"{seq} {PROBE_PADDING}\n".encode())
+        seq += 1
+        await asyncio.sleep(interval)
+        if seq == int(0.5 / interval):
+            server = subprocess.Popen(
+                new_server,
+                cwd=EXAMPLES_DIR,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        if end is None and old_server.poll() is not None:
+            end = time.perf_counter() + 0.5
+    deadline = time.perf_counter() + 10
+    while len(received) < len(sent) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    receiving.cancel()
+    sender.close()
+    receiver.close()
+    assert server is not None
+    return sent, received, server
+
+
+def logged_milliseconds(path: str, pattern: str) -> float | None:
+    with open(path, encoding="utf-8") as log_file:
+        match = re.search(pattern + r" ([\d.]+) ms", log_file.read())
+    return float(match.group(1)) if match else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Redémarrage sans coupure")
+    parser.add_argument("-n", "--connections", type=int, default=10000)
+    parser.add_argument("-i", "--interval", type=float, default=1.0)
+    options = parser.parse_args()
+    raise_fd_limit()
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        handoff_path = os.path.join(directory, "handoff.sock")
+        server = [sys.executable, "50-tchat.py", "-s", "-h", "127.0.0.1"]
+        server += ["-p", str(port), "--handoff", handoff_path]
+        # The probe sends faster than a client may
+        server += ["--rate-limit", "0", "--room-rate-limit", "0"]
+        old_log = os.path.join(directory, "ancien.log")
+        new_log = os.path.join(directory, "nouveau.log")
+        old_server = start_process(server + ["--log-file", old_log], port)
+        new_server = None
+        try:
+            idle = open_idle_clients(port, options.connections)
+            slow = open_slow_client(port)
+            sent, received, new_server = asyncio.run(
+                probe(
+                    port,
+                    options.interval / 1000,
+                    server + ["--log-file", new_log],
+                    old_server,
+                )
+            )
+            # Everybody is in the default room: a last message reaches them all
+            checker = socket.create_connection(("127.0.0.1", port))
+            checker.sendall("/pseudo fin\nterminé\n".encode())
+            end_marker = "fin> terminé".encode()
+            alive = sum(end_marker in read_until(client, end_marker) for client in idle)
+            slow_data = read_until(slow, end_marker)
+            slow_seqs = PROBE_MESSAGE.findall(slow_data)
+            checker.close()
+            for client in [*idle, slow]:
+                client.close()
+        finally:
+            if new_server:
+                stop_process(new_server)
+            stop_process(old_server)
+        copy_time = logged_milliseconds(old_log, "passées au nouveau serveur en")
+        pause = logged_milliseconds(new_log, "après une pause de")
+
+    delays = sorted(received[seq] - sent[seq] for seq in received)
+    p50 = statistics.median(delays)
+    in_order = [int(seq) for seq in slow_seqs] == sorted(sent)
+    print(
+        f"{options.connections} connexions inactives, un message toutes les "
+        f"{options.interval:g} ms"
+    )
+    print(f"  copie pendant que l'ancien serveur continue: {copy_time} ms")
+    print(f"  pause, de l'arrêt de l'ancien serveur à la reprise: {pause} ms")
+    print(
+        f"  sonde: {len(received)}/{len(sent)} messages reçus, latence p50 "
+        f"{p50 * 1e3:.2f} ms, max {delays[-1] * 1e3:.1f} ms"
+    )
+    print(
+        f"  client qui ne lit pas: {len(slow_seqs)}/{len(sent)} messages, "
+        + ("dans l'ordre" if in_order else "désordre ou trous")
+    )
+    print(f"  connexions inactives toujours servies: {alive}/{options.connections}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Consommation CPU du serveur 50-tchat.py avec beaucoup de connexions inactives,
+# comparée à l'ancienne boucle select.select().
+#   python -m bench.idle [-n CONNEXIONS] [-d DUREE]
+import argparse
+import socket
+import sys
+import time
+
+from bench._util import (
+    free_port,
+    process_cpu_time,
+    raise_fd_limit,
+    start_process,
+    stop_process,
+)
+
+
+# select.select() refuse les descripteurs au-delà de FD_SETSIZE
+LEGACY_MAX_CONNECTIONS = 1000
+
+
+def measure_idle(args: list[str], port: int, connection_count: int, duration: float):
+    server = start_process(args, port)
+    clients: list[socket.socket] = []
+    try:
+        for _ in range(connection_count):
+            clients.append(socket.create_connection(("127.0.0.1", port)))
+        time.sleep(1.0)  # let the server accept and greet everybody
+        cpu_start = process_cpu_time(server.pid)
+        time.sleep(duration)
+        cpu_used = process_cpu_time(server.pid) - cpu_start
+    finally:
+        for client in clients:
+            client.close()
+        stop_process(server)
+    return cpu_used / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="CPU du serveur avec des connexions inactives"
+    )
+    parser.add_argument("-n", "--connections", type=int, default=10000)
+    parser.add_argument("-d", "--duration", type=float, default=5.0)
+    options = parser.parse_args()
+    raise_fd_limit()
+
+    results = []
+    port = free_port()
+    legacy_count = min(options.connections, LEGACY_MAX_CONNECTIONS)
+    cpu = measure_idle(
+        [sys.executable, "-m", "bench.legacy_select", str(port)],
+        port,
+        legacy_count,
+        options.duration,
+    )
+    results.append(("select.select (ancien)", legacy_count, cpu))
+
+    for connection_count in sorted({legacy_count, options.connections}):
+        port = free_port()
+        cpu = measure_idle(
+            [sys.executable, "50-tchat.py", "-s", "-h", "127.0.0.1", "-p", str(port)],
+            port,
+            connection_count,
+            options.duration,
+        )
+        results.append(("selectors", connection_count, cpu))
+
+    print(f"{'boucle':<24}{'connexions':>12}{'CPU':>10}")
+    for name, connection_count, cpu in results:
+        print(f"{name:<24}{connection_count:>12}{cpu:>9.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# Copie de la boucle select.select() d'origine de 50-tchat.py, gardée comme
+# point de comparaison: tous les clients sont considérés prêts en écriture et
+# select() est rappelé toutes les 0.1 s avec la liste complète des sockets.
+import select
+import socket
+import sys
+
+
+def server_main(port: int):
+    server_socket = socket.socket()
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.setblocking(False)
+    server_socket.bind(("127.0.0.1", port))
+    server_socket.listen(socket.SOMAXCONN)
+
+    all_sockets = [server_socket]
+    connections: dict[socket.socket, list[bytes]] = {}
+    try:
+        while all_sockets:
+            # the original filter tested the ClientInfo object, always true
+            output_sockets = list(connections)
+            readable_sockets, writable_sockets, error_sockets = select.select(
+                all_sockets, output_sockets, all_sockets, 0.1
+            )
+            for readable_socket in readable_sockets:
+                if readable_socket is server_socket:
+                    client_socket, _ = server_socket.accept()
+                    client_socket.setblocking(False)
+                    all_sockets.append(client_socket)
+                    connections[client_socket] = []
+                else:
+                    data = readable_socket.recv(100)
+                    if not data:
+                        del connections[readable_socket]
+                        all_sockets.remove(readable_socket)
+                        readable_socket.close()
+            for writable_socket in writable_sockets:
+                if writable_socket in connections and connections[writable_socket]:
+                    writable_socket.send(connections[writable_socket].pop(0))
+            for error_socket in error_sockets:
+                del connections[error_socket]
+                all_sockets.remove(error_socket)
+                error_socket.close()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    server_main(int(sys.argv[1]))
@@ -0,0 +1,398 @@
+# Générateur de charge pour les deux serveurs: des milliers de clients simulés
+# répartis sur quelques processus, selon un scénario:
+#   idle   connexions inactives (mémoire et CPU du serveur au repos)
+#   chat   salons bavards, chaque client envoie --rate messages par seconde
+#   large  longs messages, découpés en plusieurs lignes par le serveur
+#   slow   comme chat, mais une partie des clients lit très lentement
+# Les résultats peuvent être écrits en JSON (--json) et comparés à une mesure
+# précédente (--baseline) pour détecter les régressions.
+#   python -m bench.load [--server 50|51] [--server-args="--protocol"]
+#       [--workload idle|chat|large|slow] [-c CLIENTS] [-P PROCESSUS] [-d DUREE]
+import argparse
+import asyncio
+from dataclasses import asdict, dataclass, field, replace
+import json
+import multiprocessing
+import random
+import shlex
+import subprocess
+import sys
+import time
+
+from bench._util import (
+    free_port,
+    process_cpu_time,
+    process_rss,
+    raise_fd_limit,
+    start_process,
+    stop_process,
+)
+from tchat.metrics import Histogram
+
+
+SERVERS = {"50": "50-tchat.py", "51": "51-asyncio.py"}
+ROOM_SIZE = 50
+DRAIN_DELAY = 2.0
+# How long a slow reader waits between two small reads
+SLOW_READ_INTERVAL = 0.1
+# Connections being opened at the same time by a load process, more would
+# overflow the listen backlog of the server
+CONNECT_CONCURRENCY = 50
+
+
+@dataclass
+class Workload:
+    name: str
+    rate: float  # messages per second and per client
+    size: int
+    slow_fraction: float = 0.0
+    slow_rate: int = 1024  # bytes per second read by a slow client
+
+
+WORKLOADS = {
+    "idle": Workload("idle", rate=0.0, size=0),
+    "chat": Workload("chat", rate=1.0, size=64),
+    "large": Workload("large", rate=0.2, size=4000),
+    "slow": Workload("slow", rate=1.0, size=64, slow_fraction=0.1),
+}
+
+
+@dataclass
+class LoadSettings:
+    port: int
+    process_index: int
+    clients: int
+    rooms: int
+    duration: float
+    workload: Workload
+
+
+@dataclass
+class LoadResult:
+    connected: int = 0
+    errors: int = 0
+    sent: int = 0
+    received: int = 0
+    received_slow: int = 0
+    latency: Histogram = field(
+        default_factory=lambda: Histogram("latency", "Latence de bout en bout")
+    )
+
+    def merge(self, other: "LoadResult"):
+        self.connected += other.connected
+        self.errors += other.errors
+        self.sent += other.sent
+        self.received += other.received
+        self.received_slow += other.received_slow
+        self.latency.merge(other.latency)
+
+
+def parse_timestamp(line: bytes) -> int | None:
+    # Chat lines are "[salon] pseudo> <monotonic_ns> xxxx", the continuation
+    # lines of a long message start with the padding and are not counted.
+    start = line.find(b"> ")
+    if start < 0:
+        return None
+    start += 2
+    end = line.find(b" ", start)
+    stamp = line[start:end] if end > 0 else line[start:].rstrip()
+    return int(stamp) if stamp.isdigit() else None
+
+
+async def connect(name: str, room: str | None, settings: LoadSettings, limit: int):
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", settings.port, limit=limit
+    )
+    writer.write(f"/pseudo {name}\n".encode())
+    if room:
+        writer.write(f"/join {room}\n".encode())
+    await writer.drain()
+    # 51-asyncio.py answers "Bienvenue", 50-tchat.py announces the new name
+    # to everybody, sender included.
+    confirmations = (
+        f"Bienvenue {name}\n".encode(),
+        f" {name} est dans la place !\n".encode(),
+    )
+    while not (await reader.readuntil(b"\n")).endswith(confirmations):
+        pass
+    return reader, writer
+
+
+async def send_messages(
+    writer: asyncio.StreamWriter, workload: Workload, stop: float, result: LoadResult
+):
+    padding = b"x" * max(workload.size - 21, 0)
+    while True:
+        # Poisson arrivals, clients do not all speak at the same time
+        await asyncio.sleep(random.expovariate(workload.rate))
+        if time.monotonic() >= stop:
+            return
+        writer.write(b"%d %s\n" % (time.monotonic_ns(), padding))
+        await writer.drain()
+        result.sent += 1
+
+
+async def read_messages(
+    reader: asyncio.StreamReader, slow: bool, workload: Workload, result: LoadResult
+):
+    if slow:
+        chunk = max(int(workload.slow_rate * SLOW_READ_INTERVAL), 1)
+        pending = b""
+        while data := await reader.read(chunk):
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            result.received_slow += sum(
+                parse_timestamp(line) is not None for line in lines
+            )
+            await asyncio.sleep(SLOW_READ_INTERVAL)
+        return
+    while line := await reader.readline():
+        stamp = parse_timestamp(line)
+        if stamp is not None:
+            result.latency.record((time.monotonic_ns() - stamp) / 1e9)
+            result.received += 1
+
+
+async def run_client(
+    index: int,
+    settings: LoadSettings,
+    connecting: asyncio.Semaphore,
+    start: asyncio.Event,
+    result: LoadResult,
+):
+    workload = settings.workload
+    name = f"c{settings.process_index}_{index}"
+    global_index = settings.process_index * settings.clients + index
+    room = f"salon{global_index % settings.rooms}" if settings.rooms > 1 else None
+    slow = random.random() < workload.slow_fraction
+    try:
+        # A slow reader keeps little in its StreamReader so that the server
+        # sees a full socket quickly.
+        async with connecting:
+            limit = 4096 if slow else 2**16
+            reader, writer = await connect(name, room, settings, limit)
+    except (OSError, asyncio.IncompleteReadError):
+        result.errors += 1
+        return
+    result.connected += 1
+    await start.wait()
+    stop = time.monotonic() + settings.duration
+    reading = asyncio.create_task(read_messages(reader, slow, workload, result))
+    try:
+        if workload.rate > 0 and not slow:
+            await send_messages(writer, workload, stop, result)
+        await asyncio.sleep(max(stop - time.monotonic(), 0) + DRAIN_DELAY)
+    except ConnectionError:
+        result.errors += 1
+    finally:
+        reading.cancel()
+        writer.close()
+
+
+async def run_process_clients(settings: LoadSettings, barrier) -> LoadResult:
+    result = LoadResult()
+    connecting = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    start = asyncio.Event()
+    clients = [
+        asyncio.create_task(run_client(index, settings, connecting, start, result))
+        for index in range(settings.clients)
+    ]
+    # Every process connects its clients, then they all start together
+    while result.connected + result.errors < settings.clients:
+        await asyncio.sleep(0.05)
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    start.set()
+    await asyncio.gather(*clients)
+    return result
+
+
+def load_process(settings: LoadSettings, barrier, results):
+    raise_fd_limit()
+    results.put(asyncio.run(run_process_clients(settings, barrier)))
+
+
+def run_load(
+    port: int,
+    server_pid: int,
+    client_count: int,
+    process_count: int,
+    rooms: int,
+    duration: float,
+    workload: Workload,
+) -> dict[str, object]:
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(process_count + 1)
+    results = context.Queue()
+    rss_start = process_rss(server_pid)
+    processes = []
+    for process_index in range(process_count):
+        clients = client_count // process_count
+        if process_index < client_count % process_count:
+            clients += 1
+        settings = LoadSettings(port, process_index, clients, rooms, duration, workload)
+        process = context.Process(
+            target=load_process, args=(settings, barrier, results)
+        )
+        process.start()
+        processes.append(process)
+
+    barrier.wait()
+    connected_rss = process_rss(server_pid)
+    cpu_start = process_cpu_time(server_pid)
+    started = time.perf_counter()
+    total = LoadResult()
+    for _ in processes:
+        total.merge(results.get())
+    cpu_used = process_cpu_time(server_pid) - cpu_start
+    for process in processes:
+        process.join()
+
+    latency = total.latency
+    return {
+        "connected": total.connected,
+        "errors": total.errors,
+        "sent": total.sent,
+        "received": total.received,
+        "received_slow": total.received_slow,
+        "sent_per_second": total.sent / duration,
+        "received_per_second": total.received / duration,
+        "latency_p50": latency.quantile(0.5),
+        "latency_p99": latency.quantile(0.99),
+        "latency_p999": latency.quantile(0.999),
+        "latency_max": latency.max,
+        "rss_per_connection": (connected_rss - rss_start) / max(total.connected, 1),
+        "server_rss": connected_rss,
+        # Includes the DRAIN_DELAY during which only queued messages flow
+        "cpu_percent": cpu_used / (time.perf_counter() - started) * 100,
+        "cpu_per_message_us": (
+            cpu_used / total.received * 1e6 if total.received else None
+        ),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "inconnue"
+
+
+def compare(results: dict[str, object], baseline_path: str, tolerance: float) -> bool:
+    # Returns False when a figure is worse than the baseline by more than tolerance
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    for key in ("server", "server_args", "workload", "clients"):
+        if baseline.get(key) != results[key]:
+            print(f"Attention, {key} différent: {baseline.get(key)} -> {results[key]}")
+    ok = True
+    checks = [
+        ("received_per_second", False),
+        ("latency_p99", True),
+        ("rss_per_connection", True),
+        ("cpu_per_message_us", True),
+    ]
+    for key, lower_is_better in checks:
+        before, after = baseline.get(key), results[key]
+        if not before or not isinstance(after, (int, float)):
+            continue
+        change = (after - before) / before
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        ok = ok and not worse
+        flag = "  RÉGRESSION" if worse else ""
+        print(f"{key:<22}{before:>14.6g} -> {after:<14.6g}{change:>+8.1%}{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Charge simulée sur un serveur de tchat"
+    )
+    parser.add_argument("--server", choices=SERVERS, default="51")
+    parser.add_argument(
+        "--server-args", default="", help='ex: --server-args="--protocol --workers 2"'
+    )
+    parser.add_argument("--workload", choices=WORKLOADS, default="chat")
+    parser.add_argument("-c", "--clients", type=int, default=1000)
+    parser.add_argument("-P", "--processes", type=int, default=4)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("--rooms", type=int, help=f"défaut: un salon pour {ROOM_SIZE}")
+    parser.add_argument("--rate", type=float, help="messages/s par client")
+    parser.add_argument("--size", type=int, help="taille des messages")
+    parser.add_argument("--slow", type=float, help="part des clients lents")
+    parser.add_argument("--json", help="fichier de résultats")
+    parser.add_argument("--baseline", help="résultats JSON à comparer")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    options = parser.parse_args()
+    raise_fd_limit()
+
+    workload = WORKLOADS[options.workload]
+    if options.rate is not None:
+        workload = replace(workload, rate=options.rate)
+    if options.size is not None:
+        workload = replace(workload, size=options.size)
+    if options.slow is not None:
+        workload = replace(workload, slow_fraction=options.slow)
+    rooms = options.rooms or max(options.clients // ROOM_SIZE, 1)
+
+    port = free_port()
+    args = [sys.executable, SERVERS[options.server], "-s", "-h", "127.0.0.1"]
+    args += ["-p", str(port), *shlex.split(options.server_args)]
+    server = start_process(args, port)
+    try:
+        results = run_load(
+            port,
+            server.pid,
+            options.clients,
+            options.processes,
+            rooms,
+            options.duration,
+            workload,
+        )
+    finally:
+        stop_process(server)
+
+    print(
+        f"{SERVERS[options.server]} {options.server_args} - {workload.name}: "
+        f"{results['connected']} clients ({results['errors']} erreurs), {rooms} salons"
+    )
+    print(
+        f"envoyés {results['sent_per_second']:.0f} msg/s, "
+        f"reçus {results['received_per_second']:.0f} msg/s "
+        f"(+{results['received_slow']} par les clients lents)"
+    )
+    print(
+        "latence p50 {latency_p50:.4f}s  p99 {latency_p99:.4f}s  "
+        "p999 {latency_p999:.4f}s  max {latency_max:.4f}s".format(**results)
+    )
+    cpu_per_message = results["cpu_per_message_us"]
+    print(
+        f"serveur: {results['rss_per_connection'] / 1024:.1f} Kio par connexion, "
+        f"CPU {results['cpu_percent']:.0f}%"
+        + (f", {cpu_per_message:.1f} µs par message reçu" if cpu_per_message else "")
+    )
+
+    results.update(
+        server=SERVERS[options.server],
+        server_args=options.server_args,
+        workload=asdict(workload),
+        clients=options.clients,
+        processes=options.processes,
+        rooms=rooms,
+        duration=options.duration,
+        revision=git_revision(),
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+    if options.json:
+        with open(options.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+    if options.baseline and not compare(results, options.baseline, options.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Mémoire par connexion et recherche de pseudo avec 100 000 clients simulés:
+# anciens enregistrements (dataclass avec __dict__, dict par client) contre le
+# registre indexé de tchat.registry.
+#   python -m bench.registry [-n CLIENTS]
+import argparse
+from dataclasses import dataclass, field
+import gc
+import timeit
+import tracemalloc
+from typing import Any, Callable
+
+from bench._util import load_example
+from tchat.registry import Client, Registry
+
+
+@dataclass
+class LegacyClientInfo:
+    # ClientInfo of 50-tchat.py before the registry
+    socket: object
+    name: str
+    send_buffer: list[bytes] = field(default_factory=list)
+
+
+def address(index: int) -> str:
+    return f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}:{index}"
+
+
+def legacy_50(count: int) -> dict[object, LegacyClientInfo]:
+    connections = {}
+    for index in range(count):
+        key = object()
+        connections[key] = LegacyClientInfo(key, address(index))
+        connections[key].name = f"user{index}"
+    return connections
+
+
+def legacy_51(count: int) -> dict[str, dict[str, Any]]:
+    # 51-asyncio.py kept a client_data dict per connection
+    connections: dict[str, dict[str, Any]] = {}
+    for index in range(count):
+        addr = address(index)
+        connections[addr] = {"addr": addr, "connections": connections, "lock": None}
+        connections[addr]["pseudo"] = f"user{index}"
+    return connections
+
+
+def registry(count: int) -> Registry[Client]:
+    clients: Registry[Client] = Registry()
+    for index in range(count):
+        client = clients.add(Client(object(), address(index)))
+        clients.rename(client, f"user{index}")
+    return clients
+
+
+def registry_50(count: int) -> Registry[Any]:
+    # Complete records of 50-tchat.py, with their send and receive buffers
+    tchat = load_example("50-tchat.py")
+    clients: Registry[Any] = Registry()
+    for index in range(count):
+        client = clients.add(tchat.ClientInfo(object(), address(index)))
+        clients.rename(client, f"user{index}")
+    return clients
+
+
+def scan_50(connections: dict[object, LegacyClientInfo], name: str):
+    # command_set_name of 50-tchat.py compared every name
+    return any(info.name == name for info in connections.values())
+
+
+def scan_51(connections: dict[str, dict[str, Any]], name: str):
+    return any(data.get("pseudo") == name for data in connections.values())
+
+
+def measure_memory(build: Callable[[int], Any], count: int) -> tuple[Any, int]:
+    gc.collect()
+    tracemalloc.start()
+    result = build(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registre des connexions")
+    parser.add_argument("-n", "--clients", type=int, default=100_000)
+    options = parser.parse_args()
+    count = options.clients
+
+    print(f"{count} clients simulés")
+    print(f"{'structure':<36}{'octets/client':>14}{'recherche pseudo':>18}")
+    builds = {
+        "50-tchat.py ancien (dataclass)": (legacy_50, scan_50),
+        "51-asyncio.py ancien (dict)": (legacy_51, scan_51),
+        "Registry[Client] (__slots__)": (registry, Registry.find_name),
+        "Registry[ClientInfo] avec tampons": (registry_50, Registry.find_name),
+    }
+    for name, (build, find_name) in builds.items():
+        clients, size = measure_memory(build, count)
+        # Worst case for a scan: the nickname is not used
+        lookup = min(
+            timeit.repeat(lambda: find_name(clients, "personne"), number=3, repeat=3)
+        )
+        print(f"{name:<36}{size / count:>14.0f}{lookup / 3 * 1e6:>15.2f} µs")
+        del clients
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# Rejoue une trace de trafic sur le cœur d'un serveur, sans réseau: horloge
+# virtuelle, connexions en mémoire et hasard tiré d'une graine. Deux exécutions
+# avec la même trace et la même graine donnent la même empreinte de tout ce
+# que les clients ont reçu, ce qui permet de reproduire un incident et de
+# profiler le serveur (--profile) sans le bruit du réseau.
+#   python -m bench.simulate [--server 50|51] [--protocol] [-c CLIENTS]
+#       [-m MESSAGES] [--rooms SALONS] [--seed GRAINE] [--latency S] [--jitter S]
+#       [--trace FICHIER] [--save-trace FICHIER] [--profile]
+import argparse
+import asyncio
+import cProfile
+from dataclasses import dataclass
+import functools
+import pstats
+import time
+from types import ModuleType
+from typing import Iterable
+
+from bench._util import load_example
+from tchat.bus import LocalBus
+from tchat.registry import Registry
+from tchat.simulation import (
+    SimulatedClient,
+    SimulatedNetwork,
+    SimulatedSelector,
+    TraceEvent,
+    read_trace,
+    run_simulation,
+    synthetic_trace,
+    write_trace,
+)
+
+
+# Simulated time left to the server to deliver what is queued after the trace
+DRAIN_DELAY = 5.0
+
+
+@dataclass
+class Replay:
+    events: int = 0
+    messages: int = 0
+    simulated_time: float = 0.0
+
+
+def apply_event(
+    event: TraceEvent,
+    clients: dict[int, SimulatedClient],
+    connect,
+    replay: Replay,
+):
+    replay.events += 1
+    if event.kind == "connect":
+        clients[event.client] = connect()
+    elif event.kind == "send":
+        replay.messages += event.data.count(b"\n")
+        clients[event.client].send(event.data)
+    elif event.kind == "close":
+        clients.pop(event.client).close()
+
+
+def replay_selector_server(
+    module: ModuleType, trace: Iterable[TraceEvent], network: SimulatedNetwork
+) -> Replay:
+    # 50-tchat.py: its select() loop body runs over memory sockets
+    selector = SimulatedSelector()
+    connections = Registry()
+    clients: dict[int, SimulatedClient] = {}
+    replay = Replay()
+
+    def connect() -> SimulatedClient:
+        client, sock = network.connect_socket(selector)
+        module.connection_made(connections, sock, selector)
+        return client
+
+    def run_until_idle():
+        while ready := selector.select(0):
+            module.process_events(connections, ready, selector)
+
+    for event in trace:
+        if event.time > selector.now:
+            run_until_idle()
+            selector.now = event.time
+        apply_event(event, clients, connect, replay)
+    run_until_idle()
+    replay.simulated_time = selector.now
+    return replay
+
+
+async def replay_asyncio_server(
+    module: ModuleType,
+    trace: Iterable[TraceEvent],
+    network: SimulatedNetwork,
+    use_protocol: bool,
+) -> Replay:
+    # 51-asyncio.py: Chat with its protocol or its streams over MemoryTransports
+    loop = asyncio.get_running_loop()
+    chat = module.Chat(module.ServerConfig(use_protocol=use_protocol), LocalBus())
+    clients: dict[int, SimulatedClient] = {}
+    replay = Replay()
+
+    def connect() -> SimulatedClient:
+        if use_protocol:
+            protocol = module.ChatProtocol(chat)
+        else:
+            protocol = asyncio.StreamReaderProtocol(
+                asyncio.StreamReader(),
+                functools.partial(module.handle_client_connection, chat=chat),
+            )
+        return network.connect_protocol(loop, protocol)  # type: ignore [arg-type]
+
+    for event in trace:
+        if event.time > loop.time():
+            await asyncio.sleep(event.time - loop.time())
+        apply_event(event, clients, connect, replay)
+    await asyncio.sleep(DRAIN_DELAY)
+    replay.simulated_time = loop.time()
+    return replay
+
+
+def simulate(options: argparse.Namespace, trace: Iterable[TraceEvent]):
+    network = SimulatedNetwork(options.latency, options.jitter)
+    if options.server == "50":
+        module = load_example("50-tchat.py")
+        replay = replay_selector_server(module, trace, network)
+    else:
+        module = load_example("51-asyncio.py")
+        replay = run_simulation(
+            replay_asyncio_server(module, trace, network, options.protocol),
+            options.seed,
+        )
+    return replay, network
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulation déterministe d'un serveur")
+    parser.add_argument("--server", choices=("50", "51"), default="51")
+    parser.add_argument("--protocol", action="store_true", help="51 en mode --protocol")
+    parser.add_argument("-c", "--clients", type=int, default=1000)
+    parser.add_argument("-m", "--messages", type=int, default=100_000)
+    parser.add_argument("--rooms", type=int, help="défaut: un salon pour 50 clients")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages/s par client")
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--trace", help="trace JSON à rejouer (sinon trace générée)")
+    parser.add_argument("--save-trace", help="enregistre la trace générée")
+    parser.add_argument("--profile", action="store_true")
+    options = parser.parse_args()
+
+    if options.trace:
+        trace = read_trace(options.trace)
+    else:
+        rooms = options.rooms or max(options.clients // 50, 1)
+        trace = synthetic_trace(
+            options.seed,
+            options.clients,
+            options.messages,
+            rooms,
+            options.rate,
+            options.size,
+        )
+        if options.save_trace:
+            write_trace(options.save_trace, trace)
+            trace = read_trace(options.save_trace)
+
+    profiler = cProfile.Profile() if options.profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    replay, network = simulate(options, trace)
+    if profiler:
+        profiler.disable()
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{replay.events} évènements, {replay.messages} messages, "
+        f"{network.deliveries} envois ({network.delivered_bytes} octets)"
+    )
+    print(
+        f"{replay.simulated_time:.1f} s simulées en {elapsed:.2f} s: "
+        f"{replay.messages / elapsed:.0f} messages/s, "
+        f"{network.deliveries / elapsed:.0f} envois/s"
+    )
+    print(f"empreinte {network.digest:08x}")
+    if profiler:
+        pstats.Stats(profiler).sort_stats("tottime").print_stats(25)
+
+
+if __name__ == "__main__":
+    main()
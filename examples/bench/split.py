@@ -0,0 +1,97 @@
+# Découpage d'un long message collé en trames de MESSAGE_MAX_SIZE octets:
+# l'ancien cut_message (décodage et ré-encodage de chaque préfixe, copie du
+# reste à chaque trame) contre split_utf8 sur une memoryview.
+# Par défaut le message est une seule ligne, le pire cas de l'ancien découpage.
+#   python -m bench.split [--sizes MO,...] [--max-size OCTETS] [--line KO]
+#       [--legacy-limit MO]
+import argparse
+import time
+from typing import Callable, Iterator
+
+from tchat.fanout import Frames, encode_message
+
+
+MEGABYTE = 1 << 20
+
+
+def legacy_cut_message(message: str, max_size: int) -> Iterator[bytes]:
+    data = message.encode()
+    data_size = len(data)
+    if not max_size or data_size <= max_size:
+        yield data
+    else:
+        while data:
+            beginning = data[:max_size].decode(errors="ignore").encode()
+            yield beginning
+            data = data[len(beginning) :]
+
+
+def legacy_encode_message(message: str, header: str = "", max_size: int = 0) -> Frames:
+    message = message.rstrip()
+    header_data = header.encode()
+    footer_data = b"\n"
+    overhead_size = len(header_data) + len(footer_data)
+    body_max_size = max_size - overhead_size if max_size else 0
+    return tuple(
+        b"".join((header_data, body_data, footer_data))
+        for line in message.split("\n")
+        for body_data in legacy_cut_message(line, body_max_size)
+    )
+
+
+def make_message(size: int, line_size: int) -> str:
+    # French text with accents and a few emojis, one line unless `line_size`
+    sentence = "Une ligne collée, avec des accents: é à ç ô, et 😀. "
+    sentence_size = len(sentence.encode())
+    if not line_size:
+        return sentence * (size // sentence_size + 1)
+    line = sentence * max(line_size // sentence_size, 1) + "\n"
+    return line * (size // len(line.encode()) + 1)
+
+
+def measure(function: Callable[[], Frames]) -> tuple[float, Frames]:
+    start = time.perf_counter()
+    frames = function()
+    return time.perf_counter() - start, frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Découpage de longs messages")
+    parser.add_argument("--sizes", default="1,4,16", help="tailles en Mo")
+    parser.add_argument("--max-size", type=int, default=100)
+    parser.add_argument("--line", type=float, default=0, help="Ko par ligne, 0: une")
+    parser.add_argument(
+        "--legacy-limit",
+        type=float,
+        default=4,
+        help="taille maximale mesurée avec l'ancien découpage, en Mo",
+    )
+    options = parser.parse_args()
+
+    header = "alice> "
+    print(f"trames de {options.max_size} octets au plus")
+    print(f"{'taille':>8}{'trames':>10}{'ancien':>12}{'memoryview':>12}{'débit':>12}")
+    for size in (float(size) for size in options.sizes.split(",")):
+        message = make_message(int(size * MEGABYTE), int(options.line * 1024))
+        elapsed, frames = measure(
+            lambda: encode_message(message, header, options.max_size)
+        )
+        for frame in frames:
+            frame.decode()
+        legacy = "-"
+        if size <= options.legacy_limit:
+            legacy_elapsed, legacy_frames = measure(
+                lambda: legacy_encode_message(message, header, options.max_size)
+            )
+            if legacy_frames != frames:
+                raise AssertionError("les deux découpages diffèrent")
+            legacy = f"{legacy_elapsed * 1e3:.0f} ms"
+        throughput = len(message.encode()) / MEGABYTE / elapsed
+        print(
+            f"{size:>6g}Mo{len(frames):>10}{legacy:>12}"
+            f"{elapsed * 1e3:>9.0f} ms{throughput:>8.0f} Mo/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# Journal persistant des messages (tchat.store): débit d'écriture soutenu puis
+# latence des requêtes par numéro, par période et par auteur sur le journal
+# écrit. Avec --cold, le cache des fichiers est vidé avant les requêtes.
+#   python -m bench.store [--size GO] [--fsync always|never|SECONDES]
+#       [--message-size OCTETS] [--authors N] [--rooms N] [--queries N]
+#       [--dir RÉPERTOIRE] [--cold]
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from tchat.metrics import Histogram, format_histogram
+from tchat.store import RECORD, MessageStore, StoreConfig, parse_fsync
+
+
+GIGABYTE = 1 << 30
+MEGABYTE = 1 << 20
+# Messages queued and not written yet before the producer waits for the writer
+MAX_PENDING = 100_000
+# One append out of SAMPLE_EVERY is timed
+SAMPLE_EVERY = 64
+# Messages per second of the simulated chat, for the timestamps
+MESSAGE_RATE = 1000
+
+
+def write_log(
+    store: MessageStore, count: int, options: argparse.Namespace, start_time: float
+):
+    rng = random.Random(1)
+    text = "Un message du tchat, avec des accents: é à ç. " * (
+        options.message_size // 48 + 1
+    )
+    append_seconds = Histogram("append", "Durée d'un append()", unit=1e-9)
+    store.start()
+    start = time.perf_counter()
+    for index in range(count):
+        room = f"salon{rng.randrange(options.rooms)}"
+        author = f"user{rng.randrange(options.authors)}"
+        body = text[: rng.randrange(options.message_size // 2, options.message_size)]
+        stamp = start_time + index / MESSAGE_RATE
+        if index % SAMPLE_EVERY:
+            store.append(room, author, body, stamp)
+        else:
+            before = time.perf_counter()
+            store.append(room, author, body, stamp)
+            append_seconds.record(time.perf_counter() - before)
+            if store.records.qsize() > MAX_PENDING:
+                while store.records.qsize() > MAX_PENDING // 2:
+                    time.sleep(0.001)
+    produced = time.perf_counter()
+    store.close()
+    elapsed = time.perf_counter() - start
+    print(f"append(): {format_histogram(append_seconds)}")
+    print(
+        f"écriture: {store.written} messages, {store.written_bytes / MEGABYTE:.0f} Mo "
+        f"en {elapsed:.1f} s ({produced - start:.1f} s pour les produire), "
+        f"{store.written_bytes / MEGABYTE / elapsed:.0f} Mo/s, "
+        f"{store.written / elapsed:.0f} messages/s"
+    )
+
+
+def drop_cache(directory: str):
+    for name in os.listdir(directory):
+        fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def query_log(config: StoreConfig, options: argparse.Namespace, start_time: float):
+    start = time.perf_counter()
+    store = MessageStore(config)
+    print(
+        f"ouverture: {(time.perf_counter() - start) * 1e3:.1f} ms, "
+        f"{len(store.segments)} segments, {store.last_seq} messages"
+    )
+    rng = random.Random(2)
+    last_seq = store.last_seq
+    duration = last_seq / MESSAGE_RATE
+    queries = {
+        "numéro": lambda: store.get(rng.randint(1, last_seq)),
+        "période, 100 messages": lambda: store.since_time(
+            start_time + rng.uniform(0, duration)
+        ),
+        "période d'un salon": lambda: store.since_time(
+            start_time + rng.uniform(0, duration),
+            f"salon{rng.randrange(options.rooms)}",
+        ),
+        # A room with no message: only its own positions are looked at
+        "salon sans message": lambda: store.since_time(
+            start_time + rng.uniform(0, duration), "salon-vide"
+        ),
+        "auteur, 20 messages": lambda: store.by_author(
+            f"user{rng.randrange(options.authors)}", 20
+        ),
+    }
+    for name, query in queries.items():
+        latency = Histogram(name, name)
+        for _ in range(options.queries):
+            before = time.perf_counter()
+            query()
+            latency.record(time.perf_counter() - before)
+        print(f"{name}: {format_histogram(latency)}")
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Journal persistant des messages")
+    parser.add_argument("--size", type=float, default=1, help="taille en Go")
+    parser.add_argument("--fsync", default="1", help="always, never ou secondes")
+    parser.add_argument("--message-size", type=int, default=120)
+    parser.add_argument("--authors", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--dir", help="répertoire du journal, temporaire par défaut")
+    parser.add_argument(
+        "--cold", action="store_true", help="vide le cache avant les requêtes"
+    )
+    options = parser.parse_args()
+
+    directory = options.dir or tempfile.mkdtemp(prefix="tchat-store-")
+    config = StoreConfig(directory, parse_fsync(options.fsync))
+    # Average record: header, "salonN", "userN" and 3/4 of message_size
+    record_size = RECORD.size + 16 + options.message_size * 3 // 4
+    count = int(options.size * GIGABYTE / record_size)
+    start_time = time.time() - count / MESSAGE_RATE
+    print(f"{count} messages dans {directory}, fsync {options.fsync}")
+    try:
+        write_log(MessageStore(config), count, options, start_time)
+        if options.cold:
+            drop_cache(directory)
+        query_log(config, options, start_time)
+    finally:
+        if not options.dir:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# Débit du serveur 51-asyncio.py: streams et tâches par message contre le
+# mode --protocol (asyncio.BufferedProtocol), et avec -w plusieurs processus.
+#   python -m bench.throughput [-c CLIENTS] [-m MESSAGES] [-w PROCESSUS]
+import argparse
+import asyncio
+import sys
+import time
+from typing import Awaitable, Callable
+
+from bench._util import (
+    free_port,
+    process_cpu_time,
+    raise_fd_limit,
+    start_process,
+    stop_process,
+)
+
+
+Connect = Callable[[], Awaitable[tuple[asyncio.StreamReader, asyncio.StreamWriter]]]
+
+
+def tcp_connect(port: int) -> Connect:
+    return lambda: asyncio.open_connection("127.0.0.1", port)
+
+
+async def login(
+    connect: Connect, name: str
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    reader, writer = await connect()
+    writer.write(f"/pseudo {name}\n".encode())
+    await writer.drain()
+    await reader.readuntil(f"Bienvenue {name}\n".encode())
+    return reader, writer
+
+
+async def run_client(
+    index: int,
+    connect: Connect,
+    message_count: int,
+    expected: int,
+    ready: asyncio.Barrier,
+    payload: bytes,
+) -> int:
+    reader, writer = await login(connect, f"u{index}")
+    await ready.wait()
+
+    async def send():
+        for _ in range(message_count):
+            writer.write(payload)
+            await writer.drain()
+
+    sender = asyncio.create_task(send())
+    received = 0
+    try:
+        while received < expected:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.startswith(b"u") and b"> " in line:
+                received += 1
+    finally:
+        await sender
+        writer.close()
+    return received
+
+
+async def run_load(
+    connect: Connect, client_count: int, message_count: int, size: int
+) -> tuple[int, float]:
+    payload = b"x" * (size - 1) + b"\n"
+    expected = (client_count - 1) * message_count
+    ready = asyncio.Barrier(client_count + 1)
+    clients = [
+        asyncio.create_task(
+            run_client(index, connect, message_count, expected, ready, payload)
+        )
+        for index in range(client_count)
+    ]
+    await ready.wait()
+    start = time.perf_counter()
+    received = await asyncio.wait_for(asyncio.gather(*clients), 120)
+    return sum(received), time.perf_counter() - start
+
+
+def measure(args: list[str], client_count: int, message_count: int, size: int):
+    port = free_port()
+    server = start_process(args + ["-h", "127.0.0.1", "-p", str(port)], port)
+    try:
+        cpu_start = process_cpu_time(server.pid)
+        delivered, elapsed = asyncio.run(
+            run_load(tcp_connect(port), client_count, message_count, size)
+        )
+        cpu_used = process_cpu_time(server.pid) - cpu_start
+    finally:
+        stop_process(server)
+    return delivered, elapsed, cpu_used
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Débit de 51-asyncio.py")
+    parser.add_argument("-c", "--clients", type=int, default=20)
+    parser.add_argument("-m", "--messages", type=int, default=500)
+    parser.add_argument("-s", "--size", type=int, default=64)
+    parser.add_argument("-w", "--workers", type=int, default=0)
+    options = parser.parse_args()
+    raise_fd_limit()
+
+    # The clients flood on purpose: no rate limit
+    server = [sys.executable, "51-asyncio.py", "-s"]
+    server += ["--rate-limit", "0", "--room-rate-limit", "0"]
+    modes = {"streams": server, "protocol": server + ["--protocol"]}
+    if options.workers > 1:
+        modes[f"protocol x{options.workers}"] = modes["protocol"] + [
+            "--workers",
+            str(options.workers),
+        ]
+    print(
+        f"{options.clients} clients, {options.messages} messages de "
+        f"{options.size} octets chacun"
+    )
+    print(f"{'mode':<14}{'livrés':>10}{'durée':>10}{'msg/s':>12}{'CPU µs/msg':>12}")
+    for name, args in modes.items():
+        delivered, elapsed, cpu = measure(
+            args, options.clients, options.messages, options.size
+        )
+        print(
+            f"{name:<14}{delivered:>10}{elapsed:>9.2f}s"
+            f"{delivered / elapsed:>12.0f}{cpu / max(delivered, 1) * 1e6:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
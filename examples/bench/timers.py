@@ -0,0 +1,94 @@
+# Minuteries de 100 000 connexions: roue de minuteries (tchat.timers) contre
+# un loop.call_later() par connexion. Coût de la programmation, de
+# l'annulation et du déclenchement, et mémoire par minuterie.
+#   python -m bench.timers [-n CONNEXIONS]
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+from typing import Callable, TypeVar
+
+from tchat.timers import Timer, TimerWheel
+
+
+T = TypeVar("T")
+
+
+def measure(function: Callable[[], T]) -> tuple[float, int, T]:
+    # Timed without tracemalloc, which slows allocations down, then run again
+    # for the memory
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, memory, result
+
+
+def report(name: str, count: int, elapsed: float, memory: int | None = None):
+    line = f"{name:<32}{elapsed / count * 1e9:>8.0f} ns"
+    if memory is not None:
+        line += f"{memory / count:>8.0f} octets"
+    print(line)
+
+
+def bench_wheel(count: int, delays: list[float]):
+    now = [1000.0]
+    fired: list[int] = []
+
+    def schedule_all() -> tuple[TimerWheel, list[Timer]]:
+        wheel = TimerWheel(clock=lambda: now[0])
+        timers = [
+            wheel.schedule(delay, fired.append, index)
+            for index, delay in enumerate(delays)
+        ]
+        return wheel, timers
+
+    elapsed, memory, (wheel, timers) = measure(schedule_all)
+    report("roue: programmer", count, elapsed, memory)
+    start = time.perf_counter()
+    for timer in timers[::2]:
+        timer.cancel()
+    report("roue: annuler", count // 2, time.perf_counter() - start)
+    start = time.perf_counter()
+    ticks = 0
+    while len(wheel):
+        now[0] += wheel.tick
+        wheel.advance()
+        ticks += 1
+    report("roue: déclencher", len(fired), time.perf_counter() - start)
+    print(f"  {ticks} tops, {len(fired)} minuteries déclenchées")
+
+
+def bench_call_later(count: int, delays: list[float]):
+    loop = asyncio.new_event_loop()
+    try:
+        elapsed, memory, handles = measure(
+            lambda: [loop.call_later(delay, lambda: None) for delay in delays]
+        )
+        report("call_later: programmer", count, elapsed, memory)
+        start = time.perf_counter()
+        for handle in handles[::2]:
+            handle.cancel()
+        report("call_later: annuler", count // 2, time.perf_counter() - start)
+    finally:
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minuteries des connexions")
+    parser.add_argument("-n", "--connections", type=int, default=100_000)
+    options = parser.parse_args()
+
+    rng = random.Random(1)
+    delays = [rng.uniform(1, 90) for _ in range(options.connections)]
+    print(f"{options.connections} minuteries entre 1 et 90 s")
+    bench_wheel(options.connections, delays)
+    bench_call_later(options.connections, delays)
+
+
+if __name__ == "__main__":
+    main()
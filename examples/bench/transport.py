@@ -0,0 +1,150 @@
+# Transports locaux: socket Unix contre TCP sur la boucle locale, d'abord seuls
+# (aller-retour et débit entre deux sockets), puis à travers 51-asyncio.py qui
+# écoute sur les deux à la fois (--listen): latence d'un message relayé d'un
+# client à un autre, débit d'un salon et CPU du serveur.
+#   python -m bench.transport [-n ALLERS-RETOURS] [-r RELAIS] [-c CLIENTS]
+#                             [-m MESSAGES]
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+from bench._util import (
+    free_port,
+    process_cpu_time,
+    raise_fd_limit,
+    start_process,
+    stop_process,
+)
+from bench.throughput import Connect, login, run_load, tcp_connect
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def socket_pair(transport: str) -> tuple[socket.socket, socket.socket]:
+    if transport == "unix":
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    for sock in (client, server):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client, server
+
+
+def receive_exactly(sock: socket.socket, size: int):
+    while size:
+        size -= len(sock.recv(size))
+
+
+def bench_sockets(transport: str, round_trips: int, size: int, total: int):
+    # A single thread on both ends: the cost of the kernel only, no scheduling
+    client, server = socket_pair(transport)
+    with client, server:
+        message = b"x" * size
+        start = time.perf_counter()
+        for _ in range(round_trips):
+            client.sendall(message)
+            receive_exactly(server, size)
+            server.sendall(message)
+            receive_exactly(client, size)
+        round_trip = (time.perf_counter() - start) / round_trips
+        chunk = b"x" * CHUNK_SIZE
+        start = time.perf_counter()
+        for _ in range(total // CHUNK_SIZE):
+            client.sendall(chunk)
+            receive_exactly(server, CHUNK_SIZE)
+        rate = total / (time.perf_counter() - start)
+    print(f"{transport:<10}{round_trip * 1e6:>12.1f}{rate / 2**20:>14.0f}")
+
+
+async def relay_latency(connect: Connect, count: int, size: int) -> list[float]:
+    # One message at a time from a client to another, through the server
+    _, sender = await login(connect, "emetteur")
+    reader, writer = await login(connect, "recepteur")
+    payload = b"x" * (size - 1) + b"\n"
+    delays = []
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            sender.write(payload)
+            while not (await reader.readline()).startswith(b"emetteur> "):
+                pass
+            delays.append(time.perf_counter() - start)
+    finally:
+        sender.close()
+        writer.close()
+    return delays
+
+
+def bench_server(options: argparse.Namespace, protocol: bool):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tchat.sock")
+        # The clients flood on purpose: no rate limit
+        args = [sys.executable, "51-asyncio.py", "-s"]
+        args += ["--listen", f"127.0.0.1:{port}", "--listen", f"unix:{path}"]
+        args += ["--rate-limit", "0", "--room-rate-limit", "0"]
+        if protocol:
+            args.append("--protocol")
+        server = start_process(args, port)
+        connects: dict[str, Connect] = {
+            "tcp": tcp_connect(port),
+            "unix": lambda: asyncio.open_unix_connection(path),
+        }
+        try:
+            for transport, connect in connects.items():
+                delays = asyncio.run(
+                    relay_latency(connect, options.relays, options.size)
+                )
+                p50, p99 = statistics.quantiles(delays, n=100)[49::49]
+                cpu_start = process_cpu_time(server.pid)
+                delivered, elapsed = asyncio.run(
+                    run_load(connect, options.clients, options.messages, options.size)
+                )
+                cpu = process_cpu_time(server.pid) - cpu_start
+                cpu_per_message = cpu / max(delivered, 1)
+                print(
+                    f"{transport:<10}{p50 * 1e6:>10.0f}{p99 * 1e6:>10.0f}"
+                    f"{delivered / elapsed:>12.0f}{cpu_per_message * 1e6:>12.1f}"
+                )
+        finally:
+            stop_process(server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket Unix contre TCP local")
+    parser.add_argument("-n", "--round-trips", type=int, default=20_000)
+    parser.add_argument("-r", "--relays", type=int, default=2000)
+    parser.add_argument("-c", "--clients", type=int, default=20)
+    parser.add_argument("-m", "--messages", type=int, default=500)
+    parser.add_argument("-s", "--size", type=int, default=64)
+    options = parser.parse_args()
+    raise_fd_limit()
+
+    print(
+        f"deux sockets, {options.round_trips} allers-retours de "
+        f"{options.size} octets"
+    )
+    print(f"{'transport':<10}{'µs/a-r':>12}{'Mo/s':>14}")
+    for transport in ("tcp", "unix"):
+        bench_sockets(transport, options.round_trips, options.size, 256 * 2**20)
+    for protocol in (False, True):
+        mode = "--protocol" if protocol else "streams"
+        print(
+            f"51-asyncio.py {mode}: {options.relays} messages relayés un à un "
+            f"(µs), puis {options.clients} clients x {options.messages} messages"
+        )
+        print(
+            f"{'transport':<10}{'p50':>10}{'p99':>10}{'msg/s':>12}{'CPU µs/msg':>12}"
+        )
+        bench_server(options, protocol)
+
+
+if __name__ == "__main__":
+    main()
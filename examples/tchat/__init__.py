@@ -0,0 +1 @@
+# Briques communes aux serveurs de tchat 50-tchat.py et 51-asyncio.py
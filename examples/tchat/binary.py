@@ -0,0 +1,269 @@
+import asyncio
+from dataclasses import dataclass
+import struct
+from typing import TYPE_CHECKING, Container
+
+from tchat.fanout import Frames
+from tchat.framing import (
+    FRAME_MAX_SIZE,
+    RECEIVE_BUFFER_SIZE,
+    FrameDecoder,
+    FrameError,
+)
+
+if TYPE_CHECKING:
+    from tchat.compress import InflatingReader
+
+
+# Every frame: type, sequence number, sender id, room id, payload size, then
+# the payload. Ids are interned by the server, 0 is nobody and no room.
+HEADER = struct.Struct("!BIIII")
+
+# Server: lines of text shown as is (notices, answers to the commands,
+# messages relayed by the other workers), with `seq` and `room` for a message
+TEXT = 1
+# Chat message of `sender` in `room`. From a client: sent to its current
+# room, `room` and `sender` are ignored
+MESSAGE = 2
+# Server: private message of `sender`
+PRIVATE = 3
+# Client: a command line, "/join salon"
+COMMAND = 4
+# Server: `sender` is the nickname in the payload, `room` the room
+NAME = 5
+ROOM = 6
+PING = 7
+PONG = 8
+CLIENT_FRAMES = frozenset((MESSAGE, COMMAND, PONG))
+
+# Line of a text client asking to switch, and answer of the server: both
+# ways, the connection is binary from the next byte on
+NEGOTIATE = b"/binary\n"
+ACCEPTED = b"/binary 1\n"
+
+
+def encode_frame(
+    frame_type: int, payload: bytes = b"", seq: int = 0, sender: int = 0, room: int = 0
+) -> bytes:
+    return HEADER.pack(frame_type, seq, sender, room, len(payload)) + payload
+
+
+BINARY_PING = encode_frame(PING)
+BINARY_PONG = encode_frame(PONG)
+
+
+def encode_text(frames: Frames) -> Frames:
+    # Text frames for a binary client, the same bytes behind a TEXT header
+    return tuple(encode_frame(TEXT, frame) for frame in frames)
+
+
+class BinaryDecoder(FrameDecoder):
+    """Binary frames of a stream, iterating yields their payloads.
+
+    The header fields of the last frame yielded are in `frame_type`, `seq`,
+    `sender` and `room`: no object is built per frame besides the payload.
+    """
+
+    overhead_size = HEADER.size
+
+    def __init__(
+        self,
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+        max_frame_size: int = FRAME_MAX_SIZE,
+    ):
+        super().__init__(buffer_size, max_frame_size)
+        self.frame_type = self.seq = self.sender = self.room = 0
+
+    @classmethod
+    def following(cls, decoder: FrameDecoder) -> "BinaryDecoder":
+        # Takes over the bytes `decoder` received after the end of the text
+        binary = cls(len(decoder.buffer), decoder.max_frame_size)
+        binary.feed(decoder.view[decoder.start : decoder.end])
+        decoder.start = decoder.end
+        return binary
+
+    def next_frame(self) -> bytes | None:
+        if self.end - self.start < HEADER.size:
+            return None
+        frame_type, seq, sender, room, size = HEADER.unpack_from(
+            self.buffer, self.start
+        )
+        if size > self.max_frame_size:
+            raise FrameError(f"Trame de plus de {self.max_frame_size} octets")
+        frame_start = self.start + HEADER.size
+        if self.end - frame_start < size:
+            return None
+        self.frame_type, self.seq = frame_type, seq
+        self.sender, self.room = sender, room
+        self.start = frame_start + size
+        return bytes(self.view[frame_start : self.start])
+
+
+async def read_frame(
+    reader: "asyncio.StreamReader | InflatingReader",
+    max_frame_size: int = FRAME_MAX_SIZE,
+) -> tuple[tuple[int, int, int, int, int], bytes]:
+    # Header fields and payload of the next frame of a stream
+    header = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if header[4] > max_frame_size:
+        raise FrameError(f"Trame de plus de {max_frame_size} octets")
+    return header, await reader.readexactly(header[4])
+
+
+# The definition of id 0, known to every session
+NO_DEFINITION = b""
+# Interned names before the first collection of those no longer in use
+COLLECT_MIN = 1024
+
+
+class Interner:
+    """Small ids of nicknames or rooms, and the frame defining each of them.
+
+    Only the names found in `in_use` are kept: once the table doubled since
+    the last collection, the ids of the others are freed and reused. A
+    message keeps the definitions of its ids and a session the ones it was
+    sent, so a client is told again what an id means before it changed.
+    Without `in_use` the table keeps every name.
+    """
+
+    def __init__(self, frame_type: int, in_use: Container[str] | None = None):
+        self.frame_type = frame_type
+        self.in_use = in_use
+        self.ids: dict[str, int] = {}
+        self.definitions: list[bytes] = [NO_DEFINITION]
+        self.free: list[int] = []
+        self.collect_at = COLLECT_MIN
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def intern(self, name: str) -> int:
+        index = self.ids.get(name)
+        if index is None:
+            if len(self.ids) >= self.collect_at:
+                self.collect()
+            index = self.free.pop() if self.free else len(self.definitions)
+            if index == len(self.definitions):
+                self.definitions.append(NO_DEFINITION)
+            self.ids[name] = index
+            self.definitions[index] = self._encode(index, name)
+        return index
+
+    def collect(self):
+        if self.in_use is not None:
+            for name, index in list(self.ids.items()):
+                if name not in self.in_use:
+                    del self.ids[name]
+                    self.free.append(index)
+        self.collect_at = max(COLLECT_MIN, 2 * len(self.ids))
+
+    def define(self, index: int, name: str) -> bytes:
+        # The definition of `index` as `name` given by another process, the
+        # object of the table when it says the same
+        while len(self.definitions) <= index:
+            self.definitions.append(NO_DEFINITION)
+        definition = self.definitions[index]
+        if index and defined_name(definition) != name:
+            definition = self.definitions[index] = self._encode(index, name)
+        return definition
+
+    def restore(self, ids: dict[str, int], free: list[int]):
+        # The table of another process, see define()
+        for name, index in ids.items():
+            self.define(index, name)
+        self.ids, self.free = ids, free
+        self.collect_at = max(COLLECT_MIN, 2 * len(ids))
+
+    def _encode(self, index: int, name: str) -> bytes:
+        if self.frame_type == NAME:
+            return encode_frame(NAME, name.encode(), sender=index)
+        return encode_frame(ROOM, name.encode(), room=index)
+
+
+def defined_name(definition: bytes) -> str:
+    # Name given by a NAME or ROOM frame
+    return definition[HEADER.size :].decode()
+
+
+@dataclass(slots=True, eq=False)
+class BinaryMessage:
+    # Frames of a message for the binary clients, the ids they must know and
+    # their definitions
+    sender: int
+    room: int
+    frames: Frames
+    sender_definition: bytes = NO_DEFINITION
+    room_definition: bytes = NO_DEFINITION
+
+
+class BinaryCodec:
+    """Binary frames of the messages of a server, and its interned ids.
+
+    A message is encoded once and its frames are shared by every binary
+    recipient, like the text frames of tchat.fanout; only the definition of
+    an id a client does not know is sent to it before. Nicknames and rooms
+    are interned while `names_in_use` and `rooms_in_use` hold them.
+    """
+
+    def __init__(
+        self,
+        names_in_use: Container[str] | None = None,
+        rooms_in_use: Container[str] | None = None,
+    ):
+        self.names = Interner(NAME, names_in_use)
+        self.rooms = Interner(ROOM, rooms_in_use)
+
+    def message(self, seq: int, sender: str, room: str, text: str) -> BinaryMessage:
+        sender_id = self.names.intern(sender)
+        room_id = self.rooms.intern(room)
+        frame = encode_frame(MESSAGE, text.rstrip().encode(), seq, sender_id, room_id)
+        return BinaryMessage(
+            sender_id,
+            room_id,
+            (frame,),
+            self.names.definitions[sender_id],
+            self.rooms.definitions[room_id],
+        )
+
+    def private(self, sender: str, text: str) -> BinaryMessage:
+        sender_id = self.names.intern(sender)
+        frame = encode_frame(PRIVATE, text.rstrip().encode(), sender=sender_id)
+        return BinaryMessage(sender_id, 0, (frame,), self.names.definitions[sender_id])
+
+    def relayed(self, seq: int, room: str, data: bytes) -> BinaryMessage:
+        # Room message already encoded as text, by another worker
+        room_id = self.rooms.intern(room)
+        frame = encode_frame(TEXT, data, seq, room=room_id)
+        return BinaryMessage(
+            0, room_id, (frame,), room_definition=self.rooms.definitions[room_id]
+        )
+
+    def session(self) -> "BinarySession":
+        return BinarySession()
+
+
+class BinarySession:
+    # Ids a binary client knows and the definitions it was sent for them
+
+    __slots__ = ("names", "rooms")
+
+    def __init__(self):
+        self.names: dict[int, bytes] = {0: NO_DEFINITION}
+        self.rooms: dict[int, bytes] = {0: NO_DEFINITION}
+
+    def message_frames(self, message: BinaryMessage) -> Frames:
+        sender, room = message.sender, message.room
+        sender_definition = message.sender_definition
+        room_definition = message.room_definition
+        known_sender = self.names.get(sender) is sender_definition
+        known_room = self.rooms.get(room) is room_definition
+        if known_sender and known_room:
+            return message.frames
+        definitions: list[bytes] = []
+        if not known_sender:
+            self.names[sender] = sender_definition
+            definitions.append(sender_definition)
+        if not known_room:
+            self.rooms[room] = room_definition
+            definitions.append(room_definition)
+        return (*definitions, *message.frames)
@@ -0,0 +1,315 @@
+import asyncio
+import os
+import signal
+import socket
+import struct
+from typing import Callable, Iterable, Iterator
+
+from tchat.framing import (
+    FRAME_MAX_SIZE,
+    FrameError,
+    LengthPrefixedDecoder,
+    encode_length_prefixed,
+)
+from tchat.logs import log
+
+
+# Bus messages, each one is a length prefixed frame starting with its type
+BROADCAST = b"B"  # + space separated rooms + NUL + wire frames for their members
+MESSAGE = b"M"  # + room + NUL + wire frames of a chat message, kept in history
+CLAIM = b"C"  # + request id + nickname + NUL + previous nickname
+RELEASE = b"R"  # + nickname
+PRIVATE = b"P"  # + request id + nickname + NUL + wire frames
+DELIVER = b"D"  # + nickname + NUL + wire frames, sent by the hub to the owner
+ANSWER = b"A"  # + request id + 1 if the nickname was granted/found else 0
+
+REQUEST_ID = struct.Struct("!I")
+# Type, request id and separators of a message, besides its names and data
+MESSAGE_OVERHEAD = 1 + REQUEST_ID.size + 1
+
+AnswerCallback = Callable[[bool], None]
+
+
+class LocalBus:
+    """Chat state shared by the workers of a server, here a single process.
+
+    Broadcasts are delivered locally by the server itself, the bus only has to
+    forward them to other processes. Nickname claims are answered through a
+    callback since a worker has to ask the other processes first.
+    """
+
+    def __init__(self):
+        self.names: set[str] = set()
+        self.on_broadcast: Callable[[list[str], bytes], None] = lambda rooms, data: None
+        self.on_message: Callable[[str, bytes], None] = lambda room, data: None
+        self.on_private: Callable[[str, bytes], None] = lambda name, data: None
+
+    def fits(self, names: Iterable[str], data: bytes) -> bool:
+        # Whether the bus can carry `data` for these rooms or this nickname
+        return True
+
+    def publish(self, rooms: Iterable[str], data: bytes):
+        pass
+
+    def publish_message(self, room: str, data: bytes):
+        pass
+
+    def send_private(self, name: str, data: bytes, callback: AnswerCallback):
+        # Only called for nicknames unknown to this process
+        callback(False)
+
+    def claim_name(self, name: str, previous: str | None, callback: AnswerCallback):
+        # A client already named `name` keeps it, as in 50-tchat.py
+        granted = name == previous or name not in self.names
+        if granted:
+            self.release_name(previous)
+            self.names.add(name)
+        callback(granted)
+
+    def release_name(self, name: str | None):
+        if name is not None:
+            self.names.discard(name)
+
+    async def close(self):
+        pass
+
+
+class WorkerBus(LocalBus, asyncio.BufferedProtocol):
+    # Worker side of the bus, talks to the BusHub of the parent process
+
+    def __init__(self, max_frame_size: int = FRAME_MAX_SIZE):
+        super().__init__()
+        self.decoder = LengthPrefixedDecoder(max_frame_size=max_frame_size)
+        self.transport: asyncio.Transport | None = None
+        self.pending_requests: dict[int, AnswerCallback] = {}
+        self.claiming: set[str] = set()
+        self.next_request_id = 0
+
+    @classmethod
+    async def connect(
+        cls, sock: socket.socket, max_frame_size: int = FRAME_MAX_SIZE
+    ) -> "WorkerBus":
+        loop = asyncio.get_running_loop()
+        _, bus = await loop.create_unix_connection(
+            lambda: cls(max_frame_size), sock=sock
+        )
+        return bus
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        assert isinstance(transport, asyncio.Transport)
+        self.transport = transport
+
+    def connection_lost(self, exc: Exception | None):
+        # Without the hub the chat is split, better stop this worker
+        log.error("Bus inter-processus perdu")
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        self.decoder.buffer_updated(nbytes)
+        for message in decode_messages(self.decoder):
+            message_type, payload = message[:1], message[1:]
+            if message_type == BROADCAST:
+                rooms, data = payload.split(b"\0", 1)
+                self.on_broadcast(rooms.decode().split(" "), data)
+            elif message_type == MESSAGE:
+                room, data = payload.split(b"\0", 1)
+                self.on_message(room.decode(), data)
+            elif message_type == DELIVER:
+                name, data = payload.split(b"\0", 1)
+                self.on_private(name.decode(), data)
+            elif message_type == ANSWER:
+                (request_id,) = REQUEST_ID.unpack_from(payload)
+                callback = self.pending_requests.pop(request_id)
+                callback(payload[REQUEST_ID.size :] == b"1")
+
+    def fits(self, names: Iterable[str], data: bytes) -> bool:
+        size = sum(len(name.encode()) + 1 for name in names) + len(data)
+        return size + MESSAGE_OVERHEAD <= self.decoder.max_frame_size
+
+    def send(self, message_type: bytes, payload: bytes):
+        assert self.transport
+        if len(payload) + 1 > self.decoder.max_frame_size:
+            # The hub would drop it: fits() is checked before, where the
+            # sender can be told
+            log.warning("Message de %d octets trop long pour le bus", len(payload))
+            return
+        self.transport.write(encode_length_prefixed(message_type + payload))
+
+    def request(self, message_type: bytes, payload: bytes, callback: AnswerCallback):
+        self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+        self.pending_requests[self.next_request_id] = callback
+        self.send(message_type, REQUEST_ID.pack(self.next_request_id) + payload)
+
+    def publish(self, rooms: Iterable[str], data: bytes):
+        # Room names never contain spaces, they come from str.split()
+        self.send(BROADCAST, " ".join(rooms).encode() + b"\0" + data)
+
+    def publish_message(self, room: str, data: bytes):
+        self.send(MESSAGE, room.encode() + b"\0" + data)
+
+    def send_private(self, name: str, data: bytes, callback: AnswerCallback):
+        self.request(PRIVATE, name.encode() + b"\0" + data, callback)
+
+    def claim_name(self, name: str, previous: str | None, callback: AnswerCallback):
+        # The hub knows which worker owns a nickname, not which client: clients
+        # of this worker are checked here.
+        if name == previous:
+            callback(True)
+            return
+        if name in self.names or name in self.claiming:
+            callback(False)
+            return
+
+        def claimed(granted: bool):
+            self.claiming.discard(name)
+            if granted:
+                self.names.discard(previous)  # type: ignore [arg-type]
+                self.names.add(name)
+            callback(granted)
+
+        self.claiming.add(name)
+        self.request(CLAIM, f"{name}\0{previous or ''}".encode(), claimed)
+
+    def release_name(self, name: str | None):
+        if name is not None:
+            self.names.discard(name)
+            self.send(RELEASE, name.encode())
+
+    async def close(self):
+        if self.transport:
+            self.transport.close()
+
+
+class HubConnection(asyncio.BufferedProtocol):
+    def __init__(self, hub: "BusHub"):
+        self.hub = hub
+        self.decoder = LengthPrefixedDecoder(max_frame_size=hub.max_frame_size)
+        self.transport: asyncio.Transport | None = None
+        self.names: set[str] = set()
+
+    def connection_made(self, transport: asyncio.BaseTransport):
+        assert isinstance(transport, asyncio.Transport)
+        self.transport = transport
+        self.hub.workers.append(self)
+
+    def connection_lost(self, exc: Exception | None):
+        self.hub.workers.remove(self)
+        for name in self.names:
+            self.hub.owners.pop(name, None)
+        if not self.hub.workers:
+            self.hub.stopped.set()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        self.decoder.buffer_updated(nbytes)
+        for message in decode_messages(self.decoder):
+            self.hub.dispatch(self, message)
+
+    def send(self, message: bytes):
+        assert self.transport
+        self.transport.write(message)
+
+
+class BusHub:
+    """Parent side of the bus: relays broadcasts and owns the nicknames."""
+
+    def __init__(self, max_frame_size: int = FRAME_MAX_SIZE):
+        self.max_frame_size = max_frame_size
+        self.workers: list[HubConnection] = []
+        self.owners: dict[str, HubConnection] = {}
+        self.stopped = asyncio.Event()
+
+    async def attach(self, sock: socket.socket):
+        loop = asyncio.get_running_loop()
+        await loop.create_unix_connection(lambda: HubConnection(self), sock=sock)
+
+    def dispatch(self, origin: HubConnection, message: bytes):
+        message_type = message[:1]
+        if message_type == BROADCAST or message_type == MESSAGE:
+            # Built once, written as is to every other worker
+            frame = encode_length_prefixed(message)
+            for worker in self.workers:
+                if worker is not origin:
+                    worker.send(frame)
+        elif message_type == CLAIM:
+            request_id = message[1 : 1 + REQUEST_ID.size]
+            name, previous = message[1 + REQUEST_ID.size :].decode().split("\0")
+            granted = self.owners.setdefault(name, origin) is origin
+            if granted and previous and self.owners.get(previous) is origin:
+                del self.owners[previous]
+                origin.names.discard(previous)
+            if granted:
+                origin.names.add(name)
+            answer = ANSWER + request_id + (b"1" if granted else b"0")
+            origin.send(encode_length_prefixed(answer))
+        elif message_type == PRIVATE:
+            request_id = message[1 : 1 + REQUEST_ID.size]
+            name_and_data = message[1 + REQUEST_ID.size :]
+            name = name_and_data.split(b"\0", 1)[0].decode()
+            owner = self.owners.get(name)
+            if owner is not None:
+                owner.send(encode_length_prefixed(DELIVER + name_and_data))
+            answer = ANSWER + request_id + (b"0" if owner is None else b"1")
+            origin.send(encode_length_prefixed(answer))
+        elif message_type == RELEASE:
+            name = message[1:].decode()
+            if self.owners.get(name) is origin:
+                del self.owners[name]
+                origin.names.discard(name)
+
+
+def decode_messages(decoder: LengthPrefixedDecoder) -> Iterator[bytes]:
+    # A message too large is dropped, not the connection: a worker stops
+    # without it, with every client it serves
+    while True:
+        try:
+            yield from decoder
+            return
+        except FrameError as error:
+            log.error("Message du bus ignoré: %s", error)
+
+
+def fork_workers(
+    count: int, worker_main: Callable[[int, socket.socket], None]
+) -> list[tuple[int, socket.socket]]:
+    # Each worker gets one end of a socket pair, the parent keeps the other
+    workers = []
+    for index in range(count):
+        parent_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            for _, other_end in workers:
+                other_end.close()
+            try:
+                worker_main(index, worker_end)
+            finally:
+                os._exit(0)
+        worker_end.close()
+        workers.append((pid, parent_end))
+    return workers
+
+
+def stop_workers(workers: list[tuple[int, socket.socket]]):
+    for pid, _ in workers:
+        try:
+            os.kill(pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
+    for pid, parent_end in workers:
+        os.waitpid(pid, 0)
+        parent_end.close()
+
+
+async def run_hub(
+    sockets: list[socket.socket], max_frame_size: int = FRAME_MAX_SIZE
+):
+    hub = BusHub(max_frame_size)
+    for sock in sockets:
+        await hub.attach(sock)
+    await hub.stopped.wait()
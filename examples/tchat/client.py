@@ -0,0 +1,490 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import random
+from typing import AsyncIterator, Callable, Iterable
+
+from tchat.binary import (
+    ACCEPTED,
+    BINARY_PONG,
+    COMMAND,
+    MESSAGE,
+    NAME,
+    NEGOTIATE,
+    PING,
+    PRIVATE,
+    ROOM,
+    encode_frame,
+    read_frame,
+)
+from tchat.compress import InflatingReader, accepted
+from tchat.framing import FrameError
+from tchat.listen import UNIX_PREFIX
+from tchat.logs import log
+from tchat.rooms import DEFAULT_ROOM
+from tchat.timers import PING_FRAME, PONG_FRAME
+
+
+RECEIVE_LIMIT = 2**16
+# Lines received and not consumed yet, the server is then slowed down by TCP
+RECEIVE_QUEUE_SIZE = 1024
+# Bytes written and not yet accepted by the socket before send() waits
+SEND_HIGH_WATERMARK = 256 * 1024
+# Connections being opened at the same time by a pool
+CONNECT_CONCURRENCY = 50
+
+
+@dataclass
+class Backoff:
+    """Delays between connection attempts: exponential, with full jitter.
+
+    The n-th attempt waits a random delay between 0 and
+    min(`maximum`, `initial` * `multiplier`**n), so that clients dropped by
+    the same server restart spread their reconnections instead of coming
+    back all at once. The first attempt after a drop is jittered as well.
+    """
+
+    initial: float = 0.5
+    maximum: float = 30.0
+    multiplier: float = 2.0
+    # Attempts before giving up, None to retry forever
+    attempts: int | None = None
+
+    def delays(self, rng: random.Random) -> Iterable[float]:
+        attempt = 0
+        while self.attempts is None or attempt < self.attempts:
+            ceiling = min(self.maximum, self.initial * self.multiplier**attempt)
+            yield rng.uniform(0, ceiling)
+            attempt += 1
+
+
+class ChatClient:
+    """Connection to a tchat server, without any terminal.
+
+    `send()` queues a line and returns at once: the lines are written by a
+    task, as many as are queued in one write, without waiting for the answer
+    of the previous ones. Received lines are read with `receive()` or
+    `async for line in client`. When the connection drops, the client
+    reconnects with `backoff` and restores its session, the last /pseudo and
+    the rooms joined with /join; lines sent meanwhile are kept and written
+    once connected. Lines already handed to a dropped connection may be lost.
+
+    The client asks the server to number the room messages (/resume) and
+    keeps the `position` of the last one. After a reconnection, it resumes
+    from there: the room messages missed meanwhile are replayed once, and
+    what the server sends before its answer (welcome, latest messages of the
+    rooms joined again) is skipped.
+
+    With `binary`, each connection switches to the frames of tchat.binary
+    (/binary) before anything else is sent, the server has to know them.
+    Lines are still sent and received as text: they are encoded to frames,
+    and frames shown as the text protocol would show them.
+
+    With `compress`, a level from 1 to 9, each connection then asks the
+    server to compress what it sends (/compress) and inflates it.
+
+    A `host` such as "unix:/run/tchat.sock" connects to the Unix-domain
+    socket of a server on the same machine, `port` is then ignored.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int | str,
+        name: str | None = None,
+        rooms: Iterable[str] = (),
+        backoff: Backoff | None = None,
+        rng: random.Random | None = None,
+        on_status: Callable[[str], object] | None = None,
+        connecting: asyncio.Semaphore | None = None,
+        binary: bool = False,
+        compress: int | None = None,
+    ):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.rooms: dict[str, None] = dict.fromkeys(rooms)
+        self.backoff = backoff or Backoff()
+        self.rng = rng or random.Random()
+        self.on_status = on_status
+        self.connecting = connecting
+        self.binary = binary
+        self.compress = compress
+        self.connected = asyncio.Event()
+        self.connections = 0
+        # Resume token of the last room message, "epoch:sequence"
+        self.position: str | None = None
+        self.pending: deque[bytes] = deque()
+        self.received: asyncio.Queue[str | None] = asyncio.Queue(RECEIVE_QUEUE_SIZE)
+        self._writer: asyncio.StreamWriter | None = None
+        self._has_pending = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        self._resuming = False
+        # The current connection switched to binary frames
+        self._framed = False
+        # Waiting for the answers to /binary and /compress
+        self._negotiating = False
+
+    async def __aenter__(self) -> "ChatClient":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self.messages()
+
+    async def start(self, wait: bool = True):
+        # Connects in the background, `wait` for the first connection
+        self._task = asyncio.create_task(self._run())
+        if wait:
+            connected = asyncio.create_task(self.connected.wait())
+            await asyncio.wait(
+                (connected, self._task), return_when=asyncio.FIRST_COMPLETED
+            )
+            connected.cancel()
+            if self._task.done():
+                self._task.result()
+
+    async def close(self):
+        self._closing = True
+        # Not while negotiating: the server may read frames already
+        if self._writer and self.pending and not self._negotiating:
+            self._writer.writelines(self._take_pending())
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        self.connected.clear()
+        self._end_messages()
+
+    def send(self, line: str):
+        self.pending.append(line.rstrip("\n").encode() + b"\n")
+        self._has_pending.set()
+
+    async def send_and_wait(self, line: str):
+        # send() then wait until the socket accepts more, for producers
+        # faster than the network
+        self.send(line)
+        await self.connected.wait()
+        if self._writer:
+            try:
+                await self._writer.drain()
+            except ConnectionError:
+                pass
+
+    async def receive(self) -> str | None:
+        # Next received line without its "\n", None once the client is closed
+        return await self.received.get()
+
+    async def receive_many(self) -> list[str]:
+        # Every line received so far, waiting for one; empty once closed
+        lines: list[str] = []
+        line = await self.received.get()
+        while line is not None:
+            lines.append(line)
+            if self.received.empty():
+                return lines
+            line = self.received.get_nowait()
+        if lines:
+            self.received.put_nowait(None)  # for the next call
+        return lines
+
+    async def messages(self) -> AsyncIterator[str]:
+        while (line := await self.received.get()) is not None:
+            yield line
+
+    def _take_pending(self) -> list[bytes]:
+        lines = list(self.pending)
+        self.pending.clear()
+        for line in lines:
+            if line.startswith(b"/"):
+                self._remember(line.decode(errors="replace"))
+        return self._encode(lines)
+
+    def _encode(self, lines: list[bytes]) -> list[bytes]:
+        # What is written for `lines`: themselves, or frames once switched
+        if not self._framed:
+            return lines
+        return [encode_line(line) for line in lines]
+
+    def _remember(self, line: str):
+        # Session state replayed after a reconnection, from the lines written
+        command, _, argument = line.strip().partition(" ")
+        argument = argument.strip()
+        if command == "/pseudo" and argument:
+            self.name = argument
+        elif command == "/join" and argument:
+            self.rooms.pop(argument, None)
+            self.rooms[argument] = None
+        elif command == "/leave" and self.rooms:
+            self.rooms.pop(argument or next(reversed(self.rooms)), None)
+
+    def _session(self) -> list[bytes]:
+        lines = [f"/pseudo {self.name}\n".encode()] if self.name else []
+        lines.extend(f"/join {room}\n".encode() for room in self.rooms)
+        # Last: the answer comes after everything the session lines caused
+        self._resuming = self.position is not None
+        lines.append(f"/resume {self.position or ''}".rstrip().encode() + b"\n")
+        return lines
+
+    def _status(self, message: str):
+        log.info(message)
+        if self.on_status:
+            self.on_status(message)
+
+    def _end_messages(self):
+        # The end of the messages must get through, at the cost of a line
+        if self.received.full():
+            self.received.get_nowait()
+        self.received.put_nowait(None)
+
+    async def _run(self):
+        try:
+            while not self._closing:
+                reader, writer = await self._connect()
+                self._writer = writer
+                self.connections += 1
+                self.connected.set()
+                self._status(f"Connecté à {self.host}:{self.port}")
+                session = self._session()
+                writing = None
+                try:
+                    stream = await self._negotiate(reader, writer)
+                    if stream:
+                        writer.writelines(self._encode(session))
+                        writing = asyncio.create_task(self._write_pending(writer))
+                        if self._framed:
+                            await self._read_frames(stream)
+                        else:
+                            await self._read(stream)
+                finally:
+                    if writing:
+                        writing.cancel()
+                    self.connected.clear()
+                    self._writer = None
+                    self._framed = self._negotiating = False
+                    writer.close()
+                if not self._closing:
+                    self._status("Connexion perdue")
+        finally:
+            if not self._closing:
+                self._end_messages()
+
+    async def _connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        # After a drop, even the first attempt waits a jittered delay
+        delays = iter(self.backoff.delays(self.rng))
+        if self.connections:
+            await asyncio.sleep(next(delays, 0))
+        while True:
+            try:
+                if self.connecting:
+                    async with self.connecting:
+                        return await self._open()
+                return await self._open()
+            except OSError as error:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                self._status(f"{error}, nouvelle tentative dans {delay:.1f} s")
+                await asyncio.sleep(delay)
+
+    async def _open(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self.host.startswith(UNIX_PREFIX):
+            path = self.host[len(UNIX_PREFIX) :]
+            return await asyncio.open_unix_connection(path, limit=RECEIVE_LIMIT)
+        return await asyncio.open_connection(self.host, self.port, limit=RECEIVE_LIMIT)
+
+    async def _negotiate(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> "asyncio.StreamReader | InflatingReader | None":
+        # Nothing else is written until the server switched; what to read
+        # from then on, None when the connection was lost meanwhile
+        self._negotiating = True
+        if self.binary:
+            writer.write(NEGOTIATE)
+            if not await self._read(reader, ACCEPTED):
+                return None
+            self._framed = True
+        stream: asyncio.StreamReader | InflatingReader = reader
+        if self.compress:
+            command = f"/compress {self.compress}\n".encode()
+            writer.writelines(self._encode([command]))
+            answer = accepted(self.compress)
+            if self._framed:
+                answered = await self._read_frames(reader, answer)
+            else:
+                answered = await self._read(reader, answer)
+            if not answered:
+                return None
+            stream = InflatingReader(reader, RECEIVE_LIMIT)
+        self._negotiating = False
+        return stream
+
+    async def _read(
+        self,
+        reader: "asyncio.StreamReader | InflatingReader",
+        until: bytes | None = None,
+    ) -> bool:
+        # True once the line `until` is received, an answer when negotiating
+        try:
+            while data := await reader.readline():
+                if data == until:
+                    return True
+                await self._receive_line(data)
+        except (ConnectionError, ValueError):
+            # ValueError: a line longer than RECEIVE_LIMIT, or FrameError
+            pass
+        return False
+
+    async def _receive_line(self, data: bytes):
+        line = data.decode(errors="replace").rstrip("\n")
+        if line.startswith("/seq "):
+            self._update_position(line[5:])
+        elif data == PING_FRAME:
+            self._pong()
+        elif not self._resuming:
+            await self.received.put(line)
+
+    def _pong(self):
+        self.pending.append(PONG_FRAME)
+        self._has_pending.set()
+
+    async def _read_frames(
+        self,
+        reader: "asyncio.StreamReader | InflatingReader",
+        until: bytes | None = None,
+    ) -> bool:
+        # Nicknames and rooms are defined by the server before their first use
+        names: dict[int, str] = {}
+        rooms: dict[int, str] = {}
+        try:
+            while True:
+                header, payload = await read_frame(reader, RECEIVE_LIMIT)
+                frame_type, seq, sender, room, _ = header
+                if frame_type == PING:
+                    self._pong()
+                elif frame_type == NAME:
+                    names[sender] = payload.decode(errors="replace")
+                elif frame_type == ROOM:
+                    rooms[room] = payload.decode(errors="replace")
+                elif frame_type in (MESSAGE, PRIVATE):
+                    if seq:
+                        self._update_position(str(seq))
+                    name = names.get(sender, "?")
+                    if frame_type == PRIVATE:
+                        label = f"{name} (privé)"
+                    elif rooms.get(room, DEFAULT_ROOM) == DEFAULT_ROOM:
+                        label = name
+                    else:
+                        label = f"[{rooms[room]}] {name}"
+                    if not self._resuming:
+                        for line in payload.decode(errors="replace").split("\n"):
+                            await self.received.put(f"{label}> {line}")
+                elif payload == until:
+                    return True
+                else:
+                    # TEXT: lines of the text protocol
+                    if seq:
+                        self._update_position(str(seq))
+                    for line in payload.rstrip(b"\n").split(b"\n"):
+                        await self._receive_line(line)
+        except (asyncio.IncompleteReadError, ConnectionError, FrameError):
+            pass
+        return False
+
+    def _update_position(self, token: str):
+        if ":" in token:
+            # Answer to /resume, with the epoch of the server
+            self.position = token
+            self._resuming = False
+        elif self.position:
+            epoch = self.position.partition(":")[0]
+            self.position = f"{epoch}:{token}"
+
+    async def _write_pending(self, writer: asyncio.StreamWriter):
+        # Everything queued goes out in one write, flow control only pauses
+        # this task, never send()
+        try:
+            while True:
+                await self._has_pending.wait()
+                self._has_pending.clear()
+                writer.writelines(self._take_pending())
+                if writer.transport.get_write_buffer_size() > SEND_HIGH_WATERMARK:
+                    await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def encode_line(line: bytes) -> bytes:
+    # Frame of a binary client for a line of the text protocol
+    if line == PONG_FRAME:
+        return BINARY_PONG
+    frame_type = COMMAND if line.startswith(b"/") else MESSAGE
+    return encode_frame(frame_type, line.rstrip(b"\n"))
+
+
+class ClientPool:
+    """Many ChatClients driven from one event loop, for bots and load tests.
+
+    Connections, first ones and reconnections alike, are opened at most
+    `concurrency` at a time so that a pool does not overflow the listen
+    backlog of the server.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int | str,
+        names: Iterable[str],
+        rooms: Iterable[str] = (),
+        backoff: Backoff | None = None,
+        concurrency: int = CONNECT_CONCURRENCY,
+        seed: int | None = None,
+    ):
+        rng = random.Random(seed)
+        self.connecting = asyncio.Semaphore(concurrency)
+        rooms = tuple(rooms)
+        self.clients = [
+            ChatClient(
+                host,
+                port,
+                name,
+                rooms,
+                backoff,
+                random.Random(rng.random()),
+                connecting=self.connecting,
+            )
+            for name in names
+        ]
+
+    async def __aenter__(self) -> "ClientPool":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    async def start(self):
+        await asyncio.gather(*(client.start() for client in self.clients))
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients))
+
+    def send_all(self, line: str):
+        for client in self.clients:
+            client.send(line)
@@ -0,0 +1,236 @@
+import asyncio
+from collections import deque
+import zlib
+
+from tchat.framing import FrameError
+
+
+# "/compress [level]" asks the server to compress what it sends, the answer
+# is the last line sent uncompressed: the raw deflate stream starts after it.
+# What clients send is never compressed.
+DEFAULT_LEVEL = 6
+# 4 Ko of history: about 32 Ko per zlib context instead of 256 Ko with the
+# defaults, chat lines seldom repeat anything older
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+# Outputs kept by a shared compressor for its clients still behind, enough
+# for every frame of a long message
+RECENT_BYTES = 256 * 1024
+# Compressions of a frame in as many compressors before their clients share
+# a new one
+MAX_COMPRESSIONS = 4
+# Frames remembered for MAX_COMPRESSIONS
+RECENT_FRAMES = 256
+READ_SIZE = 64 * 1024
+
+
+def accepted(level: int) -> bytes:
+    return f"/compress {level}\n".encode()
+
+
+def parse_level(value: str) -> int:
+    level = int(value or DEFAULT_LEVEL)
+    if not 1 <= level <= 9:
+        raise ValueError(f"Niveau de compression invalide: {value}")
+    return level
+
+
+class DeflateStream:
+    """zlib context shared by the clients which received all of its output.
+
+    Every frame is followed by Z_SYNC_FLUSH: its output ends on a byte
+    boundary and is inflated by the client without waiting for more. The
+    last frames compressed are kept with their output in `recent`, at most
+    `window` bytes of them, for the clients of the stream still behind.
+    """
+
+    __slots__ = ("compressor", "count", "recent", "recent_bytes", "users")
+
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL
+        )
+        self.count = 0
+        self.recent: deque[tuple[bytes, bytes]] = deque()
+        self.recent_bytes = 0
+        self.users = 0
+
+    def compress(self, frame: bytes, window: int = RECENT_BYTES) -> bytes:
+        compressor = self.compressor
+        output = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.count += 1
+        recent = self.recent
+        recent.append((frame, output))
+        self.recent_bytes += len(frame) + len(output)
+        while self.recent_bytes > window and len(recent) > 1:
+            old_frame, old_output = recent.popleft()
+            self.recent_bytes -= len(old_frame) + len(old_output)
+        return output
+
+    def starts_with(self, frame: bytes) -> bool:
+        # Whether a client can join from the first frame, all of them kept
+        recent = self.recent
+        return bool(recent) and self.count == len(recent) and recent[0][0] == frame
+
+
+class Compression:
+    """Streaming compression of the frames sent to the clients of a server.
+
+    A client inflates one raw deflate stream for the whole connection, but
+    that stream may come from several compressors in turn: after a sync
+    flush, the output of a new compressor can follow the output of another,
+    since it only refers to its own bytes. Clients with the same level share
+    a compressor as long as they receive the same frames: a frame broadcast
+    to them is compressed once, and the others get the same output.
+
+    A client missing a frame of its compressor cannot use it any more, it
+    moves to a new compressor shared by every client in the same case for
+    that frame. So do the clients of a frame already compressed
+    `max_compressions` times by other compressors: the history of their
+    compressor is lost, but a broadcast is never compressed much more than
+    `max_compressions` times, whatever the number of recipients.
+    """
+
+    def __init__(self, max_compressions: int = MAX_COMPRESSIONS):
+        self.max_compressions = max_compressions
+        # New compressor of each level, joined by the clients of its first frame
+        self.fresh: dict[int, DeflateStream] = {}
+        # Frames compressed lately at each level, and by how many compressors
+        self.compressed: dict[int, dict[bytes, int]] = {}
+        self.streams = 0
+        self.compressions = 0
+        self.shared_frames = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def session(self, level: int = DEFAULT_LEVEL) -> "CompressionSession":
+        return CompressionSession(self, level)
+
+    def merges(self, stream: DeflateStream, level: int, frame: bytes) -> bool:
+        # Whether the clients of `stream`, in step with it, join the fresh
+        # compressor of `frame` instead of compressing it once more: a client
+        # alone in its stream as soon as another compressor did
+        fresh = self.fresh.get(level)
+        if stream is fresh:
+            return False
+        if fresh and fresh.starts_with(frame):
+            return True
+        compressed = self.compressed.setdefault(level, {})
+        count = compressed.get(frame, 0)
+        if count and (stream.users == 1 or count >= self.max_compressions):
+            return True
+        if not count and len(compressed) >= RECENT_FRAMES:
+            del compressed[next(iter(compressed))]
+        compressed[frame] = count + 1
+        return False
+
+    def fresh_stream(self, level: int, frame: bytes) -> DeflateStream:
+        stream = self.fresh.get(level)
+        if stream and stream.starts_with(frame):
+            self.shared_frames += 1
+            return stream
+        stream = self.fresh[level] = DeflateStream(level)
+        stream.compress(frame)
+        self.compressions += 1
+        return stream
+
+
+class CompressionSession:
+    # Compressor of a client and how many of its frames the client received
+
+    __slots__ = ("codec", "level", "stream", "position")
+
+    def __init__(self, codec: Compression, level: int):
+        self.codec = codec
+        self.level = level
+        self.stream = DeflateStream(level)
+        self.stream.users = 1
+        self.position = 0
+        codec.streams += 1
+
+    def compress(self, frame: bytes) -> bytes:
+        codec = self.codec
+        stream = self.stream
+        recent = stream.recent
+        codec.input_bytes += len(frame)
+        offset = self.position - stream.count + len(recent)
+        if 0 <= offset < len(recent) and recent[offset][0] == frame:
+            # Compressed already for another client of the stream
+            output = recent[offset][1]
+            codec.shared_frames += 1
+        elif self.position == stream.count and not codec.merges(
+            stream, self.level, frame
+        ):
+            # Only kept for the others: alone, the client never falls behind
+            shared = stream.users > 1 or stream is codec.fresh.get(self.level)
+            output = stream.compress(frame, RECENT_BYTES if shared else 0)
+            codec.compressions += 1
+        else:
+            stream = codec.fresh_stream(self.level, frame)
+            self._move(stream)
+            self.position = 0
+            output = stream.recent[0][1]
+        self.position += 1
+        codec.output_bytes += len(output)
+        return output
+
+    def close(self):
+        self.stream.users -= 1
+        if not self.stream.users:
+            self.codec.streams -= 1
+
+    def _move(self, stream: DeflateStream):
+        self.close()
+        if not stream.users:
+            self.codec.streams += 1
+        stream.users += 1
+        self.stream = stream
+
+
+class InflatingReader:
+    """Reads a raw deflate stream like the asyncio.StreamReader it wraps.
+
+    Bytes the reader buffered before are the start of the stream. At most
+    `limit` bytes are inflated at a time, whatever the compression ratio.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, limit: int = READ_SIZE):
+        self.reader = reader
+        self.limit = limit
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = bytearray()
+
+    async def _fill(self) -> bool:
+        data = self.decompressor.unconsumed_tail
+        if not data:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                return False
+        try:
+            self.buffer += self.decompressor.decompress(data, self.limit)
+        except zlib.error as error:
+            raise FrameError(f"Flux compressé invalide: {error}") from None
+        return True
+
+    async def readline(self) -> bytes:
+        start = 0
+        while (end := self.buffer.find(b"\n", start)) < 0:
+            if len(self.buffer) > self.limit:
+                raise ValueError(f"Ligne de plus de {self.limit} octets")
+            start = len(self.buffer)
+            if not await self._fill():
+                end = len(self.buffer) - 1
+                break
+        line = bytes(self.buffer[: end + 1])
+        del self.buffer[: end + 1]
+        return line
+
+    async def readexactly(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            if not await self._fill():
+                partial = bytes(self.buffer)
+                self.buffer.clear()
+                raise asyncio.IncompleteReadError(partial, size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
@@ -0,0 +1,73 @@
+from typing import Callable, Iterable, Iterator, TypeVar
+
+
+Destination = TypeVar("Destination")
+Frames = tuple[bytes, ...]
+
+
+def is_continuation(byte: int) -> bool:
+    # 0b10xxxxxx: inside a UTF-8 sequence, never the first byte of a character
+    return byte & 0xC0 == 0x80
+
+
+def split_utf8(data: memoryview, max_size: int) -> Iterator[memoryview]:
+    """Cut UTF-8 data in slices of at most `max_size` bytes, 0 for no limit.
+
+    Cuts are moved back to the start of the character they would split, so
+    every slice decodes on its own. Only the bytes around a cut are looked at
+    and the slices share the memory of `data`. A character larger than
+    `max_size` gets a slice of its own rather than being split.
+    """
+    size = len(data)
+    start = 0
+    if max_size:
+        while size - start > max_size:
+            end = start + max_size
+            while end > start and is_continuation(data[end]):
+                end -= 1
+            if end == start:
+                end = start + max_size
+                while end < size and is_continuation(data[end]):
+                    end += 1
+            yield data[start:end]
+            start = end
+    if start < size or not size:
+        yield data[start:]
+
+
+def encode_message(message: str, header: str = "", max_size: int = 0) -> Frames:
+    """Build the wire frames of a message, one or more per line.
+
+    `max_size` bounds the size of a frame, header and newline included, 0 for
+    no limit. The frames are immutable and meant to be shared by every
+    recipient of the message.
+    """
+    data = message.rstrip().encode()
+    view = memoryview(data)
+    header_data = header.encode()
+    footer_data = b"\n"
+    overhead_size = len(header_data) + len(footer_data)
+    body_max_size = max(max_size - overhead_size, 1) if max_size else 0
+    frames: list[bytes] = []
+    start = 0
+    while start >= 0:
+        end = data.find(b"\n", start)
+        line = view[start:end] if end >= 0 else view[start:]
+        for body_data in split_utf8(line, body_max_size):
+            frames.append(b"".join((header_data, body_data, footer_data)))
+        start = end + 1 if end >= 0 else -1
+    return tuple(frames)
+
+
+def fan_out(
+    frames: Frames,
+    destinations: Iterable[Destination],
+    push: Callable[[Destination, bytes], object],
+) -> int:
+    """Queue the same frames to each destination, return the destination count."""
+    count = 0
+    for destination in destinations:
+        for frame in frames:
+            push(destination, frame)
+        count += 1
+    return count
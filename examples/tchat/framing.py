@@ -0,0 +1,181 @@
+import socket
+import struct
+
+
+RECEIVE_BUFFER_SIZE = 4096
+FRAME_MAX_SIZE = 65536
+
+
+class FrameError(ValueError):
+    pass
+
+
+class FrameDecoder:
+    """Split a byte stream into frames, reading into a preallocated buffer.
+
+    Data is read with `recv_from()` (socket.recv_into) or through the
+    `get_buffer()`/`buffer_updated()` pair of asyncio.BufferedProtocol, then
+    complete frames are obtained by iterating over the decoder. A frame may
+    span several reads and a read may hold several frames.
+    """
+
+    overhead_size = 0
+
+    def __init__(
+        self,
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+        max_frame_size: int = FRAME_MAX_SIZE,
+    ):
+        self.initial_size = buffer_size
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # Where to resume searching for the end of the current frame, so a
+        # long frame received in many small reads is not scanned again.
+        self.scanned = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        if self.end == len(self.buffer):
+            self._make_room()
+        return self.view[self.end :]
+
+    def buffer_updated(self, nbytes: int):
+        self.end += nbytes
+
+    def recv_from(self, sock: socket.socket) -> int:
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def feed(self, data: bytes):
+        # Unlike recv_from(), the buffer may end up holding many frames, the
+        # frame size limit is then enforced when the frames are decoded.
+        pending = self.end - self.start
+        if self.end + len(data) > len(self.buffer):
+            self._resize(max(pending + len(data), len(self.buffer)))
+        self.buffer[self.end : self.end + len(data)] = data
+        self.end += len(data)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        frame = self.next_frame()
+        if frame is None:
+            if self.start == self.end:
+                self._reset()
+            raise StopIteration
+        return frame
+
+    def next_frame(self) -> bytes | None:
+        raise NotImplementedError
+
+    def _reset(self):
+        self.start = self.end = self.scanned = 0
+        if len(self.buffer) > self.initial_size:
+            # Give back the memory used by an unusually large frame
+            self.buffer = bytearray(self.initial_size)
+            self.view = memoryview(self.buffer)
+
+    def _make_room(self):
+        # Only called once every complete frame has been consumed: what is
+        # left is the beginning of a single frame.
+        if self.start:
+            self._resize(len(self.buffer))
+        if self.end < len(self.buffer):
+            return
+        max_size = self.max_frame_size + self.overhead_size
+        if len(self.buffer) >= max_size:
+            raise FrameError(f"Trame de plus de {self.max_frame_size} octets")
+        self._resize(min(2 * len(self.buffer), max_size))
+
+    def _resize(self, size: int):
+        # Move the pending bytes at the beginning of a buffer of the given size
+        pending = self.end - self.start
+        if size == len(self.buffer):
+            self.view[:pending] = self.view[self.start : self.end]
+        else:
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start : self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.scanned = max(self.scanned - self.start, 0)
+        self.start, self.end = 0, pending
+
+
+class LineDecoder(FrameDecoder):
+    """Newline delimited frames, the delimiter is not part of the frame."""
+
+    overhead_size = 1
+
+    def __init__(
+        self,
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+        max_frame_size: int = FRAME_MAX_SIZE,
+        delimiter: bytes = b"\n",
+    ):
+        super().__init__(buffer_size, max_frame_size)
+        self.delimiter = delimiter
+
+    def next_frame(self) -> bytes | None:
+        position = self.buffer.find(
+            self.delimiter, max(self.start, self.scanned), self.end
+        )
+        if position < 0:
+            self.scanned = self.end
+            if self.end - self.start > self.max_frame_size:
+                raise FrameError(f"Ligne de plus de {self.max_frame_size} octets")
+            return None
+        frame = bytes(self.view[self.start : position])
+        self.start = self.scanned = position + len(self.delimiter)
+        return frame
+
+
+class LengthPrefixedDecoder(FrameDecoder):
+    """Frames preceded by their size as a 32 bits big endian integer.
+
+    A frame larger than `max_frame_size` raises FrameError, then is skipped
+    as it arrives: iterating again goes on with the next frames.
+    """
+
+    header = struct.Struct("!I")
+    overhead_size = header.size
+
+    def __init__(
+        self,
+        buffer_size: int = RECEIVE_BUFFER_SIZE,
+        max_frame_size: int = FRAME_MAX_SIZE,
+    ):
+        super().__init__(buffer_size, max_frame_size)
+        # Bytes of a frame too large still to be dropped
+        self.skipping = 0
+
+    def next_frame(self) -> bytes | None:
+        if self.skipping:
+            skipped = min(self.skipping, self.end - self.start)
+            self.start += skipped
+            self.skipping -= skipped
+            if self.skipping:
+                return None
+        if self.end - self.start < self.header.size:
+            return None
+        (size,) = self.header.unpack_from(self.buffer, self.start)
+        if size > self.max_frame_size:
+            self.start += self.header.size
+            self.skipping = size
+            raise FrameError(f"Trame de plus de {self.max_frame_size} octets")
+        frame_start = self.start + self.header.size
+        if self.end - frame_start < size:
+            return None
+        frame = bytes(self.view[frame_start : frame_start + size])
+        self.start = frame_start + size
+        return frame
+
+
+def encode_length_prefixed(payload: bytes) -> bytes:
+    return LengthPrefixedDecoder.header.pack(len(payload)) + payload
@@ -0,0 +1,163 @@
+import json
+import os
+import socket
+import struct
+
+from tchat.listen import open_unix_listener
+
+
+# A server started with "--handoff /run/tchat.handoff" while another one runs
+# with the same path takes over its listening sockets and its clients, which
+# stay connected: the new code is running without any reconnection.
+#
+# The running server listens on the path. The new one connects and receives
+# messages, each acknowledged before the next one: descriptors (SCM_RIGHTS)
+# and the state that goes with them. First the listening sockets, then the
+# clients by batches while the old server goes on serving, and last, once it
+# stopped, what changed meanwhile. The old server then closes what the new
+# one opens again (the message log, the metrics port) and hangs up, the new
+# one resumes service. Until the last acknowledgement nothing changed in the
+# old server, which goes on if the new one fails.
+#
+# The state is no pickle, which would run whatever code the other end
+# chose: a JSON document, then the byte strings it refers to by their index
+# (frames, buffers), which JSON could only hold escaped.
+
+# Descriptors passed in one message at most, SCM_MAX_FD of Linux
+MAX_FDS = 253
+# Descriptors, then size of the state
+HEADER = struct.Struct("!II")
+ACK = b"\x06"
+HANDOFF_TIMEOUT = 10.0
+# Size of the JSON document and number of byte strings, then their sizes
+STATE_HEADER = struct.Struct("!II")
+
+
+class StateError(ValueError):
+    pass
+
+
+def listen_handoff(path: str) -> socket.socket:
+    # Whoever connects gets every connection: the owner only
+    umask = os.umask(0o177)
+    try:
+        listener = open_unix_listener(path, 1)
+    finally:
+        os.umask(umask)
+    listener.setblocking(False)
+    return listener
+
+
+def connect_handoff(path: str) -> socket.socket | None:
+    # Connection to the server running on `path`, None if there is none. Its
+    # state is trusted: it must be run by the same user, like this one.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    if not same_user(sock):
+        sock.close()
+        raise PermissionError(f"{path} est le serveur d'un autre utilisateur")
+    sock.settimeout(HANDOFF_TIMEOUT)
+    return sock
+
+
+def same_user(sock: socket.socket) -> bool:
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid == os.getuid()
+
+
+def send_handoff(sock: socket.socket, fds: list[int], state: bytes):
+    # One byte per batch of descriptors: a read never takes two batches
+    sock.sendall(HEADER.pack(len(fds), len(state)))
+    for start in range(0, len(fds), MAX_FDS):
+        socket.send_fds(sock, [b"F"], fds[start : start + MAX_FDS])
+    sock.sendall(state)
+
+
+def receive_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Passation interrompue")
+        received += count
+    return bytes(data)
+
+
+def receive_ack(sock: socket.socket):
+    if sock.recv(1) != ACK:
+        raise ConnectionError("Passation abandonnée par le nouveau serveur")
+
+
+def receive_handoff(sock: socket.socket) -> tuple[list[int], bytes]:
+    fd_count, state_size = HEADER.unpack(receive_exactly(sock, HEADER.size))
+    fds: list[int] = []
+    try:
+        while len(fds) < fd_count:
+            data, batch, flags, _ = socket.recv_fds(sock, 1, MAX_FDS)
+            fds += batch
+            if not data or flags & socket.MSG_CTRUNC:
+                raise ConnectionError("Passation interrompue")
+        return fds, receive_exactly(sock, state_size)
+    except:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+class StateWriter:
+    """State of a handoff message: a JSON document and byte strings.
+
+    `blob()` stores a byte string and gives the index to put in the
+    document in its place, `encode()` the message for send_handoff().
+    """
+
+    def __init__(self):
+        self.blobs: list[bytes] = []
+
+    def blob(self, data: bytes) -> int:
+        self.blobs.append(data)
+        return len(self.blobs) - 1
+
+    def encode(self, document: object) -> bytes:
+        text = json.dumps(document, separators=(",", ":")).encode()
+        sizes = struct.pack(f"!{len(self.blobs)}I", *map(len, self.blobs))
+        header = STATE_HEADER.pack(len(text), len(self.blobs))
+        return b"".join([header, sizes, text, *self.blobs])
+
+
+class StateReader:
+    # The document and the byte strings of a state made by StateWriter
+
+    def __init__(self, data: bytes):
+        try:
+            text_size, count = STATE_HEADER.unpack_from(data)
+            sizes = struct.unpack_from(f"!{count}I", data, STATE_HEADER.size)
+        except struct.error as error:
+            raise StateError(f"État de passation invalide: {error}") from None
+        start = STATE_HEADER.size + 4 * count
+        end = start + text_size
+        try:
+            self.document = json.loads(data[start:end])
+        except ValueError as error:
+            raise StateError(f"État de passation invalide: {error}") from None
+        self.blobs: list[bytes] = []
+        for size in sizes:
+            self.blobs.append(data[end : end + size])
+            end += size
+        if end != len(data):
+            raise StateError("État de passation invalide: taille incorrecte")
+
+    def blob(self, index: int) -> bytes:
+        try:
+            return self.blobs[index]
+        except (IndexError, TypeError):
+            raise StateError(f"État de passation invalide: {index!r}") from None
@@ -0,0 +1,157 @@
+from collections import deque
+from dataclasses import dataclass
+import heapq
+from itertools import islice, takewhile
+import os
+import time
+from typing import Iterable, Iterator
+
+from tchat.binary import BinaryMessage, BinarySession, encode_text
+from tchat.fanout import Frames
+
+
+HISTORY_MAX_BYTES = 1024 * 1024
+# Messages replayed to a new member of a room, and by /history without count
+HISTORY_REPLAY = 20
+# Bookkeeping of an entry, counted with its frames against max_bytes
+ENTRY_OVERHEAD = 200
+
+
+@dataclass(slots=True, eq=False)
+class HistoryEntry:
+    seq: int
+    room: str
+    frames: Frames
+    # `frames` preceded by the "/seq N" line sent to the clients that resume
+    sequenced_frames: Frames
+    size: int
+    # The same message for the binary clients, numbered in its header
+    binary: BinaryMessage | None = None
+
+
+class History:
+    """Recent room messages, kept as the frames that were broadcast.
+
+    Every message gets the next sequence number. The entries are in a ring
+    buffer bounded to `max_bytes`, the oldest ones are dropped first, and
+    indexed by room so that replaying a room never looks at the others.
+    Replays queue the stored frames, they are never encoded again.
+
+    Sequence numbers only mean something to the process that gave them:
+    `epoch` changes when the server restarts, and each worker of
+    51-asyncio.py --workers has its own.
+    """
+
+    def __init__(self, max_bytes: int = HISTORY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.epoch = f"{os.getpid():x}{time.time_ns():x}"
+        self.last_seq = 0
+        self.size = 0
+        self.entries: deque[HistoryEntry] = deque()
+        self.rooms: dict[str, deque[HistoryEntry]] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def first_seq(self) -> int:
+        # Oldest sequence number still available, last_seq + 1 when empty
+        return self.entries[0].seq if self.entries else self.last_seq + 1
+
+    @property
+    def next_seq(self) -> int:
+        # Sequence number of the next message, for the frames encoded with it
+        return self.last_seq + 1
+
+    @property
+    def position(self) -> str:
+        # Resume token of the last message, for "/seq" and "/resume"
+        return f"{self.epoch}:{self.last_seq}"
+
+    def append(
+        self, room: str, frames: Frames, binary: BinaryMessage | None = None
+    ) -> HistoryEntry:
+        self.last_seq += 1
+        marker = b"/seq %d\n" % self.last_seq
+        size = sum(map(len, frames)) + ENTRY_OVERHEAD
+        if binary is not None:
+            size += sum(map(len, binary.frames))
+        entry = HistoryEntry(
+            self.last_seq, room, frames, (marker, *frames), size, binary
+        )
+        self.entries.append(entry)
+        self.rooms.setdefault(room, deque()).append(entry)
+        self.size += size
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self._drop_oldest()
+        return entry
+
+    def set_binary(self, entry: HistoryEntry, binary: BinaryMessage):
+        # Encoded for the first binary client to receive the message, which
+        # binary clients replaying it later get then instead of TEXT frames
+        entry.binary = binary
+        size = sum(map(len, binary.frames))
+        entry.size += size
+        self.size += size
+
+    def _drop_oldest(self):
+        entry = self.entries.popleft()
+        room_entries = self.rooms[entry.room]
+        room_entries.popleft()  # also the oldest of its room
+        if not room_entries:
+            del self.rooms[entry.room]
+        self.size -= entry.size
+
+    def recent(self, room: str, count: int = HISTORY_REPLAY) -> list[HistoryEntry]:
+        # Read from the newest end: the cost depends on `count`, not on the size
+        newest = list(islice(reversed(self.rooms.get(room, ())), count))
+        newest.reverse()
+        return newest
+
+    def since(self, seq: int, rooms: Iterable[str]) -> Iterator[HistoryEntry]:
+        # Entries after `seq` in any of the rooms, in sequence order
+        def newer(room: str) -> list[HistoryEntry]:
+            room_entries = reversed(self.rooms.get(room, ()))
+            entries = list(takewhile(lambda entry: entry.seq > seq, room_entries))
+            entries.reverse()
+            return entries
+
+        return heapq.merge(*map(newer, rooms), key=lambda entry: entry.seq)
+
+    def resume(
+        self, token: str, rooms: Iterable[str]
+    ) -> tuple[list[HistoryEntry], bool]:
+        """Entries a client resuming from `token` missed in `rooms`.
+
+        Also tells whether they are complete: the token may come from another
+        process, or be older than everything still in the buffer. Then the
+        latest messages of the rooms are returned instead.
+        """
+        seq = self.parse_position(token)
+        if seq is None:
+            latest = [self.recent(room) for room in rooms]
+            return list(heapq.merge(*latest, key=lambda entry: entry.seq)), False
+        return list(self.since(seq, rooms)), seq >= self.first_seq - 1
+
+    def parse_position(self, token: str) -> int | None:
+        # Sequence number of a resume token given by this history, else None
+        epoch, _, seq = token.partition(":")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.last_seq:
+            return None
+        return int(seq)
+
+
+def entry_frames(
+    entries: Iterable[HistoryEntry],
+    sequenced: bool,
+    binary: BinarySession | None = None,
+) -> Iterator[bytes]:
+    # Frames to queue to a client replaying `entries`
+    for entry in entries:
+        if binary is not None:
+            if entry.binary is not None:
+                yield from binary.message_frames(entry.binary)
+            else:
+                yield from encode_text(entry.frames)
+        else:
+            yield from entry.sequenced_frames if sequenced else entry.frames
@@ -0,0 +1,167 @@
+from dataclasses import dataclass
+import itertools
+import os
+import socket
+import stat
+from typing import Iterable
+
+
+# "unix:/run/tchat.sock": Unix-domain stream socket, for the bots and bridges
+# running on the same machine, without the TCP stack of the loopback
+UNIX_PREFIX = "unix:"
+
+# Unix clients all have "" as peer name: numbered on their listener instead
+_unix_clients = itertools.count(1)
+
+
+@dataclass(frozen=True, slots=True)
+class Endpoint:
+    # TCP host and port, or the path of a Unix-domain socket
+    host: str = ""
+    port: int = 0
+    path: str | None = None
+
+    def __str__(self) -> str:
+        if self.path is not None:
+            return UNIX_PREFIX + self.path
+        if ":" in self.host:
+            return f"[{self.host}]:{self.port}"
+        return f"{self.host}:{self.port}"
+
+
+def parse_endpoint(value: str, default_port: int | str) -> Endpoint:
+    # "unix:/run/tchat.sock", "[::1]:3030", "[::]", "127.0.0.1:3030", ":3030",
+    # "3030" or "localhost"; no host is every address, IPv4 and IPv6
+    invalid = ValueError(f"Adresse d'écoute invalide: {value}")
+    if value.startswith(UNIX_PREFIX):
+        path = value[len(UNIX_PREFIX) :]
+        if not path:
+            raise invalid
+        return Endpoint(path=path)
+    host, port = value, str(default_port)
+    if value.isdigit():
+        host, port = "", value
+    elif value.startswith("["):
+        host, bracket, rest = value[1:].partition("]")
+        if not bracket or rest and not rest.startswith(":"):
+            raise invalid
+        port = rest[1:] or port
+    elif value.count(":") == 1:
+        host, port = value.split(":")
+    if not port.isdigit():
+        raise invalid
+    return Endpoint(host, int(port))
+
+
+def open_listeners(
+    endpoints: Iterable[Endpoint],
+    reuse_port: bool = False,
+    backlog: int = socket.SOMAXCONN,
+) -> list[socket.socket]:
+    """Non-blocking listening sockets of `endpoints`, for a single registry.
+
+    A host name gets one socket per address it resolves to, no host gets
+    0.0.0.0 and :: (IPv6 only, as asyncio does); "::" is a single dual-stack
+    socket which also accepts IPv4 clients. `reuse_port` shares the TCP
+    ports between the processes of a server (SO_REUSEPORT).
+    """
+    listeners: list[socket.socket] = []
+    try:
+        for endpoint in endpoints:
+            if endpoint.path is not None:
+                listeners.append(open_unix_listener(endpoint.path, backlog))
+            else:
+                listeners += open_tcp_listeners(endpoint, reuse_port, backlog)
+    except:
+        for listener in listeners:
+            listener.close()
+        raise
+    for listener in listeners:
+        listener.setblocking(False)
+    return listeners
+
+
+def open_tcp_listeners(
+    endpoint: Endpoint, reuse_port: bool, backlog: int
+) -> list[socket.socket]:
+    if endpoint.host == "::":
+        address = ("::", endpoint.port)
+        return [
+            socket.create_server(
+                address,
+                family=socket.AF_INET6,
+                backlog=backlog,
+                reuse_port=reuse_port,
+                dualstack_ipv6=True,
+            )
+        ]
+    # SO_REUSEADDR is set by create_server() on posix: a restarted server
+    # binds again while its old connections are in TIME_WAIT
+    addresses = socket.getaddrinfo(
+        endpoint.host or None,
+        endpoint.port,
+        type=socket.SOCK_STREAM,
+        flags=socket.AI_PASSIVE,
+    )
+    listeners: list[socket.socket] = []
+    try:
+        for family, address in dict.fromkeys((info[0], info[4]) for info in addresses):
+            listeners.append(
+                socket.create_server(
+                    address, family=family, backlog=backlog, reuse_port=reuse_port
+                )
+            )
+    except:
+        for listener in listeners:
+            listener.close()
+        raise
+    return listeners
+
+
+def open_unix_listener(path: str, backlog: int) -> socket.socket:
+    # The file of a server which did not stop cleanly is removed, not the one
+    # of a server still running
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                if probe.connect_ex(path) == 0:
+                    raise OSError(f"Un serveur écoute déjà sur {UNIX_PREFIX}{path}")
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        listener.listen(backlog)
+    except:
+        listener.close()
+        raise
+    return listener
+
+
+def remove_socket_files(endpoints: Iterable[Endpoint]):
+    # Once the listeners are closed, by the process which opened them
+    for endpoint in endpoints:
+        if endpoint.path is None:
+            continue
+        try:
+            if stat.S_ISSOCK(os.stat(endpoint.path).st_mode):
+                os.unlink(endpoint.path)
+        except FileNotFoundError:
+            pass
+
+
+def listener_name(listener: socket.socket) -> str:
+    address = listener.getsockname()
+    if listener.family == socket.AF_UNIX:
+        return f"{UNIX_PREFIX}{address}"
+    if listener.family == socket.AF_INET6:
+        return f"[{address[0]}]:{address[1]}"
+    return f"{address[0]}:{address[1]}"
+
+
+def peer_name(peername: object, sockname: object) -> object:
+    # Name of a connection in the logs and the registry, which must be unique
+    if peername == "" and isinstance(sockname, str):
+        return (UNIX_PREFIX + sockname, next(_unix_clients))
+    return peername
@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+import logging
+import queue
+import signal
+import sys
+import threading
+import time
+from typing import Iterator, TextIO
+
+
+LOG_FORMAT = "%(asctime)s %(process)d %(levelname)s %(message)s"
+BATCH_SIZE = 512
+PAYLOAD_RATE = 100
+
+log = logging.getLogger("tchat")
+# Contents of the messages, only logged when enabled with --log-payloads or
+# at runtime with SIGUSR1.
+payload_log = logging.getLogger("tchat.payload")
+
+
+@dataclass
+class LogConfig:
+    level: str = "INFO"
+    filename: str | None = None
+    # Keep one payload record out of `payload_every`, 0 to start disabled
+    payload_every: int = 0
+    payload_rate: int = PAYLOAD_RATE
+
+
+class QueueingHandler(logging.Handler):
+    # Only stores the record: formatting and writing happen in LogWriter's
+    # thread. The queue is thread-safe so the handler lock is not needed.
+
+    def __init__(self, records: "queue.SimpleQueue[logging.LogRecord | None]"):
+        super().__init__()
+        self.records = records
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        if not self.filter(record):
+            return False
+        self.records.put_nowait(record)
+        return True
+
+    def emit(self, record: logging.LogRecord):
+        self.records.put_nowait(record)
+
+
+class LogWriter:
+    """Thread writing the queued log records in batches.
+
+    Logging calls of the event loop only append the record to a queue, the
+    message formatting and the write() system call happen here, once for
+    every record queued since the previous batch.
+    """
+
+    def __init__(self, stream: TextIO, batch_size: int = BATCH_SIZE):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.formatter = logging.Formatter(LOG_FORMAT)
+        self.records: queue.SimpleQueue[logging.LogRecord | None] = queue.SimpleQueue()
+        self.handler = QueueingHandler(self.records)
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self.records.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            lines: list[str] = []
+            for record in batch:
+                if record is None:
+                    running = False
+                    continue
+                try:
+                    lines.append(self.formatter.format(record) + "\n")
+                except Exception:
+                    self.handler.handleError(record)
+            if lines:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+
+
+class PayloadSampler(logging.Filter):
+    """Keeps one payload record out of `every`, at most `max_per_second`."""
+
+    def __init__(self, every: int = 1, max_per_second: int = PAYLOAD_RATE):
+        super().__init__()
+        self.every = max(every, 1)
+        self.max_per_second = max_per_second
+        self.seen = 0
+        self.suppressed = 0
+        self._window_start = 0.0
+        self._window_count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.seen += 1
+        if self.seen % self.every:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            if self.suppressed:
+                record.msg = f"{record.msg} ({self.suppressed} supprimés)"
+                self.suppressed = 0
+            self._window_start = now
+            self._window_count = 0
+        if self._window_count >= self.max_per_second:
+            self.suppressed += 1
+            return False
+        self._window_count += 1
+        return True
+
+
+def payloads_enabled() -> bool:
+    return payload_log.isEnabledFor(logging.DEBUG)
+
+
+def enable_payloads(enabled: bool):
+    payload_log.setLevel(logging.DEBUG if enabled else logging.INFO)
+
+
+def toggle_payloads(*_):
+    enable_payloads(not payloads_enabled())
+    log.info("Journal des messages %s", "activé" if payloads_enabled() else "désactivé")
+
+
+@contextmanager
+def start_logging(config: LogConfig | None = None) -> Iterator[LogWriter]:
+    # Routes the tchat loggers to a LogWriter for the duration of a `with`
+    config = config or LogConfig()
+    stream = open(config.filename, "a", encoding="utf-8") if config.filename else None
+    writer = LogWriter(stream or sys.stderr)
+    log.addHandler(writer.handler)
+    log.setLevel(config.level.upper())
+    log.propagate = False
+    payload_log.filters.clear()
+    payload_log.addFilter(PayloadSampler(config.payload_every, config.payload_rate))
+    enable_payloads(config.payload_every > 0)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, toggle_payloads)
+    writer.start()
+    try:
+        yield writer
+    finally:
+        writer.stop()
+        log.removeHandler(writer.handler)
+        if stream:
+            stream.close()
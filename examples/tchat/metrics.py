@@ -0,0 +1,294 @@
+import asyncio
+from collections import deque
+import concurrent.futures
+import http.server
+import socket
+import threading
+from typing import Callable, Iterator, TypeVar
+
+
+# Bucket bounds published to Prometheus, in seconds. Histograms keep finer
+# buckets internally and are folded into these when scraped.
+EXPORT_BOUNDS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)  # fmt: skip
+LOOP_LAG_INTERVAL = 0.25
+# Longest wait of a scrape for the chat loop to render the metrics
+SCRAPE_TIMEOUT = 5.0
+
+Sample = tuple[str, str, float]  # name suffix, labels, value
+
+
+class Counter:
+    # Either updated by the server or computed when read, with `function`
+    kind = "counter"
+
+    def __init__(
+        self, name: str, help: str, function: Callable[[], float] | None = None
+    ):
+        self.name = name
+        self.help = help
+        self.function = function
+        self._value: float = 0
+
+    @property
+    def value(self) -> float:
+        return self.function() if self.function else self._value
+
+    def inc(self, amount: float = 1):
+        self._value += amount
+
+    def samples(self) -> Iterator[Sample]:
+        yield "", "", self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float):
+        self._value = value
+
+
+class Histogram:
+    """Latency histogram with log-linear buckets, in the spirit of HdrHistogram.
+
+    Values are counted in integer `unit`s: below 2**precision_bits every value
+    has its own bucket, above each power of two is split in
+    2**(precision_bits - 1) buckets, so the relative error stays under
+    1/2**(precision_bits - 1) whatever the magnitude. Recording a value is a
+    few integer operations and no allocation once the range has been seen.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, unit: float = 1e-6, precision_bits: int = 5
+    ):
+        self.name = name
+        self.help = help
+        self.unit = unit
+        self.bits = precision_bits
+        self.sub_buckets = 1 << precision_bits
+        self.half = self.sub_buckets >> 1
+        self.counts: list[int] = [0] * self.sub_buckets
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def _index(self, units: int) -> int:
+        if units < self.sub_buckets:
+            return units
+        shift = units.bit_length() - self.bits
+        return self.sub_buckets + (shift - 1) * self.half + (units >> shift) - self.half
+
+    def _upper_bound(self, index: int) -> float:
+        # Largest value counted in the bucket, in seconds
+        if index < self.sub_buckets:
+            return index * self.unit
+        shift, sub = divmod(index - self.sub_buckets, self.half)
+        shift += 1
+        return (((sub + self.half + 1) << shift) - 1) * self.unit
+
+    def record(self, value: float):
+        index = self._index(int(value / self.unit)) if value > 0 else 0
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram"):
+        # Both histograms must use the same unit and precision
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = max(1, round(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._upper_bound(index), self.max)
+        return self.max
+
+    def samples(self) -> Iterator[Sample]:
+        bounds = iter(EXPORT_BOUNDS)
+        bound = next(bounds)
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            upper = self._upper_bound(index)
+            while bound is not None and upper > bound:
+                yield "_bucket", f'le="{bound}"', cumulative
+                bound = next(bounds, None)
+            cumulative += count
+        while bound is not None:
+            yield "_bucket", f'le="{bound}"', cumulative
+            bound = next(bounds, None)
+        yield "_bucket", 'le="+Inf"', self.count
+        yield "_sum", "", self.sum
+        yield "_count", "", self.count
+
+
+Metric = Counter | Gauge | Histogram
+M = TypeVar("M", Counter, Gauge, Histogram)
+
+
+class MetricsRegistry:
+    """Metrics of a server process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def counter(
+        self, name: str, help: str, function: Callable[[], float] | None = None
+    ) -> Counter:
+        return self.add(Counter(name, help, function))
+
+    def gauge(
+        self, name: str, help: str, function: Callable[[], float] | None = None
+    ) -> Gauge:
+        return self.add(Gauge(name, help, function))
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        return self.add(Histogram(name, help))
+
+    def add(self, metric: M) -> M:
+        if metric.name in self.metrics:
+            raise ValueError(f"duplicate metric {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                labels = "{" + labels + "}" if labels else ""
+                lines.append(f"{metric.name}{suffix}{labels} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+CallSoon = Callable[[Callable[[], None]], object]
+
+
+class LoopCalls:
+    """Functions other threads ask a selector loop to run.
+
+    The loop.call_soon_threadsafe() of asyncio for 50-tchat.py: the function
+    is queued and a byte written to a socket pair, the loop registers
+    `reader` in its selector and calls `run()` when it is readable.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self.calls: deque[Callable[[], None]] = deque()
+
+    def call_soon_threadsafe(self, function: Callable[[], None]):
+        self.calls.append(function)
+        try:
+            self.writer.send(b"\0")
+        except BlockingIOError:
+            pass  # the loop has many bytes to read already
+
+    def run(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.calls:
+            self.calls.popleft()()
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry: MetricsRegistry
+    call_soon: CallSoon
+
+    def do_GET(self):
+        # Rendered by the chat loop: the gauges read its clients and rooms,
+        # which it changes between two reads of another thread
+        future: concurrent.futures.Future[str] = concurrent.futures.Future()
+
+        def render():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.registry.render())
+                except Exception as error:
+                    future.set_exception(error)
+
+        self.call_soon(render)
+        try:
+            body = future.result(SCRAPE_TIMEOUT).encode()
+        except TimeoutError:
+            future.cancel()
+            self.send_error(503, "Serveur occupé")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object):
+        pass
+
+
+def serve_metrics(
+    registry: MetricsRegistry, host: str, port: int, call_soon: CallSoon
+) -> http.server.ThreadingHTTPServer:
+    # Scrapes are answered by a thread so that a slow one never blocks the
+    # chat loop, which only renders the metrics; it gets the function through
+    # `call_soon`, loop.call_soon_threadsafe or LoopCalls.call_soon_threadsafe
+    handler = type(
+        "MetricsHandler",
+        (_MetricsHandler,),
+        {"registry": registry, "call_soon": staticmethod(call_soon)},
+    )
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+async def monitor_loop_lag(histogram: Histogram, interval: float = LOOP_LAG_INTERVAL):
+    # How late the loop wakes this task up is the time callbacks wait to run
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.record(loop.time() - start - interval)
+
+
+def format_seconds(value: float) -> str:
+    if value < 0.001:
+        return f"{value * 1e6:.0f} µs"
+    if value < 1:
+        return f"{value * 1e3:.1f} ms"
+    return f"{value:.2f} s"
+
+
+def format_histogram(histogram: Histogram) -> str:
+    return (
+        f"p50 {format_seconds(histogram.quantile(0.5))}, "
+        f"p99 {format_seconds(histogram.quantile(0.99))}, "
+        f"max {format_seconds(histogram.max)} ({histogram.count} mesures)"
+    )
+
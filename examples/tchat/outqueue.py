@@ -0,0 +1,82 @@
+from collections import deque
+from itertools import islice
+import os
+import socket
+
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+class OutputQueue:
+    """Frames waiting to be sent to one client.
+
+    The first frame may have been partially sent already, `offset` tells how
+    many of its bytes went out. Frames are shared between recipients and never
+    copied: partial writes are tracked with a memoryview.
+    """
+
+    __slots__ = ("frames", "offset", "size")
+
+    def __init__(self):
+        self.frames: deque[bytes] = deque()
+        self.offset = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __bool__(self):
+        return bool(self.frames)
+
+    def append(self, frame: bytes):
+        if frame:
+            self.frames.append(frame)
+            self.size += len(frame)
+
+    def clear(self):
+        self.frames.clear()
+        self.offset = 0
+        self.size = 0
+
+    def pending_buffers(self, max_count: int = IOV_MAX) -> list[memoryview | bytes]:
+        if not self.frames:
+            return []
+        buffers: list[memoryview | bytes] = [memoryview(self.frames[0])[self.offset :]]
+        buffers.extend(islice(self.frames, 1, max_count))
+        return buffers
+
+    def consume(self, size: int):
+        self.size -= size
+        frames = self.frames
+        size += self.offset
+        while frames and size >= len(frames[0]):
+            size -= len(frames.popleft())
+        self.offset = size if frames else 0
+
+    def send_to(self, sock: socket.socket) -> int:
+        """Send as many frames as the kernel accepts, return the byte count.
+
+        Frames are gathered in a single sendmsg() call (writev), the loop only
+        goes on while the kernel takes everything it is given.
+        """
+        total_sent = 0
+        while self.frames:
+            buffers = self.pending_buffers()
+            batch_size = sum(len(buffer) for buffer in buffers)
+            try:
+                if HAS_SENDMSG:
+                    sent = sock.sendmsg(buffers)
+                else:
+                    sent = sock.send(buffers[0])
+                    batch_size = len(buffers[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.consume(sent)
+            total_sent += sent
+            if sent < batch_size:
+                break
+        return total_sent
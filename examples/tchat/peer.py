@@ -0,0 +1,236 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import enum
+import time
+from typing import TYPE_CHECKING
+
+from tchat.listen import peer_name
+from tchat.logs import log
+from tchat.metrics import Histogram
+
+if TYPE_CHECKING:
+    from tchat.compress import CompressionSession
+
+
+QUEUE_HIGH_WATERMARK = 256 * 1024
+QUEUE_LOW_WATERMARK = 64 * 1024
+
+
+class OverflowPolicy(enum.Enum):
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    DISCONNECT = "disconnect"
+
+
+@dataclass
+class QueueMetrics:
+    # Totals for every peer of a server, the per-peer figures live on Peer
+    dropped_frames: int = 0
+    dropped_bytes: int = 0
+    overflows: int = 0
+    disconnections: int = 0
+    max_queued_bytes: int = 0
+    sent_frames: int = 0
+    sent_bytes: int = 0
+    # Time the oldest queued frame waited before being handed to the transport
+    delivery: Histogram = field(
+        default_factory=lambda: Histogram(
+            "tchat_delivery_seconds", "Attente des messages dans les files d'envoi"
+        )
+    )
+
+
+class Peer:
+    """Bounded outgoing queue of a client.
+
+    `push()` never blocks: frames are queued and handed to the transport later
+    by the subclass, which only waits on behalf of this peer. When more than
+    `high_watermark` bytes are waiting the overflow policy applies, until the
+    queue is back under `low_watermark`.
+
+    After /compress frames are queued compressed, and none may be dropped
+    from the stream: whatever the policy, an overflow disconnects the peer.
+    The same after /binary: a dropped frame may define an id the client
+    would go on using, and show the messages of another nickname.
+    """
+
+    def __init__(
+        self,
+        peername: object,
+        high_watermark: int = QUEUE_HIGH_WATERMARK,
+        low_watermark: int = QUEUE_LOW_WATERMARK,
+        policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        metrics: QueueMetrics | None = None,
+    ):
+        self.peername = peername
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.policy = policy
+        self.metrics = metrics if metrics is not None else QueueMetrics()
+        self.queue: deque[bytes] = deque()
+        self.queued_since = 0.0
+        self.queued_bytes = 0
+        self.max_queued_bytes = 0
+        self.overflowing = False
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.compression: "CompressionSession | None" = None
+        # Set after /binary
+        self.binary = False
+        self.closed = False
+
+    def push(self, frame: bytes) -> bool:
+        if self.closed:
+            return False
+        frame_size = len(frame)
+        if self.overflowing or self.queued_bytes + frame_size > self.high_watermark:
+            if not self.overflowing:
+                self.overflowing = True
+                self.metrics.overflows += 1
+            lossless = self.compression or self.binary
+            if self.policy is OverflowPolicy.DISCONNECT or lossless:
+                self.metrics.disconnections += 1
+                self.close()
+                return False
+            if self.policy is OverflowPolicy.DROP_NEWEST:
+                self._dropped(frame_size)
+                return False
+            while self.queue and self.queued_bytes + frame_size > self.low_watermark:
+                oldest = self.queue.popleft()
+                self.queued_bytes -= len(oldest)
+                self._dropped(len(oldest))
+            self.overflowing = False
+        if self.compression:
+            frame = self.compression.compress(frame)
+            frame_size = len(frame)
+        if not self.queue:
+            self.queued_since = time.perf_counter()
+        self.queue.append(frame)
+        self.queued_bytes += frame_size
+        if self.queued_bytes > self.max_queued_bytes:
+            self.max_queued_bytes = self.queued_bytes
+            if self.queued_bytes > self.metrics.max_queued_bytes:
+                self.metrics.max_queued_bytes = self.queued_bytes
+        self._schedule_flush()
+        return True
+
+    def close(self):
+        # The reading side sees the end of the stream and cleans up
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self._abort()
+
+    def _schedule_flush(self):
+        raise NotImplementedError
+
+    def _abort(self):
+        raise NotImplementedError
+
+    def _take_frames(self) -> deque[bytes]:
+        frames, self.queue = self.queue, deque()
+        self.metrics.delivery.record(time.perf_counter() - self.queued_since)
+        self.sent_frames += len(frames)
+        self.sent_bytes += self.queued_bytes
+        self.metrics.sent_frames += len(frames)
+        self.metrics.sent_bytes += self.queued_bytes
+        self.queued_bytes = 0
+        self.overflowing = False
+        return frames
+
+    def _dropped(self, size: int):
+        self.dropped_frames += 1
+        self.dropped_bytes += size
+        self.metrics.dropped_frames += 1
+        self.metrics.dropped_bytes += size
+
+
+class StreamPeer(Peer):
+    # A writer task waits for drain() on behalf of this peer only
+
+    def __init__(self, writer: asyncio.StreamWriter, **options):
+        name = peer_name(
+            writer.get_extra_info("peername"), writer.get_extra_info("sockname")
+        )
+        super().__init__(name, **options)
+        self.writer = writer
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._write_loop())
+
+    async def stop(self):
+        self.closed = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, ConnectionError):
+                pass
+
+    def _schedule_flush(self):
+        self._ready.set()
+
+    def _abort(self):
+        self.writer.transport.abort()
+
+    async def _write_loop(self):
+        while not self.closed:
+            await self._ready.wait()
+            self._ready.clear()
+            if not self.queue:
+                continue
+            size = self.queued_bytes
+            frames = self._take_frames()
+            self.writer.writelines(frames)
+            log.debug(
+                "Envoi %d messages (%d octets) à %s", len(frames), size, self.peername
+            )
+            await self.writer.drain()
+
+
+class TransportPeer(Peer):
+    """Peer of an asyncio.Protocol, without any task.
+
+    Frames pushed during a loop iteration are written together by a single
+    callback, and nothing is written while the transport asked to pause.
+    """
+
+    def __init__(self, transport: asyncio.WriteTransport, **options):
+        name = peer_name(
+            transport.get_extra_info("peername"), transport.get_extra_info("sockname")
+        )
+        super().__init__(name, **options)
+        self.transport = transport
+        self.paused = False
+        self._flush_scheduled = False
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled and not self.paused:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _abort(self):
+        self.transport.abort()
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self.closed or self.paused or not self.queue:
+            return
+        size = self.queued_bytes
+        frames = self._take_frames()
+        self.transport.writelines(frames)
+        log.debug(
+            "Envoi %d messages (%d octets) à %s", len(frames), size, self.peername
+        )
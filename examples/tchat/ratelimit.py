@@ -0,0 +1,262 @@
+from dataclasses import dataclass
+from enum import Enum
+import math
+import time
+from typing import Callable
+
+from tchat.registry import Client
+
+
+# Buckets hold this many seconds of their rate: the size of a burst
+BURST_SECONDS = 4.0
+# Messages refused in a row before the client is muted, then muted for
+MUTE_AFTER = 50
+MUTE_SECONDS = 60.0
+# Mutes before the client is disconnected
+DISCONNECT_AFTER = 3
+# Rooms with buckets before the idle ones are forgotten
+MAX_ROOM_BUCKETS = 10_000
+
+
+@dataclass(slots=True)
+class TokenBucket:
+    """`rate` tokens per second, at most `capacity` saved for bursts.
+
+    Refilled when used, from the time elapsed since the last use: no timer.
+    An amount larger than `capacity` is taken from a full bucket and leaves
+    it in debt, so that a long line goes through and is paid for after.
+    """
+
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+
+    @classmethod
+    def full(cls, rate: float, now: float, burst_seconds: float = BURST_SECONDS):
+        capacity = rate * burst_seconds
+        return cls(rate, capacity, capacity, now)
+
+    @property
+    def is_full(self) -> bool:
+        return self.tokens >= self.capacity
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+
+def has_tokens(bucket: TokenBucket | None, amount: float, now: float) -> bool:
+    # A missing bucket is no limit
+    if bucket is None:
+        return True
+    bucket.refill(now)
+    return bucket.tokens >= min(amount, bucket.capacity)
+
+
+NO_BUCKETS: tuple[TokenBucket | None, TokenBucket | None] = (None, None)
+
+
+@dataclass
+class RateLimitConfig:
+    # Per second, 0 disables a limit: all of them are off unless configured
+    client_messages: float = 0.0
+    client_bytes: float = 0.0
+    room_messages: float = 0.0
+    room_bytes: float = 0.0
+    burst_seconds: float = BURST_SECONDS
+    mute_after: int = MUTE_AFTER
+    mute_seconds: float = MUTE_SECONDS
+    disconnect_after: int = DISCONNECT_AFTER
+
+    @property
+    def enabled(self) -> bool:
+        rates = (self.client_messages, self.client_bytes)
+        return any(rates + (self.room_messages, self.room_bytes))
+
+
+class Verdict(Enum):
+    ACCEPT = "accept"
+    # Refused, the client is told once until a message is accepted again
+    THROTTLE = "throttle"
+    ROOM_THROTTLE = "room-throttle"
+    # Refused without a notice, already given
+    DROP = "drop"
+    # Refused, the client is muted from now on
+    MUTE = "mute"
+    DISCONNECT = "disconnect"
+
+
+@dataclass(slots=True)
+class ClientLimits:
+    messages: TokenBucket | None
+    bytes: TokenBucket | None
+    refused: int = 0
+    notified: bool = False
+    muted_until: float = 0.0
+    mutes: int = 0
+    # Messages refused since the last one accepted, counted to the client then
+    dropped: int = 0
+
+
+class RateLimiter:
+    """Flood control of the messages received by a server, before fan-out.
+
+    Every client has a bucket of messages and one of bytes, every room the
+    same for the chat messages sent to it, whoever sends them. A message is
+    accepted if all of them have enough tokens; it is then charged to all of
+    them. Refused messages are only answered by a notice the first time, so
+    that a flood does not turn into a flood of notices. After `mute_after`
+    refused messages in a row a client is muted for `mute_seconds`, after
+    `disconnect_after` mutes it is disconnected. The next message accepted
+    is preceded by the number of those refused, see dropped_notice().
+
+    The state is a few numbers per client and per room, updated on each
+    message with the time given by `clock`.
+    """
+
+    def __init__(
+        self,
+        config: RateLimitConfig | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.config = config or RateLimitConfig()
+        # Read once: the configuration does not change while the server runs
+        self.enabled = self.config.enabled
+        self.clock = clock
+        self.rooms: dict[str, tuple[TokenBucket | None, TokenBucket | None]] = {}
+        self.refused_messages = 0
+        self.refused_bytes = 0
+        self.mutes = 0
+        self.disconnections = 0
+
+    def _bucket(self, rate: float, now: float) -> TokenBucket | None:
+        return TokenBucket.full(rate, now, self.config.burst_seconds) if rate else None
+
+    def client_limits(self, client: Client) -> ClientLimits:
+        if client.limits is None:
+            now = self.clock()
+            client.limits = ClientLimits(
+                self._bucket(self.config.client_messages, now),
+                self._bucket(self.config.client_bytes, now),
+            )
+        return client.limits
+
+    def check(self, client: Client, size: int, room: str | None = None) -> Verdict:
+        # `room`: where a chat message goes, None for a command
+        if not self.enabled:
+            return Verdict.ACCEPT
+        config = self.config
+        limits = self.client_limits(client)
+        now = self.clock()
+        if limits.muted_until:
+            if now < limits.muted_until:
+                return self._refuse(limits, size, Verdict.DROP)
+            limits.muted_until = 0.0
+        messages, sizes = limits.messages, limits.bytes
+        room_messages, room_sizes = NO_BUCKETS
+        if room is not None:
+            room_messages, room_sizes = self._room_buckets(room, now)
+        client_ok = has_tokens(messages, 1, now) and has_tokens(sizes, size, now)
+        if (
+            client_ok
+            and has_tokens(room_messages, 1, now)
+            and has_tokens(room_sizes, size, now)
+        ):
+            for bucket in (messages, room_messages):
+                if bucket:
+                    bucket.tokens -= 1
+            for bucket in (sizes, room_sizes):
+                if bucket:
+                    bucket.tokens -= size
+            limits.refused = 0
+            limits.notified = False
+            return Verdict.ACCEPT
+        if not client_ok:
+            # A busy room is not the fault of the client: only count these
+            limits.refused += 1
+        if config.mute_after and limits.refused >= config.mute_after:
+            limits.refused = 0
+            limits.mutes += 1
+            if config.disconnect_after and limits.mutes >= config.disconnect_after:
+                # Lines already received from it are dropped until it is gone
+                limits.muted_until = math.inf
+                self.disconnections += 1
+                return self._refuse(limits, size, Verdict.DISCONNECT)
+            limits.muted_until = now + config.mute_seconds
+            self.mutes += 1
+            return self._refuse(limits, size, Verdict.MUTE)
+        if limits.notified:
+            return self._refuse(limits, size, Verdict.DROP)
+        limits.notified = True
+        verdict = Verdict.ROOM_THROTTLE if client_ok else Verdict.THROTTLE
+        return self._refuse(limits, size, verdict)
+
+    def _room_buckets(
+        self, room: str, now: float
+    ) -> tuple[TokenBucket | None, TokenBucket | None]:
+        buckets = self.rooms.get(room)
+        if buckets is None:
+            if len(self.rooms) >= MAX_ROOM_BUCKETS:
+                self._forget_idle_rooms(now)
+            config = self.config
+            buckets = self.rooms[room] = (
+                self._bucket(config.room_messages, now),
+                self._bucket(config.room_bytes, now),
+            )
+        return buckets
+
+    def _forget_idle_rooms(self, now: float):
+        # A full bucket is the same as a new one: rooms removed since, or
+        # quiet, lose nothing
+        for room, buckets in list(self.rooms.items()):
+            for bucket in buckets:
+                if bucket:
+                    bucket.refill(now)
+            if all(bucket is None or bucket.is_full for bucket in buckets):
+                del self.rooms[room]
+
+    def _refuse(self, limits: ClientLimits, size: int, verdict: Verdict) -> Verdict:
+        limits.dropped += 1
+        self.refused_messages += 1
+        self.refused_bytes += size
+        return verdict
+
+    def dropped_notice(self, client: Client) -> str | None:
+        # Sent before a message accepted after refused ones, most of which
+        # got no notice of their own: the client learns what it lost
+        limits = client.limits
+        if limits is None or not limits.dropped:
+            return None
+        dropped, limits.dropped = limits.dropped, 0
+        plural = "s" if dropped > 1 else ""
+        return f"{dropped} message{plural} ignoré{plural} par la limite de débit."
+
+    def notice(self, verdict: Verdict, room: str | None = None) -> str | None:
+        # Text sent to the client for `verdict`, None when it is not told (a
+        # disconnected client would not get it, its queue is dropped)
+        config = self.config
+        if verdict is Verdict.THROTTLE:
+            rate = config.client_messages
+            limit = f", {rate:g} messages par seconde au plus" if rate else ""
+            return f"Trop de messages: les suivants sont ignorés{limit}."
+        if verdict is Verdict.ROOM_THROTTLE:
+            return f"Le salon {room} reçoit trop de messages: message ignoré."
+        if verdict is Verdict.MUTE:
+            return f"Vous êtes muet pendant {config.mute_seconds:g} s."
+        return None
+
+
+def parse_rate(value: str) -> tuple[float, float | None]:
+    # "5" or "5,16384": messages then bytes per second, None leaves the limit
+    # of the bytes as it is; "0" disables both. A negative rate (or NaN) would
+    # refuse every message, it is rejected like a malformed one.
+    messages, _, size = value.partition(",")
+    rates = [float(messages)] + ([float(size)] if size else [])
+    if not all(rate >= 0 for rate in rates):
+        raise ValueError(f"Débit négatif: {value}")
+    if size:
+        return rates[0], rates[1]
+    return rates[0], None if rates[0] else 0.0
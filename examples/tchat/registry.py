@@ -0,0 +1,113 @@
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Generic, Hashable, Iterator, TypeVar
+
+from tchat.rooms import Rooms
+
+if TYPE_CHECKING:
+    from tchat.binary import BinarySession
+    from tchat.ratelimit import ClientLimits
+    from tchat.timers import Timer
+
+
+def address_to_str(address: object) -> str:
+    try:
+        host, port, *_ = address  # type: ignore [misc]
+        return f"{host}:{port}"
+    except:
+        return str(address)
+
+
+@dataclass(slots=True, eq=False)
+class Client:
+    # `key` identifies the connection (a socket, a peer...), `name` is the
+    # nickname, None until the client chooses one. `rooms` is an ordered set,
+    # the last room is the current one. A `sequenced` client resumed with
+    # /resume: room messages reach it preceded by their "/seq N" line. A
+    # `binary` client switched to the frames of tchat.binary with /binary.
+    # `last_activity` and the timers belong to tchat.timers.ConnectionTimers,
+    # `limits` to tchat.ratelimit.RateLimiter.
+    key: Hashable
+    address: str
+    name: str | None = None
+    rooms: dict[str, None] = field(default_factory=dict)
+    sequenced: bool = False
+    last_activity: float = 0.0
+    idle_timer: "Timer | None" = None
+    login_timer: "Timer | None" = None
+    limits: "ClientLimits | None" = None
+    binary: "BinarySession | None" = None
+
+    @property
+    def label(self) -> str:
+        return self.name or self.address
+
+
+ClientType = TypeVar("ClientType", bound=Client)
+
+
+class Registry(Mapping[Hashable, ClientType], Generic[ClientType]):
+    """Connected clients indexed by key, address, nickname and room.
+
+    Behaves as a read-only mapping key -> client, changes go through `add()`,
+    `remove()`, `rename()` and `rooms` which keep every index up to date in
+    O(1). New clients join the default room.
+    """
+
+    def __init__(self):
+        self.by_key: dict[Hashable, ClientType] = {}
+        self.by_address: dict[str, ClientType] = {}
+        self.by_name: dict[str, ClientType] = {}
+        self.rooms: Rooms[ClientType] = Rooms()
+
+    def __getitem__(self, key: Hashable) -> ClientType:
+        return self.by_key[key]
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.by_key)
+
+    def __len__(self) -> int:
+        return len(self.by_key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.by_key
+
+    def values(self):
+        return self.by_key.values()
+
+    def items(self):
+        return self.by_key.items()
+
+    def add(self, client: ClientType) -> ClientType:
+        self.by_key[client.key] = client
+        self.by_address[client.address] = client
+        if client.name is not None:
+            self.by_name[client.name] = client
+        self.rooms.join(client, self.rooms.default_room)
+        return client
+
+    def remove(self, key: Hashable) -> ClientType:
+        client = self.by_key.pop(key)
+        if self.by_address.get(client.address) is client:
+            del self.by_address[client.address]
+        if client.name is not None and self.by_name.get(client.name) is client:
+            del self.by_name[client.name]
+        self.rooms.leave_all(client)
+        return client
+
+    def find_address(self, address: str) -> ClientType | None:
+        return self.by_address.get(address)
+
+    def find_name(self, name: str) -> ClientType | None:
+        return self.by_name.get(name)
+
+    def rename(self, client: ClientType, name: str) -> bool:
+        # False if the nickname belongs to another client
+        owner = self.by_name.get(name)
+        if owner is not None and owner is not client:
+            return False
+        if client.name is not None and self.by_name.get(client.name) is client:
+            del self.by_name[client.name]
+        client.name = name
+        self.by_name[name] = client
+        return True
@@ -0,0 +1,129 @@
+from typing import TYPE_CHECKING, Callable, Generic, Iterable, Iterator, TypeVar
+
+from tchat.binary import BinaryMessage, encode_text
+from tchat.fanout import Frames
+
+if TYPE_CHECKING:
+    from tchat.registry import Client
+
+
+DEFAULT_ROOM = "accueil"
+
+ClientType = TypeVar("ClientType", bound="Client")
+
+
+class Rooms(Generic[ClientType]):
+    """Room -> members index, the reverse index is `Client.rooms`.
+
+    A client may be in several rooms, the last one joined is its current room,
+    where its messages go. Rooms are created by their first member and removed
+    with their last one. Members are kept in joining order (dicts used as
+    ordered sets), so a broadcast always reaches them in the same order.
+    """
+
+    def __init__(self, default_room: str = DEFAULT_ROOM):
+        self.default_room = default_room
+        self.members: dict[str, dict[ClientType, None]] = {}
+
+    def __contains__(self, room: object) -> bool:
+        return room in self.members
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.members)
+
+    def join(self, client: ClientType, room: str) -> bool:
+        # False if the client was already a member, the room becomes current
+        members = self.members.setdefault(room, {})
+        joined = client not in members
+        members[client] = None
+        client.rooms.pop(room, None)
+        client.rooms[room] = None
+        return joined
+
+    def leave(self, client: ClientType, room: str) -> bool:
+        if room not in client.rooms:
+            return False
+        del client.rooms[room]
+        members = self.members[room]
+        del members[client]
+        if not members:
+            del self.members[room]
+        return True
+
+    def leave_all(self, client: ClientType) -> list[str]:
+        rooms = list(client.rooms)
+        for room in rooms:
+            self.leave(client, room)
+        return rooms
+
+    def current(self, client: ClientType) -> str | None:
+        return next(reversed(client.rooms), None)
+
+    def members_of(self, rooms: Iterable[str]) -> dict[ClientType, None]:
+        members: dict[ClientType, None] = {}
+        for room in rooms:
+            members.update(self.members.get(room, {}))
+        return members
+
+    def audience(self, client: ClientType) -> dict[ClientType, None]:
+        # Everybody sharing at least one room with the client, included
+        return self.members_of(client.rooms)
+
+    def fan_out(
+        self,
+        room: str,
+        frames: Frames,
+        push: Callable[[ClientType, bytes], object],
+        exclude: ClientType | None = None,
+        sequenced_frames: Frames | None = None,
+        binary: Callable[[], BinaryMessage | None] | None = None,
+    ) -> int:
+        # Members that asked for sequence numbers get `sequenced_frames`,
+        # binary members the message made by `binary`, called for the first
+        # of them only, or `frames` behind TEXT headers without it
+        message: BinaryMessage | None = None
+        text_frames: Frames | None = None
+        count = 0
+        for member in self.members.get(room, ()):
+            if member is exclude:
+                continue
+            session = member.binary
+            if session is None:
+                if member.sequenced and sequenced_frames is not None:
+                    member_frames = sequenced_frames
+                else:
+                    member_frames = frames
+            else:
+                if binary is not None:
+                    message = binary()
+                    binary = None
+                    if message is not None:
+                        sender, room_id = message.sender, message.room
+                        sender_definition = message.sender_definition
+                        room_definition = message.room_definition
+                        binary_frames = message.frames
+                if message is None:
+                    if text_frames is None:
+                        text_frames = encode_text(frames)
+                    member_frames = text_frames
+                # Inlined BinarySession.message_frames(), for the ids it knows
+                elif (
+                    session.names.get(sender) is sender_definition
+                    and session.rooms.get(room_id) is room_definition
+                ):
+                    member_frames = binary_frames
+                else:
+                    member_frames = session.message_frames(message)
+            for frame in member_frames:
+                push(member, frame)
+            count += 1
+        return count
+
+    def sender_label(self, room: str, name: str) -> str:
+        # Messages of the default room keep the historical "name> " header
+        if room == self.default_room:
+            return name
+        return f"[{room}] {name}"
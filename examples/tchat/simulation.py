@@ -0,0 +1,462 @@
+import asyncio
+from collections import deque
+from collections.abc import Mapping
+from dataclasses import dataclass
+import itertools
+import json
+import random
+import selectors
+from typing import Any, Callable, Coroutine, Iterable, Iterator, TypeVar
+import zlib
+
+
+T = TypeVar("T")
+TRANSPORT_HIGH_WATERMARK = 64 * 1024
+TRANSPORT_LOW_WATERMARK = 16 * 1024
+
+
+class SimulatedSelector(selectors.BaseSelector):
+    """Selector without system calls, over MemorySockets and a virtual clock.
+
+    Only memory sockets ever become ready. When nothing is, select() moves the
+    clock straight to the end of its timeout, so waiting costs nothing.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self._keys: dict[Any, selectors.SelectorKey] = {}
+        # Memory sockets with data or an end of stream to read, or with
+        # EVENT_WRITE interest: the only candidates of select()
+        self._candidates: dict[Any, None] = {}
+
+    def register(self, fileobj: Any, events: int, data: Any = None):
+        if fileobj in self._keys:
+            raise KeyError(f"{fileobj!r} is already registered")
+        fd = fileobj if isinstance(fileobj, int) else id(fileobj)
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self._keys[fileobj] = key
+        self.wake(fileobj)
+        return key
+
+    def unregister(self, fileobj: Any) -> selectors.SelectorKey:
+        self._candidates.pop(fileobj, None)
+        return self._keys.pop(fileobj)
+
+    def modify(self, fileobj: Any, events: int, data: Any = None):
+        key = self._keys[fileobj]._replace(events=events, data=data)
+        self._keys[fileobj] = key
+        self.wake(fileobj)
+        return key
+
+    def wake(self, fileobj: Any):
+        if isinstance(fileobj, MemorySocket) and fileobj in self._keys:
+            self._candidates[fileobj] = None
+
+    def select(self, timeout: float | None = None):
+        ready = []
+        for fileobj in list(self._candidates):
+            key = self._keys[fileobj]
+            events = 0
+            if key.events & selectors.EVENT_READ and fileobj.readable():
+                events |= selectors.EVENT_READ
+            if key.events & selectors.EVENT_WRITE:
+                events |= selectors.EVENT_WRITE
+            if events:
+                ready.append((key, events))
+            else:
+                del self._candidates[fileobj]
+        if not ready:
+            if timeout is None:
+                raise RuntimeError("Simulation bloquée: plus rien ne peut arriver")
+            self.now += timeout
+        return ready
+
+    def close(self):
+        self._keys.clear()
+        self._candidates.clear()
+
+    def get_map(self) -> Mapping[Any, selectors.SelectorKey]:
+        return self._keys
+
+
+class SimulatedLoop(asyncio.SelectorEventLoop):
+    """asyncio loop on virtual time: timers fire in order, without waiting.
+
+    Callbacks run in the order asyncio schedules them and every random choice
+    of the simulation comes from `random`, so a run only depends on its seed.
+    """
+
+    def __init__(self, seed: int = 0):
+        self.random = random.Random(seed)
+        super().__init__(SimulatedSelector())
+
+    def time(self) -> float:
+        return self._selector.now  # type: ignore [attr-defined]
+
+
+def run_simulation(main: Coroutine[Any, Any, T], seed: int = 0) -> T:
+    with asyncio.Runner(loop_factory=lambda: SimulatedLoop(seed)) as runner:
+        return runner.run(main)
+
+
+class SimulatedClient:
+    # Remote end of a simulated connection, it only records what it receives
+
+    def __init__(self, network: "SimulatedNetwork", index: int):
+        self.network = network
+        self.index = index
+        self.received_bytes = 0
+        self.closed = False
+        self._send: Callable[[bytes], None] = lambda data: None
+        self._close: Callable[[], None] = lambda: None
+
+    def data_received(self, data: bytes):
+        self.received_bytes += len(data)
+        self.network.record(self, data)
+
+    def send(self, data: bytes):
+        self._send(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._close()
+
+
+class SimulatedNetwork:
+    """Connections between simulated clients and a server, without sockets.
+
+    Everything the clients receive is folded into `digest`, two runs of the
+    same trace with the same seed have the same digest.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.delayed = latency > 0 or jitter > 0
+        self.digest = 0
+        self.deliveries = 0
+        self.delivered_bytes = 0
+        self._indexes = itertools.count()
+
+    def record(self, client: SimulatedClient, data: bytes):
+        self.deliveries += 1
+        self.delivered_bytes += len(data)
+        digest = zlib.crc32(client.index.to_bytes(4), self.digest)
+        self.digest = zlib.crc32(data, digest)
+
+    def delay(self, rng: random.Random) -> float:
+        return self.latency + (rng.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def connect_protocol(
+        self, loop: SimulatedLoop, protocol: asyncio.BaseProtocol
+    ) -> SimulatedClient:
+        # asyncio server side: the protocol gets a MemoryTransport
+        client = SimulatedClient(self, next(self._indexes))
+        transport = MemoryTransport(loop, protocol, client, self)
+        client._send = transport.feed
+        client._close = transport.peer_closed
+        protocol.connection_made(transport)
+        return client
+
+    def connect_socket(
+        self, selector: SimulatedSelector
+    ) -> tuple[SimulatedClient, "MemorySocket"]:
+        # Selector server side (50-tchat.py): the server gets a MemorySocket
+        client = SimulatedClient(self, next(self._indexes))
+        sock = MemorySocket(selector, client)
+        client._send = sock.feed
+        client._close = sock.peer_closed
+        return client, sock
+
+
+class Link:
+    # One direction of a simulated connection: items arrive after the network
+    # delay, in the order they were sent whatever the jitter.
+
+    def __init__(
+        self,
+        loop: SimulatedLoop,
+        network: SimulatedNetwork,
+        arrive: Callable[[Any], None],
+    ):
+        self.loop = loop
+        self.network = network
+        self.arrive = arrive
+        self.in_flight: deque[tuple[float, Any]] = deque()
+
+    def send(self, item: Any):
+        if not self.network.delayed:
+            # Like a socket buffer: the data is there as soon as it is written
+            self.arrive(item)
+            return
+        when = self.loop.time() + self.network.delay(self.loop.random)
+        if self.in_flight:
+            when = max(when, self.in_flight[-1][0])
+        self.in_flight.append((when, item))
+        if len(self.in_flight) == 1:
+            self.loop.call_at(when, self._arrived)
+
+    def _arrived(self):
+        # The timer was set for the head, the items due at the same time follow
+        _, item = self.in_flight.popleft()
+        self.arrive(item)
+        now = self.loop.time()
+        while self.in_flight and self.in_flight[0][0] <= now:
+            _, item = self.in_flight.popleft()
+            self.arrive(item)
+        if self.in_flight:
+            self.loop.call_at(self.in_flight[0][0], self._arrived)
+
+
+class MemoryTransport(asyncio.Transport):
+    """Server side transport of a simulated connection.
+
+    Writes reach the client after the network delay, in order. The bytes not
+    delivered yet count as the write buffer and drive pause_writing() and
+    resume_writing() like a socket buffer would.
+    """
+
+    def __init__(
+        self,
+        loop: SimulatedLoop,
+        protocol: asyncio.BaseProtocol,
+        client: SimulatedClient,
+        network: SimulatedNetwork,
+    ):
+        super().__init__({"peername": ("sim", client.index), "sockname": ("sim", 0)})
+        self._loop = loop
+        self._protocol = protocol
+        self._client = client
+        self._closing = False
+        self._reading = True
+        self._pending_input: list[bytes | None] = []
+        self._buffer_size = 0
+        self._high_water = TRANSPORT_HIGH_WATERMARK
+        self._low_water = TRANSPORT_LOW_WATERMARK
+        self._writing_paused = False
+        self._output = Link(loop, network, self._deliver)
+        self._input = Link(loop, network, self._receive)
+
+    # Server -> client
+
+    def write(self, data: bytes | bytearray | memoryview):
+        if self._closing or not data:
+            return
+        data = bytes(data)
+        self._buffer_size += len(data)
+        self._output.send(data)
+        if not self._writing_paused and self._buffer_size > self._high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def writelines(self, list_of_data: Iterable[bytes | bytearray | memoryview]):
+        self.write(b"".join(list_of_data))
+
+    def _deliver(self, data: bytes):
+        self._buffer_size -= len(data)
+        if not self._client.closed:
+            self._client.data_received(data)
+        if self._writing_paused and self._buffer_size <= self._low_water:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+
+    def get_write_buffer_size(self) -> int:
+        return self._buffer_size
+
+    def get_write_buffer_limits(self) -> tuple[int, int]:
+        return self._low_water, self._high_water
+
+    def set_write_buffer_limits(self, high: int | None = None, low: int | None = None):
+        self._high_water = TRANSPORT_HIGH_WATERMARK if high is None else high
+        self._low_water = self._high_water // 4 if low is None else low
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    # Client -> server
+
+    def feed(self, data: bytes):
+        self._input.send(data)
+
+    def _receive(self, data: bytes | None):
+        if self._closing:
+            return
+        if not self._reading:
+            self._pending_input.append(data)
+            return
+        if data is None:
+            self._eof()
+            return
+        if isinstance(self._protocol, asyncio.BufferedProtocol):
+            view = memoryview(data)
+            while view:
+                buffer = self._protocol.get_buffer(len(view))
+                size = min(len(buffer), len(view))
+                buffer[:size] = view[:size]
+                self._protocol.buffer_updated(size)
+                view = view[size:]
+        else:
+            self._protocol.data_received(data)  # type: ignore [attr-defined]
+
+    def peer_closed(self):
+        self._input.send(None)
+
+    def _eof(self):
+        keep_open = self._protocol.eof_received()  # type: ignore [attr-defined]
+        if not keep_open:
+            self.close()
+
+    def pause_reading(self):
+        self._reading = False
+
+    def resume_reading(self):
+        self._reading = True
+        pending, self._pending_input = self._pending_input, []
+        for data in pending:
+            self._receive(data)
+
+    def is_reading(self) -> bool:
+        return self._reading
+
+    # Both ways
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._client.closed = True
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self._protocol
+
+    def set_protocol(self, protocol: asyncio.BaseProtocol):
+        self._protocol = protocol
+
+
+class MemorySocket:
+    """Stand-in for a non-blocking connected socket of 50-tchat.py.
+
+    Only what the selector server uses is there: recv_into(), sendmsg(),
+    getpeername(), getsockname() and close(). Sent bytes reach the client at once.
+    """
+
+    def __init__(self, selector: SimulatedSelector, client: SimulatedClient):
+        self.selector = selector
+        self.client = client
+        self.inbound = bytearray()
+        self.eof = False
+        self.closed = False
+
+    def fileno(self) -> int:
+        return -1 if self.closed else id(self)
+
+    def getpeername(self) -> tuple[str, int]:
+        return ("sim", self.client.index)
+
+    def getsockname(self) -> tuple[str, int]:
+        return ("sim", 0)
+
+    def feed(self, data: bytes):
+        self.inbound += data
+        self.selector.wake(self)
+
+    def peer_closed(self):
+        self.eof = True
+        self.selector.wake(self)
+
+    def readable(self) -> bool:
+        return bool(self.inbound) or self.eof
+
+    def recv_into(self, buffer: memoryview | bytearray, nbytes: int = 0) -> int:
+        if not self.inbound:
+            if self.eof:
+                return 0
+            raise BlockingIOError
+        size = min(nbytes or len(buffer), len(self.inbound), len(buffer))
+        buffer[:size] = self.inbound[:size]
+        del self.inbound[:size]
+        return size
+
+    def sendmsg(self, buffers: Iterable[bytes | memoryview]) -> int:
+        if self.eof:
+            raise BrokenPipeError
+        data = b"".join(buffers)
+        self.client.data_received(data)
+        return len(data)
+
+    def setblocking(self, flag: bool):
+        pass
+
+    def close(self):
+        self.closed = True
+        self.client.closed = True
+
+
+@dataclass(slots=True)
+class TraceEvent:
+    time: float
+    client: int
+    kind: str  # "connect", "send" or "close"
+    data: bytes = b""
+
+
+def synthetic_trace(
+    seed: int,
+    clients: int,
+    messages: int,
+    rooms: int = 1,
+    rate: float = 1.0,
+    size: int = 64,
+) -> Iterator[TraceEvent]:
+    # Clients connect during the first second, choose a nickname and a room,
+    # then speak with Poisson arrivals (`rate` messages/s each) until
+    # `messages` have been sent, and leave.
+    rng = random.Random(seed)
+    for index in range(clients):
+        at = index / clients
+        yield TraceEvent(at, index, "connect")
+        setup = f"/pseudo u{index}\n"
+        if rooms > 1:
+            setup += f"/join salon{index % rooms}\n"
+        yield TraceEvent(at, index, "send", setup.encode())
+    now = 1.0
+    total_rate = rate * clients
+    padding = "x" * max(size - 12, 0)
+    for number in range(messages):
+        now += rng.expovariate(total_rate)
+        text = f"{number} {padding}\n".encode()
+        yield TraceEvent(now, rng.randrange(clients), "send", text)
+    for index in range(clients):
+        yield TraceEvent(now + 1.0, index, "close")
+
+
+def read_trace(path: str) -> Iterator[TraceEvent]:
+    # One JSON object per line: {"t": seconds, "c": client, "k": kind, "d": text}
+    with open(path, encoding="utf-8") as trace_file:
+        for line in trace_file:
+            event = json.loads(line)
+            yield TraceEvent(
+                event["t"], event["c"], event["k"], event.get("d", "").encode()
+            )
+
+
+def write_trace(path: str, events: Iterable[TraceEvent]):
+    with open(path, "w", encoding="utf-8") as trace_file:
+        for event in events:
+            record: dict[str, Any] = {
+                "t": event.time,
+                "c": event.client,
+                "k": event.kind,
+            }
+            if event.data:
+                record["d"] = event.data.decode()
+            trace_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
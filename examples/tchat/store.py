@@ -0,0 +1,581 @@
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from datetime import datetime
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Iterable, Iterator
+import zlib
+
+from tchat.logs import log
+
+
+# Log record: crc32 of what follows it, sequence, time, then the sizes of the
+# room, author and text that come after the header, UTF-8 encoded.
+RECORD = struct.Struct("<IQdHHI")
+# Index entry, one per record: sequence (0 for a free slot), time, offset of
+# the record in the log, crc32 of the room and of the author.
+INDEX_ENTRY = struct.Struct("<QdQII")
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Entries of an index file, created sparse: only written entries use disk
+INDEX_CAPACITY = 1024 * 1024
+BATCH_SIZE = 4096
+QUERY_LIMIT = 100
+# Bytes read at once for a record, most fit
+READ_AHEAD = 512
+# Index entries read at once by a search by author
+SCAN_CHUNK = 4096
+# Index entries a query looks at before it returns what it found so far with
+# where to go on, so that a single query never holds its thread for long
+SCAN_LIMIT = 64 * 1024
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "j": 86400, "d": 86400}
+
+
+def name_hash(name: str) -> int:
+    return zlib.crc32(name.encode())
+
+
+@dataclass
+class StoreConfig:
+    directory: str
+    # Seconds between two fsync() of the log, 0 after every batch, None never
+    fsync_interval: float | None = 1.0
+    segment_size: int = SEGMENT_SIZE
+    index_capacity: int = INDEX_CAPACITY
+
+
+@dataclass(slots=True)
+class StoredMessage:
+    seq: int
+    time: float
+    room: str
+    author: str
+    text: str
+
+    def format(self) -> str:
+        stamp = time.strftime("%d/%m %H:%M:%S", time.localtime(self.time))
+        return f"#{self.seq} {stamp} [{self.room}] {self.author}> {self.text}"
+
+
+@dataclass(slots=True)
+class QueryResult:
+    messages: list[StoredMessage] = field(default_factory=list)
+    # Sequence from which to go on when more messages may match, given back
+    # to since_seq() or as `before` to by_author(); None once complete
+    more: int | None = None
+
+
+class Segment:
+    """A log file and its memory-mapped index, named after their first sequence.
+
+    Index entries have a fixed size and sequences are consecutive, so the
+    entry of a sequence is found by position, and a time by binary search.
+    Only the writer thread appends; readers only look at the first `count`
+    entries, which are complete.
+
+    The positions of each room are kept apart, so that a query on a room
+    only reads its entries: in memory for the segment being written, then
+    saved when it is sealed as (room hash << 32 | position) sorted.
+    """
+
+    def __init__(self, directory: str, first_seq: int, capacity: int):
+        self.first_seq = first_seq
+        base = os.path.join(directory, f"{first_seq:020d}")
+        self.log_path = base + ".log"
+        self.index_path = base + ".idx"
+        self.authors_path = base + ".authors"
+        self.rooms_path = base + ".rooms"
+        self.fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(index_fd).st_size < capacity * INDEX_ENTRY.size:
+                os.ftruncate(index_fd, capacity * INDEX_ENTRY.size)
+            self.index = mmap.mmap(index_fd, 0)
+        finally:
+            os.close(index_fd)
+        self.capacity = len(self.index) // INDEX_ENTRY.size
+        self.count = self._written_entries()
+        self.size = os.fstat(self.fd).st_size
+        self.authors: set[int] | None = None
+        # Positions by room hash of the segment written, updated by _index()
+        self.room_positions: dict[int, array] | None = None
+        # The same for a sealed segment, loaded when first needed
+        self.room_keys: array | None = None
+        self.sealed = False
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, position: int) -> tuple[int, float, int, int, int]:
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        return INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)
+
+    @property
+    def last_seq(self) -> int:
+        return self.first_seq + self.count - 1
+
+    def time_at(self, position: int) -> float:
+        return self[position][1]
+
+    def _written_entries(self) -> int:
+        # Entries are written in order: the free ones (sequence 0) come last
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(self.index, middle * INDEX_ENTRY.size)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def recover(self):
+        # After a crash the log may hold records missing from the index, the
+        # last one maybe incomplete: index the valid ones, drop the rest.
+        end = 0
+        if self.count:
+            _, _, offset, _, _ = self[self.count - 1]
+            end = offset + self._record_size(offset)
+        recovered = 0
+        while end < self.size and self.count < self.capacity:
+            message = self.read_at(end)
+            if message is None or message.seq != self.first_seq + self.count:
+                break
+            self._index(message.seq, message.time, end, message.room, message.author)
+            end += self._record_size(end)
+            recovered += 1
+        if end < self.size:
+            dropped = self.size - end
+            log.warning("Journal %s tronqué de %d octets", self.log_path, dropped)
+            os.ftruncate(self.fd, end)
+            self.size = end
+        if recovered:
+            log.info("%d messages réindexés dans %s", recovered, self.index_path)
+
+    def _record_size(self, offset: int) -> int:
+        header = os.pread(self.fd, RECORD.size, offset)
+        _, _, _, room_size, author_size, text_size = RECORD.unpack(header)
+        return RECORD.size + room_size + author_size + text_size
+
+    def _index(self, seq: int, stamp: float, offset: int, room: str, author: str):
+        room_hash = name_hash(room)
+        INDEX_ENTRY.pack_into(
+            self.index,
+            self.count * INDEX_ENTRY.size,
+            seq,
+            stamp,
+            offset,
+            room_hash,
+            name_hash(author),
+        )
+        self.count += 1
+        if self.room_positions is not None:
+            positions = self.room_positions.get(room_hash)
+            if positions is None:
+                positions = self.room_positions[room_hash] = array("I")
+            positions.append(self.count - 1)
+
+    def read_at(self, offset: int) -> StoredMessage | None:
+        # None if the record is incomplete or corrupted
+        data = os.pread(self.fd, READ_AHEAD, offset)
+        if len(data) < RECORD.size:
+            return None
+        crc, seq, stamp, room_size, author_size, text_size = RECORD.unpack_from(data)
+        size = RECORD.size + room_size + author_size + text_size
+        if len(data) < size:
+            data = os.pread(self.fd, size, offset)
+            if len(data) < size:
+                return None
+        if zlib.crc32(memoryview(data)[4:size]) != crc:
+            return None
+        room_end = RECORD.size + room_size
+        author_end = room_end + author_size
+        return StoredMessage(
+            seq,
+            stamp,
+            data[RECORD.size : room_end].decode(),
+            data[room_end:author_end].decode(),
+            data[author_end:size].decode(),
+        )
+
+    def read(self, position: int) -> StoredMessage | None:
+        return self.read_at(self[position][2])
+
+    def has_author(self, author_hash: int) -> bool:
+        # Only known for sealed segments, the last one is still written
+        if not self.sealed:
+            return True
+        if self.authors is None:
+            self.load_authors()
+        return author_hash in self.authors  # type: ignore [operator]
+
+    def load_authors(self):
+        # Authors of a sealed segment are saved next to it, so that a search
+        # by author skips the segments where the author never wrote
+        if self.sealed and os.path.exists(self.authors_path):
+            with open(self.authors_path, "rb") as file:
+                data = file.read()
+            self.authors = set(memoryview(data).cast("I"))
+            return
+        hashes = memoryview(self.index)[: self.count * INDEX_ENTRY.size].cast("I")
+        self.authors = set(hashes[7::8])  # last field of each entry
+
+    def track_rooms(self):
+        # Called before the writer thread appends to the segment
+        self.room_positions = {}
+        for room_hash, positions in self._room_hashes().items():
+            self.room_positions[room_hash] = array("I", positions)
+
+    def _room_hashes(self) -> dict[int, list[int]]:
+        hashes = memoryview(self.index)[: self.count * INDEX_ENTRY.size].cast("I")
+        rooms: dict[int, list[int]] = {}
+        for position, room_hash in enumerate(hashes[6::8].tolist()):
+            rooms.setdefault(room_hash, []).append(position)
+        return rooms
+
+    def load_rooms(self) -> array:
+        if os.path.exists(self.rooms_path):
+            keys = array("Q")
+            with open(self.rooms_path, "rb") as file:
+                keys.frombytes(file.read())
+        else:
+            keys = array("Q", self._room_keys())
+        self.room_keys = keys
+        return keys
+
+    def _room_keys(self) -> Iterator[int]:
+        rooms = self.room_positions or self._room_hashes()
+        for room_hash in sorted(rooms):
+            for position in rooms[room_hash]:
+                yield room_hash << 32 | position
+
+    def positions_in_room(self, room_hash: int, start: int) -> Iterator[int]:
+        # Positions of the entries of a room from `start` on, oldest first
+        positions = self.room_positions
+        if positions is not None:
+            room = positions.get(room_hash, ())
+            for index in range(bisect_left(room, start), len(room)):
+                yield room[index]
+            return
+        keys = self.room_keys if self.room_keys is not None else self.load_rooms()
+        index = bisect_left(keys, room_hash << 32 | start)
+        while index < len(keys) and keys[index] >> 32 == room_hash:
+            yield keys[index] & 0xFFFFFFFF
+            index += 1
+
+    def author_positions(self, author_hash: int, start: int, end: int) -> Iterator[int]:
+        # Newest first from `end` down to `start`: the index is read backwards a
+        # chunk at a time, so a search stops as soon as it found enough messages
+        while end > start:
+            chunk_start = max(end - SCAN_CHUNK, start)
+            entries = memoryview(self.index)[
+                chunk_start * INDEX_ENTRY.size : end * INDEX_ENTRY.size
+            ]
+            hashes = entries.cast("I")[7::8].tolist()
+            for offset in range(len(hashes) - 1, -1, -1):
+                if hashes[offset] == author_hash:
+                    yield chunk_start + offset
+            end = chunk_start
+
+    def seal(self):
+        self.load_authors()
+        with open(self.authors_path, "wb") as file:
+            file.write(array("I", self.authors))  # type: ignore [arg-type]
+        with open(self.rooms_path, "wb") as file:
+            file.write(array("Q", self._room_keys()))
+        self.sealed = True
+
+    def flush(self):
+        os.fsync(self.fd)
+        self.index.flush()
+
+    def close(self):
+        self.index.close()
+        os.close(self.fd)
+
+
+class MessageStore:
+    """Durable log of the room messages, with queries by sequence, time, author.
+
+    `append()` only numbers the message and queues it: a thread writes the
+    queued messages in batches, one write() per batch, and calls fsync()
+    according to `fsync_interval`. Messages are stored in segment files of
+    about `segment_size` bytes, each with its memory-mapped index, so that
+    queries read the index and only the records they return, never the
+    whole log. A message is readable once written by the thread.
+    """
+
+    def __init__(self, config: StoreConfig):
+        self.config = config
+        os.makedirs(config.directory, exist_ok=True)
+        self.segments: list[Segment] = []
+        for name in sorted(os.listdir(config.directory)):
+            if name.endswith(".log"):
+                self.segments.append(
+                    Segment(config.directory, int(name[:-4]), config.index_capacity)
+                )
+        for segment in self.segments[:-1]:
+            segment.sealed = True
+        if not self.segments:
+            self.segments.append(Segment(config.directory, 1, config.index_capacity))
+        self.segments[-1].track_rooms()
+        self.segments[-1].recover()
+        self.last_seq = self.segments[-1].last_seq
+        self.records: queue.SimpleQueue[tuple | None] = queue.SimpleQueue()
+        self.written = 0
+        self.written_bytes = 0
+        last = self.segments[-1]
+        self._last_time = last.time_at(last.count - 1) if last.count else 0.0
+        self._last_sync = time.monotonic()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="message-store", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        if self._thread:
+            self.records.put(None)
+            self._thread.join()
+            self._thread = None
+        for segment in self.segments:
+            if self.config.fsync_interval is not None:
+                segment.flush()
+            segment.close()
+
+    def append(self, room: str, author: str, text: str, stamp: float | None = None):
+        # Called from the broadcast: no I/O, no encoding here
+        self.last_seq += 1
+        self.records.put_nowait(
+            (self.last_seq, stamp or time.time(), room, author, text)
+        )
+        return self.last_seq
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self.records.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            try:
+                self._write(batch)  # type: ignore [arg-type]
+            except OSError as error:
+                log.error("Écriture du journal des messages impossible: %s", error)
+                continue
+            self._sync()
+
+    def _write(self, batch: list[tuple[int, float, str, str, str]]):
+        segment = self.segments[-1]
+        chunks: list[bytes] = []
+        pending: list[tuple[int, float, int, str, str]] = []
+        size = segment.size
+        for seq, stamp, room, author, text in batch:
+            # Times never go back, so that they can be searched by bisection
+            stamp = self._last_time = max(stamp, self._last_time)
+            room_data, author_data = room.encode(), author.encode()
+            text_data = text.encode()
+            header = RECORD.pack(
+                0, seq, stamp, len(room_data), len(author_data), len(text_data)
+            )
+            body = b"".join((header[4:], room_data, author_data, text_data))
+            record = struct.pack("<I", zlib.crc32(body)) + body
+            # After a failed write the sequences of the messages it lost are
+            # skipped: a new segment keeps the entry of a sequence by position
+            skipped = seq != segment.first_seq + segment.count + len(pending)
+            full = segment.count + len(pending) >= segment.capacity
+            limit = self.config.segment_size
+            if skipped or full or (size and size + len(record) > limit):
+                self._commit(segment, chunks, pending)
+                segment = self._roll(seq)
+                chunks, pending, size = [], [], segment.size
+            pending.append((seq, stamp, size, room, author))
+            chunks.append(record)
+            size += len(record)
+        self._commit(segment, chunks, pending)
+
+    def _commit(
+        self,
+        segment: Segment,
+        chunks: list[bytes],
+        entries: list[tuple[int, float, int, str, str]],
+    ):
+        # The records first, then their index entries: a reader never finds
+        # an entry whose record is not written yet. When a write fails only
+        # the records entirely in the log are indexed.
+        data = b"".join(chunks)
+        start = segment.size
+        written = 0
+        try:
+            while written < len(data):
+                written += os.write(segment.fd, memoryview(data)[written:])
+        finally:
+            segment.size = start + written
+            ends = [entry[2] for entry in entries[1:]] + [start + len(data)]
+            indexed = 0
+            for entry, end in zip(entries, ends):
+                if end > segment.size:
+                    break
+                segment._index(*entry)
+                indexed += 1
+            self.written += indexed
+            self.written_bytes += written
+
+    def _roll(self, first_seq: int) -> Segment:
+        previous = self.segments[-1]
+        segment = Segment(self.config.directory, first_seq, self.config.index_capacity)
+        segment.track_rooms()
+        if not previous.count:
+            # Nothing could be written to it: replaced rather than kept empty
+            self.segments[-1] = segment
+            previous.close()
+            os.unlink(previous.log_path)
+            os.unlink(previous.index_path)
+            return segment
+        if self.config.fsync_interval is not None:
+            previous.flush()
+        previous.seal()
+        self.segments.append(segment)
+        return segment
+
+    def _sync(self):
+        interval = self.config.fsync_interval
+        if interval is None:
+            return
+        now = time.monotonic()
+        if now - self._last_sync >= interval:
+            self.segments[-1].flush()
+            self._last_sync = now
+
+    # Queries, from the event loop while the thread writes. Each one looks at
+    # SCAN_LIMIT index entries at most: a query on a room only at its own.
+
+    def _find_seq(self, seq: int) -> tuple[int, int]:
+        # (segment index, position) of the first message at or after `seq`
+        segments = self.segments
+        firsts = [segment.first_seq for segment in segments]
+        index = max(bisect_left(firsts, seq + 1) - 1, 0)
+        return index, max(seq - segments[index].first_seq, 0)
+
+    def _find_time(self, stamp: float) -> tuple[int, int]:
+        segments = self.segments
+        for index, segment in enumerate(segments):
+            if segment.count and segment.time_at(segment.count - 1) >= stamp:
+                return index, bisect_left(segment, stamp, key=lambda entry: entry[1])
+        return len(segments), 0
+
+    def _forward(
+        self, start: tuple[int, int], room: str | None, limit: int
+    ) -> QueryResult:
+        result = QueryResult()
+        scanned = 0
+        index, start_position = start
+        for segment in self.segments[index:]:
+            if room is None:
+                positions: Iterable[int] = range(start_position, segment.count)
+            else:
+                positions = segment.positions_in_room(name_hash(room), start_position)
+            for position in positions:
+                if len(result.messages) >= limit or scanned >= SCAN_LIMIT:
+                    # Another query goes on after the last entry looked at
+                    result.more = segment.first_seq + position - 1
+                    return result
+                scanned += 1
+                message = segment.read(position)
+                if message and (room is None or message.room == room):
+                    result.messages.append(message)
+            start_position = 0
+        return result
+
+    def get(self, seq: int) -> StoredMessage | None:
+        index, position = self._find_seq(seq)
+        segment = self.segments[index]
+        if seq < segment.first_seq or position >= segment.count:
+            return None
+        return segment.read(position)
+
+    def since_seq(
+        self, seq: int, room: str | None = None, limit: int = QUERY_LIMIT
+    ) -> QueryResult:
+        return self._forward(self._find_seq(seq + 1), room, limit)
+
+    def since_time(
+        self, stamp: float, room: str | None = None, limit: int = QUERY_LIMIT
+    ) -> QueryResult:
+        return self._forward(self._find_time(stamp), room, limit)
+
+    def by_author(
+        self, author: str, limit: int = QUERY_LIMIT, before: int | None = None
+    ) -> QueryResult:
+        # The latest messages of `author` before the sequence `before`, oldest
+        # first; `more` is then the oldest sequence looked at
+        author_hash = name_hash(author)
+        result = QueryResult()
+        messages = result.messages
+        budget = SCAN_LIMIT
+        if before is None:
+            last, end = len(self.segments) - 1, None
+        else:
+            last, end = self._find_seq(before)
+        for index in range(last, -1, -1):
+            segment = self.segments[index]
+            stop = segment.count if end is None else min(end, segment.count)
+            end = None
+            if not segment.has_author(author_hash):
+                continue
+            start = max(stop - budget, 0)
+            budget -= stop - start
+            for position in segment.author_positions(author_hash, start, stop):
+                message = segment.read(position)
+                if message and message.author == author:
+                    messages.append(message)
+                    if len(messages) >= limit:
+                        result.more = message.seq
+                        break
+            else:
+                if budget or start == index == 0:
+                    continue
+                result.more = segment.first_seq + start
+            break
+        messages.reverse()
+        return result
+
+
+def parse_since(argument: str, now: float | None = None) -> tuple[str, float]:
+    """("seq", number) for "1234", ("time", timestamp) for "10m", "2h", "1j" or
+    an ISO date "2026-10-18T10:00"; raises ValueError otherwise."""
+    if argument.isdigit():
+        return "seq", int(argument)
+    unit = DURATION_UNITS.get(argument[-1:])
+    if unit and argument[:-1].replace(".", "", 1).isdigit():
+        return "time", (now or time.time()) - float(argument[:-1]) * unit
+    return "time", datetime.fromisoformat(argument).timestamp()
+
+
+def format_result(result: QueryResult, command: str) -> str:
+    # The messages found, then `command` followed by where to go on if more
+    # may match
+    lines = [message.format() for message in result.messages]
+    if result.more is not None:
+        lines.append(f"Suite: {command} {result.more}")
+    return "\n".join(lines) or "Aucun message."
+
+
+def parse_fsync(value: str) -> float | None:
+    # --store-fsync: "always" after every batch, "never", or seconds between two
+    if value == "always":
+        return 0
+    if value == "never":
+        return None
+    return float(value)
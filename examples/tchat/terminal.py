@@ -0,0 +1,234 @@
+import asyncio
+from collections import deque
+import codecs
+import os
+import sys
+import time
+from typing import Callable
+
+from tchat.timers import PING_FRAME
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import termios
+
+
+# msvcrt has no handle to wait on: the keyboard is polled at this interval
+WINDOWS_POLL_INTERVAL = 0.03
+READ_SIZE = 4096
+# Received messages are shown at most this often, all at once
+FRAME_INTERVAL = 1 / 30
+CLEAR_LINE = "\33[2K\r"
+PING_LINE = PING_FRAME.decode()
+
+
+def write_to_terminal(text: str):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+class LineEditor:
+    """Line typed at the prompt, fed with the keys as they are read.
+
+    Handles Enter, Backspace and Ctrl+C, ignores the escape sequences of the
+    arrow and function keys.
+    """
+
+    def __init__(self, echo: bool = True, write: Callable[[str], object] | None = None):
+        self.echo = echo
+        self.write = write or write_to_terminal
+        self.line = ""
+        self._in_escape = False
+
+    def feed(self, keys: str) -> list[str]:
+        # Returns the lines completed by `keys`, with their "\n"
+        lines: list[str] = []
+        echoed: list[str] = []
+        for key in keys:
+            if self._in_escape:
+                # ESC [ or ESC O, parameters, then a final byte in @ to ~
+                self._in_escape = key in "\x1b[O" or not "@" <= key <= "~"
+            elif key == "\x1b":
+                self._in_escape = True
+            elif key == "\x03":
+                raise KeyboardInterrupt
+            elif key in "\r\n":
+                lines.append(self.line + "\n")
+                self.line = ""
+                echoed.append("\n")
+            elif key in "\x08\x7f":
+                if self.line:
+                    self.line = self.line[:-1]
+                    echoed.append("\b \b")
+            elif key.isprintable():
+                self.line += key
+                echoed.append(key)
+        if self.echo and echoed:
+            self.write("".join(echoed))
+        return lines
+
+
+class TerminalInput:
+    """Keyboard of a client, read without blocking nor polling where possible.
+
+    On Unix the terminal is put in raw mode while the object is used as a
+    context manager, so that keys are readable on stdin as soon as they are
+    typed: `fileno()` can be registered in a selector or with
+    `loop.add_reader()` and an idle client sleeps in the kernel. On Windows
+    the console is read with msvcrt, which can only be polled: `fileno()`
+    returns None and callers wait at most `poll_interval` between two reads.
+    Ctrl+C still raises KeyboardInterrupt through SIGINT on Unix.
+    """
+
+    def __init__(self, echo: bool = True):
+        self.windows = sys.platform == "win32"
+        self.fd = None if self.windows else sys.stdin.fileno()
+        is_tty = self.windows or os.isatty(self.fd)  # type: ignore [arg-type]
+        self.editor = LineEditor(echo and is_tty)
+        self.poll_interval = WINDOWS_POLL_INTERVAL if self.windows else None
+        self.lines: deque[str] = deque()
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._saved_mode: list | None = None
+
+    def __enter__(self) -> "TerminalInput":
+        if self.fd is not None and os.isatty(self.fd):
+            self._saved_mode = termios.tcgetattr(self.fd)
+            mode = termios.tcgetattr(self.fd)
+            # No line buffering nor echo by the terminal, one key is enough
+            # for read() to return. Output processing and signals are kept.
+            mode[3] &= ~(termios.ICANON | termios.ECHO)
+            mode[6][termios.VMIN] = 1
+            mode[6][termios.VTIME] = 0
+            termios.tcsetattr(self.fd, termios.TCSANOW, mode)
+        return self
+
+    def __exit__(self, *_):
+        if self._saved_mode is not None:
+            termios.tcsetattr(self.fd, termios.TCSADRAIN, self._saved_mode)
+            self._saved_mode = None
+
+    def fileno(self) -> int | None:
+        return self.fd
+
+    @property
+    def line(self) -> str:
+        # Text typed so far on the current line
+        return self.editor.line
+
+    def read_keys(self) -> str:
+        # Never blocks on Windows; on Unix, call when fileno() is readable
+        if self.windows:
+            keys: list[str] = []
+            while msvcrt.kbhit():
+                key_pressed = msvcrt.getch()
+                if key_pressed in b"\x00\xe0":
+                    msvcrt.getch()  # second half of an arrow or function key
+                    continue
+                keys.append(key_pressed.decode("cp850", errors="ignore"))
+            return "".join(keys)
+        data = os.read(self.fd, READ_SIZE)  # type: ignore [arg-type]
+        if not data:
+            raise EOFError
+        return self._decoder.decode(data)
+
+    def read_lines(self) -> list[str]:
+        # Feeds the available keys to the editor, returns the completed lines
+        return self.editor.feed(self.read_keys())
+
+    async def readline(self) -> str:
+        while not self.lines:
+            if self.fd is None:
+                await asyncio.sleep(self.poll_interval)
+            else:
+                await self._wait_readable()
+            self.lines.extend(self.read_lines())
+        return self.lines.popleft()
+
+    async def _wait_readable(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        # The callback may run again before this task resumes
+        loop.add_reader(self.fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            loop.remove_reader(self.fd)
+
+
+class Renderer:
+    """Received messages shown above the prompt, one screen update per frame.
+
+    Messages arriving within `interval` are written with a single write and
+    flush, followed by the prompt and the line being typed, instead of
+    redrawing the whole line for every message. Only complete lines are
+    shown, so a message split between two reads is never cut on screen.
+
+    With a `loop`, frames are scheduled on it; otherwise the caller waits at
+    most `timeout()` and calls `render_if_due()`. The "/ping" lines of the
+    server are not shown, `on_ping` answers them.
+    """
+
+    def __init__(
+        self,
+        prompt: str,
+        editor: LineEditor,
+        interval: float = FRAME_INTERVAL,
+        loop: asyncio.AbstractEventLoop | None = None,
+        write: Callable[[str], object] | None = None,
+        on_ping: Callable[[], object] | None = None,
+    ):
+        self.prompt = prompt
+        self.editor = editor
+        self.interval = interval
+        self.loop = loop
+        self.write = write or write_to_terminal
+        self.on_ping = on_ping
+        self.pending: list[str] = []
+        self.deadline: float | None = None
+        self.frames = 0
+        self._partial = ""
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def add(self, data: bytes):
+        self.add_text(self._decoder.decode(data))
+
+    def add_text(self, text: str):
+        text = self._partial + text
+        end = text.rfind("\n") + 1
+        self._partial = text[end:]
+        complete = text[:end]
+        if self.on_ping and PING_LINE in complete:
+            lines = complete.splitlines(keepends=True)
+            complete = "".join(line for line in lines if line != PING_LINE)
+            if len(complete) < end:
+                self.on_ping()
+        if not complete:
+            return
+        self.pending.append(complete)
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.interval
+            if self.loop:
+                self.loop.call_later(self.interval, self.render)
+
+    def timeout(self, default: float | None = None) -> float | None:
+        # How long the caller may sleep before the next frame is due
+        if self.deadline is None:
+            return default
+        remaining = max(self.deadline - time.monotonic(), 0)
+        return remaining if default is None else min(remaining, default)
+
+    def render_if_due(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.render()
+
+    def render(self):
+        self.deadline = None
+        if self.pending:
+            self.frames += 1
+            messages = "".join(self.pending)
+            self.pending.clear()
+            self.write(f"{CLEAR_LINE}{messages}{self.prompt}{self.editor.line}")
+
+    def show_prompt(self):
+        self.write(self.prompt)
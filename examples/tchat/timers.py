@@ -0,0 +1,220 @@
+import asyncio
+from dataclasses import dataclass
+import math
+import time
+from typing import Callable, Generic, TypeVar
+
+from tchat.logs import log
+from tchat.registry import Client
+
+
+TICK = 1.0
+WHEEL_SIZE = 512
+# Pings sent during the idle timeout by default, before the connection of a
+# silent client is closed
+PINGS_PER_TIMEOUT = 3
+# Sent to a silent client, which answers PONG_FRAME
+PING_FRAME = b"/ping\n"
+PONG_FRAME = b"/pong\n"
+
+
+class Timer:
+    __slots__ = ("tick", "callback", "args", "wheel")
+
+    def __init__(
+        self, tick: int, callback: Callable, args: tuple, wheel: "TimerWheel"
+    ):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.wheel: TimerWheel | None = wheel
+
+    @property
+    def active(self) -> bool:
+        return self.wheel is not None
+
+    def cancel(self):
+        if self.wheel:
+            self.wheel._remove(self)
+
+
+class TimerWheel:
+    """Hashed timer wheel: timers expire on ticks of `tick` seconds.
+
+    A timer goes in the slot of its expiry tick modulo `size`, a dict used as
+    an ordered set, so that scheduling and cancelling are O(1) whatever the
+    number of timers. Each tick only looks at its own slot; timers more than
+    `size` ticks away stay there for several turns of the wheel. Timers fire
+    up to one tick late, which is fine for timeouts in seconds.
+
+    The wheel has no thread nor task of its own: `advance()` is called by the
+    event loop of the server, which sleeps at most `timeout()` in between.
+    """
+
+    def __init__(
+        self,
+        tick: float = TICK,
+        size: int = WHEEL_SIZE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.tick = tick
+        self.size = size
+        self.clock = clock
+        self.slots: list[dict[Timer, None]] = [{} for _ in range(size)]
+        self.current_tick = int(clock() / tick)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        tick = max(
+            math.ceil((self.clock() + delay) / self.tick), self.current_tick + 1
+        )
+        timer = Timer(tick, callback, args, self)
+        self.slots[tick % self.size][timer] = None
+        self.count += 1
+        return timer
+
+    def _remove(self, timer: Timer):
+        del self.slots[timer.tick % self.size][timer]
+        timer.wheel = None
+        self.count -= 1
+
+    def timeout(self, default: float | None = None) -> float | None:
+        # How long the loop may sleep: until the next tick while timers are
+        # pending, `default` otherwise
+        if not self.count:
+            return default
+        remaining = max((self.current_tick + 1) * self.tick - self.clock(), 0)
+        return remaining if default is None else min(remaining, default)
+
+    def advance(self) -> int:
+        # Fires the expired timers, returns how many
+        now_tick = int(self.clock() / self.tick)
+        if not self.count:
+            self.current_tick = max(self.current_tick, now_tick)
+            return 0
+        expired: list[Timer] = []
+        # After a long sleep every slot is looked at once, not every tick
+        last_tick = min(now_tick, self.current_tick + self.size)
+        for tick in range(self.current_tick + 1, last_tick + 1):
+            slot = self.slots[tick % self.size]
+            if slot:
+                expired.extend(timer for timer in slot if timer.tick <= now_tick)
+        self.current_tick = max(self.current_tick, now_tick)
+        fired = 0
+        for timer in expired:
+            # A callback may cancel timers that expired on the same tick
+            if timer.wheel:
+                self._remove(timer)
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
+
+    async def run(self):
+        # Drives the wheel from an asyncio loop: one task for every timer
+        while True:
+            await asyncio.sleep(self.timeout(self.tick))  # type: ignore [arg-type]
+            self.advance()
+
+
+@dataclass
+class TimeoutConfig:
+    # Silence of a client before it is sent "/ping", 0 to never ping, None
+    # for a fraction of idle_timeout
+    ping_interval: float | None = None
+    # Silence before the connection is closed, 0 to keep silent clients: off
+    # by default, a plain client such as nc never answers "/ping"
+    idle_timeout: float = 0.0
+    # Delay to choose a nickname with /pseudo, 0 for no deadline
+    login_timeout: float = 0.0
+
+    @property
+    def ping_after(self) -> float:
+        if self.ping_interval is None:
+            return self.idle_timeout / PINGS_PER_TIMEOUT
+        return self.ping_interval
+
+
+ClientType = TypeVar("ClientType", bound=Client)
+
+
+class ConnectionTimers(Generic[ClientType]):
+    """Idle timeout, heartbeat and login deadline of the clients of a server.
+
+    A client has at most one idle timer and one login timer. Receiving data
+    only stores the time in `last_activity`: the idle timer is not moved, it
+    checks the silence when it fires and schedules itself again. A client
+    silent for `ping_interval` is sent "/ping", any data (tchat clients
+    answer "/pong") counts as an answer; after `idle_timeout` of silence the
+    connection is closed, which is how half-open connections go away.
+    """
+
+    def __init__(
+        self,
+        wheel: TimerWheel,
+        config: TimeoutConfig,
+        ping: Callable[[ClientType], object],
+        close: Callable[[ClientType], object],
+    ):
+        self.wheel = wheel
+        self.config = config
+        self.ping = ping
+        self.close = close
+        self.pings = 0
+        self.idle_closed = 0
+        self.login_closed = 0
+
+    def connected(self, client: ClientType):
+        client.last_activity = self.wheel.clock()
+        config = self.config
+        first_check = config.ping_after or config.idle_timeout
+        if first_check:
+            client.idle_timer = self.wheel.schedule(
+                first_check, self._check_idle, client
+            )
+        if config.login_timeout and client.name is None:
+            client.login_timer = self.wheel.schedule(
+                config.login_timeout, self._login_expired, client
+            )
+
+    def activity(self, client: ClientType):
+        client.last_activity = self.wheel.clock()
+
+    def logged_in(self, client: ClientType):
+        if client.login_timer:
+            client.login_timer.cancel()
+            client.login_timer = None
+
+    def disconnected(self, client: ClientType):
+        for timer in (client.idle_timer, client.login_timer):
+            if timer:
+                timer.cancel()
+        client.idle_timer = client.login_timer = None
+
+    def _check_idle(self, client: ClientType):
+        config = self.config
+        silence = self.wheel.clock() - client.last_activity
+        client.idle_timer = None
+        if config.idle_timeout and silence >= config.idle_timeout:
+            log.info("Client %s inactif depuis %.0f s", client.address, silence)
+            self.idle_closed += 1
+            self.close(client)
+            return
+        ping_after = config.ping_after
+        if ping_after and silence >= ping_after:
+            self.pings += 1
+            self.ping(client)
+            # Next check when the client has to have answered
+            delay = (config.idle_timeout or 2 * ping_after) - silence
+        else:
+            delay = (ping_after or config.idle_timeout) - silence
+        client.idle_timer = self.wheel.schedule(delay, self._check_idle, client)
+
+    def _login_expired(self, client: ClientType):
+        client.login_timer = None
+        if client.name is None:
+            log.info("Client %s sans pseudo après le délai", client.address)
+            self.login_closed += 1
+            self.close(client)